@@ -1,62 +1,179 @@
+"""Retarget the <Directory> of .idstv files, e.g. after moving a job to another drive.
+
+Each file is rewritten in one pass over its bytes. The new directory comes
+either from old=new prefix mappings (the longest matching old prefix wins,
+compared without regard to case or slash direction, as Windows does) or
+from --set, which puts the same directory everywhere like the original
+script did. Job trees are walked recursively and the files are handled by a
+pool of worker threads; files that already point at the target are left
+untouched, and changed files are written to a temporary file and renamed
+into place. NEW may lie inside OLD (a directory already under it is left
+alone) or be a parent of it (flattening a job folder).
+
+    python idstv_modderV2.py N:\\Jobs\\W8787 --map "C:\\Users\\SandroP\\Desktop=N:\\Jobs"
+    python idstv_modderV2.py N:\\Jobs\\W8787 --map "N:\\Jobs\\W8787=N:\\Jobs" --dry-run
+    python idstv_modderV2.py N:\\Jobs\\W8787 --set "N:\\Jobs\\W8787\\W8787-1-L\\" --dry-run
+"""
+import argparse
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+WORKERS = 8
+TEMP_SUFFIX = '.retarget'
+
 
 def replace_tag_content(file_content, tag, new_content):
     """Replace the content inside all occurrences of a specified tag."""
-    start_tag = f"<{tag}>"
-    end_tag = f"</{tag}>"
-    start_index = 0
+    pattern = re.compile(re.escape(f"<{tag}>") + '(.*?)' + re.escape(f"</{tag}>"), re.DOTALL)
+    return pattern.sub(lambda match: f"<{tag}>{new_content}</{tag}>", file_content)
 
-    while True:
-        found_start_index = file_content.find(start_tag, start_index)
-        end_index = file_content.find(end_tag, found_start_index)
 
-        if found_start_index == -1 or end_index == -1:
-            break  # No more tags found, break the loop
+directory_pattern = re.compile(rb'(<Directory>)(.*?)(</Directory>)', re.DOTALL)
 
-        # Replace the tag content
-        file_content = (
-            file_content[:found_start_index + len(start_tag)] 
-            + new_content 
-            + file_content[end_index:]
-        )
 
-        # Move past the last replaced tag
-        start_index = found_start_index + len(start_tag) + len(new_content)
+separator_pattern = re.compile(r'[\\/]')
 
-    return file_content
 
-def process_idstv_files(directory, new_directory_path):
-    try:
-        idstv_files = [f for f in os.listdir(directory) if f.endswith('.idstv')]
-    except Exception as e:
-        print(f"Error accessing directory '{directory}': {e}")
-        return
+def path_parts(path):
+    """The components of a path, split at either slash."""
+    return separator_pattern.split(path)
 
-    print(f"Found {len(idstv_files)} .idstv files to process.")
 
-    for idstv_file in idstv_files:
-        idstv_file_path = os.path.join(directory, idstv_file)
-        print(f"Processing file: {idstv_file}")
+def folded_parts(path):
+    """The components of a path prefix for comparing: casefolded, without the empty part of a trailing slash."""
+    parts = [part.casefold() for part in path_parts(path)]
+    while len(parts) > 1 and not parts[-1]:
+        parts.pop()
+    return parts
 
-        try:
-            with open(idstv_file_path, 'r') as file:
-                file_content = file.read()
-        except Exception as e:
-            print(f"Error reading file '{idstv_file}': {e}")
+
+class DirectoryMapping:
+    """Old directory prefixes and their new values; with fixed set, every directory becomes it."""
+
+    def __init__(self, mappings=(), fixed=None):
+        self.fixed = fixed
+        # Longest first, so N:\Jobs\W8787 is tried before N:\Jobs
+        self.mappings = sorted(((folded_parts(old), new, folded_parts(new)) for old, new in mappings),
+                               key=lambda mapping: len(mapping[0]), reverse=True)
+
+    def target(self, directory):
+        """The new value for a directory, or the directory itself when no mapping applies.
+
+        Paths are compared component by component, without regard to case or
+        slash direction. The result is the new prefix followed by the rest of
+        the original components, joined with the slash the new prefix uses.
+        """
+        if self.fixed is not None:
+            return self.fixed
+        parts = path_parts(directory)
+        folded = [part.casefold() for part in parts]
+        for old, new, folded_new in self.mappings:
+            if folded[:len(old)] != old:
+                continue
+            # With the new folder inside the old one, a directory already under it was retargeted before
+            if len(folded_new) > len(old) and folded[:len(folded_new)] == folded_new:
+                return directory
+            rest = parts[len(old):]
+            if not rest:
+                return new
+            separators = separator_pattern.findall(new) or separator_pattern.findall(directory)
+            return new.rstrip('\\/') + ''.join(separators[-1] + part for part in rest)
+        return directory
+
+
+def retarget_content(content, mapping):
+    """Return content with every <Directory> retargeted, and how many were changed."""
+    changed = 0
+
+    def replace(match):
+        nonlocal changed
+        directory = match.group(2).decode('utf-8', 'surrogateescape')
+        target = mapping.target(directory)
+        if target == directory:
+            return match.group(0)
+        changed += 1
+        return match.group(1) + target.encode('utf-8', 'surrogateescape') + match.group(3)
+
+    return directory_pattern.sub(replace, content), changed
+
+
+def retarget_file(path, mapping, dry_run=False):
+    """Retarget one file; returns the number of <Directory> tags that were changed."""
+    with open(path, 'rb') as file:
+        content = file.read()
+    new_content, changed = retarget_content(content, mapping)
+    if changed and not dry_run:
+        temp_path = path + TEMP_SUFFIX
+        with open(temp_path, 'wb') as file:
+            file.write(new_content)
+        os.replace(temp_path, path)
+    return changed
+
+
+def find_idstv_files(roots):
+    for root in roots:
+        if os.path.isfile(root):
+            yield root
             continue
+        for directory, _, filenames in os.walk(root):
+            for filename in filenames:
+                if filename.endswith('.idstv'):
+                    yield os.path.join(directory, filename)
+
 
-        # Replace <Directory> content
-        new_file_content = replace_tag_content(file_content, "Directory", new_directory_path)
+def retarget(roots, mapping, workers=WORKERS, dry_run=False):
+    """Retarget every .idstv file below roots; returns (files changed, files already on target, errors)."""
+    counts = [0, 0, 0]
 
+    def run(path):
         try:
-            # Save the changes back to the file
-            with open(idstv_file_path, 'w') as file:
-                file.write(new_file_content)
-            print(f"Updated <Directory> tag in {idstv_file}")
-        except Exception as e:
-            print(f"Error writing to file '{idstv_file}': {e}")
-
-# Directory containing the .idstv files
-directory_path = "C:\\Users\\SandroP\\OneDrive - Saskarc\\Desktop\\W8787\\W8787-1-L\\"
-new_directory_path = "C:\\Users\\SandroP\\OneDrive - Saskarc\\Desktop\\W8787\\W8787-1-L\\"
-process_idstv_files(directory_path, new_directory_path)
+            return path, retarget_file(path, mapping, dry_run), None
+        except OSError as e:
+            return path, 0, e
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for path, changed, error in executor.map(run, find_idstv_files(roots)):
+            if error is not None:
+                print(f"Error processing file '{path}': {error}")
+                counts[2] += 1
+            elif changed:
+                print(f"{'Would update' if dry_run else 'Updated'} {changed} <Directory> tags in {path}")
+                counts[0] += 1
+            else:
+                counts[1] += 1
+    return tuple(counts)
+
+
+def process_idstv_files(directory, new_directory_path):
+    """Put new_directory_path in every <Directory> of the .idstv files in directory (not recursive)."""
+    files = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.idstv')]
+    return retarget(files, DirectoryMapping(fixed=new_directory_path))
+
+
+def parse_mapping(text):
+    old, separator, new = text.partition('=')
+    if not separator or not old:
+        raise argparse.ArgumentTypeError(f"expected OLD=NEW, got {text!r}")
+    return old, new
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('roots', nargs='+', help='job folders (searched recursively) or .idstv files')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--map', dest='mappings', action='append', type=parse_mapping, metavar='OLD=NEW',
+                        help='replace the OLD directory prefix with NEW; can be given more than once')
+    target.add_argument('--set', dest='fixed', metavar='DIRECTORY', help='put DIRECTORY in every <Directory>')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--dry-run', action='store_true', help='report what would change without writing')
+    args = parser.parse_args(argv)
+
+    changed, unchanged, failed = retarget(args.roots, DirectoryMapping(args.mappings or (), args.fixed),
+                                          args.workers, args.dry_run)
+    print(f"{changed} files {'to update' if args.dry_run else 'updated'}, {unchanged} already on target, "
+          f"{failed} errors.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+"""Beamline and angle master tools: the file watcher, production reports and maintenance commands.
+
+The tools themselves live in the top-level pdc_* modules, which can still be
+run as scripts. This package gives them one entry point, ``pdc`` (or
+``python -m pdc``), see pdc.cli.
+"""
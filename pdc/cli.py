@@ -0,0 +1,57 @@
+"""One command line for all the tools.
+
+    pdc watch [options]       watch the folders (pdc_watcher.py)
+    pdc batch [options]       process what is already in the folders and exit
+    pdc report [XML]          production report (pdc_report.py)
+    pdc live [XML]            live production summary (report_live.py)
+    pdc retarget ROOT...      retarget .idstv <Directory> tags (idstv_modderV2.py)
+    pdc retry list|replay     dead letters (pdc_retry.py)
+    pdc archive list|rollback archived originals (pdc_archive.py)
+    pdc journal query|rotate  journal of processed files (pdc_journal.py)
+    pdc bench [options]       benchmarks (pdc_bench.py)
+    pdc soak [options]        watcher load test (pdc_soak.py)
+    pdc difftest [options]    engines against the legacy processors (pdc_difftest.py)
+
+Only the module behind the chosen command is imported, so watchdog,
+openpyxl and the rest are loaded only by the commands that use them;
+"pdc --help" and "pdc retarget" start without them. Everything after the
+command name is passed on to that tool; "pdc COMMAND --help" shows its
+options.
+"""
+import importlib
+import sys
+
+# command -> (module, arguments put in front of the user's, summary)
+COMMANDS = {
+    'watch': ('pdc_watcher', [], 'watch the folders and process new files'),
+    'batch': ('pdc_watcher', ['--batch'], 'process the files already in the folders and exit'),
+    'report': ('pdc_report', [], 'build the production report from the machine XML'),
+    'live': ('report_live', [], 'follow the machine XML and publish live totals'),
+    'retarget': ('idstv_modderV2', [], 'retarget <Directory> in .idstv files'),
+    'retry': ('pdc_retry', [], 'list or replay dead letters'),
+    'archive': ('pdc_archive', [], 'list or roll back archived originals'),
+    'journal': ('pdc_journal', [], 'look up processed files by job, path or time'),
+    'bench': ('pdc_bench', [], 'run the benchmarks'),
+    'soak': ('pdc_soak', [], 'load the watcher and report latency, drops and resource use'),
+    'difftest': ('pdc_difftest', [], 'check the engines give the same bytes as the legacy processors'),
+}
+
+
+def usage():
+    lines = ["usage: pdc COMMAND [ARGS...]", "", "commands:"]
+    lines += [f"  {name:10} {summary}" for name, (_, _, summary) in COMMANDS.items()]
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage())
+        return
+    name, arguments = argv[0], argv[1:]
+    if name not in COMMANDS:
+        sys.exit(f"pdc: unknown command {name!r}\n\n{usage()}")
+    module_name, extra_arguments, _ = COMMANDS[name]
+    module = importlib.import_module(module_name)
+    sys.argv[0] = f"pdc {name}"  # So the tool's help and errors show the command that was typed
+    return module.main(extra_arguments + arguments)
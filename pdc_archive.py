@@ -0,0 +1,174 @@
+"""Archive of original files, taken before the watcher changes them.
+
+Every original is stored once by its SHA-256 as a zlib-compressed blob, so
+the same piece exported into several jobs, or exported again unchanged,
+takes no extra space. A SQLite index records each version: the path it came
+from, the job, when it was archived and where the processed file ended up
+(.nc1 files are renamed).
+
+Rolling back restores the originals of a job folder, optionally only those
+archived in a time window, and removes the processed files that replaced
+them. Stop the watcher first, or the restored files are processed again.
+
+    python pdc_archive.py list N:/Jobs/W8787
+    python pdc_archive.py rollback N:/Jobs/W8787 --since 2024-05-02T06:00 --dry-run
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from pdc_metrics import REGISTRY
+
+ARCHIVE_DIR = 'pdc_archive'
+INDEX_FILE = 'index.sqlite'
+COMPRESSION_LEVEL = 6
+RESTORE_WORKERS = 8
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT, job TEXT, sha256 TEXT, size INTEGER,
+    archived_at REAL, targets TEXT);
+CREATE INDEX IF NOT EXISTS versions_path ON versions (path, archived_at);
+"""
+
+archived_files = REGISTRY.counter('pdc_archived_files_total', 'Originals archived', ['result'])
+archived_bytes = REGISTRY.counter('pdc_archived_bytes_total', 'Compressed bytes added to the archive')
+
+
+class Archive:
+    def __init__(self, directory=ARCHIVE_DIR):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, 'blobs'), exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(directory, INDEX_FILE), check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, 'blobs', digest[:2], digest)
+
+    def store(self, data):
+        """Store data as a blob unless it is already there; returns its SHA-256."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+        if os.path.exists(path):
+            archived_files.inc(result='duplicate')
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        compressed = zlib.compress(data, COMPRESSION_LEVEL)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as file:
+            file.write(compressed)
+        os.replace(temp_path, path)
+        archived_files.inc(result='stored')
+        archived_bytes.inc(len(compressed))
+        return digest
+
+    def snapshot(self, path, job, data, targets):
+        """Archive the original contents of path before it is replaced by targets."""
+        digest = self.store(data)
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO versions (path, job, sha256, size, archived_at, targets) VALUES (?, ?, ?, ?, ?, ?)",
+                (os.path.abspath(path), job, digest, len(data), time.time(),
+                 '\n'.join(os.path.abspath(target) for target in targets)))
+
+    def load(self, digest):
+        with open(self.blob_path(digest), 'rb') as file:
+            return zlib.decompress(file.read())
+
+    def versions(self, folder, since=None, until=None):
+        """The earliest version of each file under folder archived in the window, oldest first.
+
+        The earliest one is the file as it was before the first change in the window.
+        """
+        prefix = os.path.join(os.path.abspath(folder), '')
+        query = ("SELECT id, path, sha256, size, MIN(archived_at), targets FROM versions "
+                 "WHERE (path LIKE ? ESCAPE '\\' OR path = ?)")
+        parameters = [prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%',
+                      os.path.abspath(folder)]
+        if since is not None:
+            query += " AND archived_at >= ?"
+            parameters.append(since)
+        if until is not None:
+            query += " AND archived_at < ?"
+            parameters.append(until)
+        query += " GROUP BY path ORDER BY MIN(archived_at)"
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+    def restore(self, path, digest, targets):
+        """Put the original back at path and remove the processed files that replaced it."""
+        data = self.load(digest)
+        temp_path = path + '.restore'
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+        for target in targets.split('\n') if targets else []:
+            if target != path and os.path.exists(target):
+                os.remove(target)
+
+    def rollback(self, folder, since=None, until=None, dry_run=False, workers=RESTORE_WORKERS):
+        """Restore every file under folder archived in the window; returns (restored, failed)."""
+        versions = self.versions(folder, since, until)
+        if dry_run:
+            for _, path, _, size, archived_at, _ in versions:
+                archived = datetime.fromtimestamp(archived_at)
+                print(f"Would restore {path} ({size} bytes, archived {archived:%Y-%m-%d %H:%M:%S})")
+            return len(versions), 0
+
+        def run(version):
+            _, path, digest, _, _, targets = version
+            try:
+                self.restore(path, digest, targets)
+                return None
+            except (OSError, zlib.error) as e:
+                return f"Error restoring {path}: {e}"
+
+        failed = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for error in executor.map(run, versions):
+                if error is not None:
+                    print(error)
+                    failed += 1
+        return len(versions) - failed, failed
+
+
+def parse_time(text):
+    return datetime.fromisoformat(text).timestamp()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--archive', default=ARCHIVE_DIR, help='archive directory')
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name, help_text in [('list', 'show the archived originals of a folder'),
+                            ('rollback', 'restore the archived originals of a folder')]:
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('folder', help='job folder (or a single file)')
+        command.add_argument('--since', type=parse_time, help='only versions archived at or after this time')
+        command.add_argument('--until', type=parse_time, help='only versions archived before this time')
+        if name == 'rollback':
+            command.add_argument('--dry-run', action='store_true', help='list what would be restored')
+            command.add_argument('--workers', type=int, default=RESTORE_WORKERS)
+    args = parser.parse_args(argv)
+
+    archive = Archive(args.archive)
+    if args.command == 'list':
+        versions = archive.versions(args.folder, args.since, args.until)
+        for _, path, digest, size, archived_at, _ in versions:
+            print(f"{datetime.fromtimestamp(archived_at):%Y-%m-%d %H:%M:%S}  {digest[:12]}  {size:9}  {path}")
+        print(f"{len(versions)} files.")
+        return
+    restored, failed = archive.rollback(args.folder, args.since, args.until, args.dry_run, args.workers)
+    print(f"{restored} files {'to restore' if args.dry_run else 'restored'}, {failed} errors.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Asyncio engine that overlaps share round trips with the rules.
+
+With the thread engine each worker reads a file, transforms it, writes it
+and renames it, one step after the other, so on OneDrive or N:\\ a worker
+spends most of its time waiting on the share and the rules run only in the
+gaps. This engine runs the same Pipeline stages from one asyncio loop:
+
+- every blocking file system call (read, archive, write, rename, the retry
+  database) goes to a bounded pool of IO_WORKERS threads;
+- the .idstv rules, which are XML work and hold the GIL, go to a pool of
+  --workers processes, and the .nc1 rules run on as many threads;
+- up to PREFETCH files beyond the ones being transformed are read ahead,
+  so the next files are already in memory when a worker is free.
+
+Settling, bursts, priorities, retries and the journal are the WatchEngine's,
+so the engine serves both watching and --batch. Staging (--stage-dir) and
+the profilers need the thread engine.
+
+    python pdc_watcher.py --engine async
+    python pdc_watcher.py --engine async --batch --workers 4 --io-workers 16 --prefetch 32
+"""
+import asyncio
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from pdc_watcher import WORKERS, WatchEngine, burst_files, queue_depth
+
+IO_WORKERS = 8  # Threads doing blocking file system calls
+PREFETCH = 16  # Files read ahead of the ones being transformed
+
+
+class AsyncEngine(WatchEngine):
+    """A WatchEngine whose files are processed by an asyncio loop instead of worker threads."""
+
+    def __init__(self, pipeline=None, workers=WORKERS, io_workers=IO_WORKERS, prefetch=PREFETCH, **kwargs):
+        super().__init__(pipeline, workers=workers, **kwargs)
+        if self.profiler is not None:
+            raise ValueError("the async engine cannot profile files; use the thread engine")
+        if not self.pipeline.async_capable:
+            raise ValueError(f"{type(self.pipeline).__name__} needs the thread engine")
+        self.io_workers = io_workers
+        self.prefetch = prefetch
+        # Spawned rather than forked: the watcher has threads running, and Windows spawns anyway
+        self.pipeline.processes = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        self.loop_thread = threading.Thread(target=lambda: asyncio.run(self.dispatch()), name='async', daemon=True)
+        self.threads = self.threads[:1] + [self.loop_thread]  # The settle thread, and the loop instead of workers
+
+    def stop(self, *args, **kwargs):
+        super().stop(*args, **kwargs)
+        self.pipeline.processes.shutdown()
+
+    async def run_io(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.io_executor, partial(function, *args))
+
+    def read_queue(self, loop, items):
+        """Hand the engine's queue to the loop, one item at a time as the loop asks for them."""
+        while True:
+            wanted = asyncio.run_coroutine_threadsafe(items.join(), loop)
+            wanted.result()  # Wait until the loop has room for the last item, so the queue keeps deciding the order
+            item = self.queue.get()
+            loop.call_soon_threadsafe(items.put_nowait, item)
+            if item is None:
+                return
+
+    async def dispatch(self):
+        """Take queued files as fast as slots free up and process each one as an asyncio task."""
+        loop = asyncio.get_running_loop()
+        self.io_executor = ThreadPoolExecutor(self.io_workers, thread_name_prefix='pdc-io')
+        self.transform_executor = ThreadPoolExecutor(self.workers, thread_name_prefix='pdc-transform')
+        items = asyncio.Queue()
+        # A daemon thread of its own, since it blocks in queue.get() and would hold up an executor's shutdown
+        threading.Thread(target=self.read_queue, args=(loop, items), name='async-queue', daemon=True).start()
+        slots = asyncio.Semaphore(self.workers + self.prefetch)  # Files in memory at once
+        running = set()
+        try:
+            while True:
+                item = await items.get()
+                queue_depth.set(self.queue.qsize())
+                if item is None:
+                    self.queue.task_done()
+                    break
+                in_burst = isinstance(item, list)
+                file_tasks = []
+                for task in item if in_burst else [item]:
+                    await slots.acquire()
+                    file_tasks.append(asyncio.create_task(self.run_task_async(task, slots, in_burst)))
+                items.task_done()  # Only now may the reader take the next item off the priority queue
+                # One task_done() per queued item, once all of its files are through, for run_tasks()
+                done = asyncio.gather(*file_tasks)
+                done.add_done_callback(lambda _: self.queue.task_done())
+                running.add(done)
+                done.add_done_callback(running.discard)
+            if running:
+                await asyncio.gather(*running)
+        finally:
+            self.transform_executor.shutdown()
+            self.io_executor.shutdown()
+
+    async def run_task_async(self, task, slots, in_burst):
+        try:
+            processed = await self.process(task)
+            if self.retries is not None:
+                if processed:
+                    await self.run_io(self.retries.succeeded, task.path)
+                elif task.error is not None:
+                    await self.run_io(self.retries.failed, task, *task.error)
+            if processed and in_burst:
+                burst_files.inc(kind=task.kind)
+        except Exception:
+            logging.exception(f"Unexpected error with {task.path}")
+        finally:
+            slots.release()
+
+    async def process(self, task):
+        """Pipeline.process with its blocking calls run in the executors."""
+        pipeline = self.pipeline
+        pipeline.begin(task)
+        source = None
+        bytes_in = bytes_out = None
+        targets = ()
+        try:
+            with pipeline.stage('read', task):
+                source = await self.run_io(pipeline.read, task)
+            bytes_in = len(source)
+            with pipeline.stage('transform', task):
+                writes = await asyncio.get_running_loop().run_in_executor(
+                    self.transform_executor, pipeline.plan, task, source.data)
+            if writes:
+                targets = [target for target, _ in writes]
+                bytes_out = sum(rewrite.size() for _, rewrite in writes)
+                if pipeline.archive is not None and not task.outputs:
+                    with pipeline.stage('archive', task):
+                        await self.run_io(pipeline.archive.snapshot, task.path, task.job, source.data, targets)
+                with pipeline.stage('write', task):
+                    renames = await self.run_io(
+                        lambda: [(pipeline.write(task, rewrite, target), target) for target, rewrite in writes])
+                    del writes
+                await self.run_io(source.close)  # The source may be memory-mapped and must be closed first
+                with pipeline.stage('rename', task):
+                    await self.run_io(lambda: [pipeline.rename(task, temp_path, target)
+                                               for temp_path, target in renames])
+        except FileNotFoundError:
+            return pipeline.gone(task)
+        except Exception as e:
+            return pipeline.failed(task, e, bytes_in, bytes_out, targets)
+        finally:
+            if source is not None:
+                source.close()
+        return pipeline.done(task, bytes_in, bytes_out, targets)
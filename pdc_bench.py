@@ -0,0 +1,235 @@
+"""Benchmarks for the watcher processors and the production report.
+
+Times the pdcCodeFinal processors and pdc_report end to end on synthetic data
+of increasing size and writes the results to JSON, so two versions can be
+compared with --compare.
+
+    python pdc_bench.py --output bench_results.json
+    python pdc_bench.py --quick --compare bench_results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import pdcCodeFinal
+import synthetic_data
+
+SIZES = {
+    'remove_SI_block': [10, 100, 1000],  # SI lines per .nc1
+    'process_nc1_files_BL': [10, 100, 1000],  # hole lines per .nc1
+    'process_idstv_file_BL': [10, 100, 1000, 10000],  # PI elements per .idstv
+    'process_idstv_file_AM': [10, 100, 1000, 10000],  # PI elements per .idstv
+    'pipeline_nc1': [10, 100, 1000, 30000],  # hole and SI lines per .nc1 (30000 is memory-mapped)
+    'pipeline_idstv': [10, 100, 1000, 10000],  # PI elements per .idstv
+    'transform_id': [1000, 10000, 100000],  # IDs per call batch
+    'pdc_report': [100, 1000, 10000],  # PartReports per production XML
+    'pdc_report_cached': [100, 1000, 10000],  # PartReports per production XML, read from report_cache
+    'watcher_state': [1000, 10000, 100000],  # Files tracked by the watcher
+}
+QUICK_SIZES = {name: sizes[:2] for name, sizes in SIZES.items()}
+
+
+def time_runs(setup, run, repeat):
+    """Call setup() then time run(setup_result) repeat times.
+
+    Returns the timings in seconds and the peak Python memory of one extra,
+    untimed run traced with tracemalloc (memory-mapped files are not counted).
+    """
+    timings = []
+    for _ in range(repeat):
+        argument = setup()
+        start = time.perf_counter()
+        run(argument)
+        timings.append(time.perf_counter() - start)
+    argument = setup()
+    tracemalloc.start()
+    try:
+        run(argument)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return timings, peak
+
+
+def fresh_copy(source, workdir):
+    """Copy the pristine input next to the benchmark so in-place processors always see the original."""
+    def setup():
+        target = os.path.join(workdir, 'run', os.path.basename(source))
+        if os.path.exists(os.path.dirname(target)):
+            shutil.rmtree(os.path.dirname(target))
+        os.makedirs(os.path.dirname(target))
+        shutil.copyfile(source, target)
+        return target
+    return setup
+
+
+def bench_nc1(workdir, size, repeat, processor, by_scribes):
+    rng = random.Random(size)
+    source_dir = os.path.join(workdir, 'source')
+    os.makedirs(source_dir, exist_ok=True)
+    source = synthetic_data.write_nc1(source_dir, rng, size, holes=8 if by_scribes else size,
+                                      scribes=size if by_scribes else 6)
+    return time_runs(fresh_copy(source, workdir), processor, repeat), os.path.getsize(source)
+
+
+def bench_idstv(workdir, size, repeat, processor):
+    rng = random.Random(size)
+    source_dir = os.path.join(workdir, 'source')
+    os.makedirs(source_dir, exist_ok=True)
+    source = synthetic_data.write_idstv(source_dir, rng, size, pieces=size, angle=True)
+    if processor is pdcCodeFinal.process_idstv_file_AM:
+        # The AM rules run on the output of the BL rules, as in CombinedHandler
+        pdcCodeFinal.process_idstv_file_BL(source)
+    return time_runs(fresh_copy(source, workdir), processor, repeat), os.path.getsize(source)
+
+
+def bench_pipeline(workdir, size, repeat, kind):
+    """The watcher engine's single-read pipeline on the same inputs as the legacy processors."""
+    from pdc_watcher import FileTask, Pipeline
+    rng = random.Random(size)
+    source_dir = os.path.join(workdir, 'source')
+    os.makedirs(source_dir, exist_ok=True)
+    if kind == 'nc1':
+        source = synthetic_data.write_nc1(source_dir, rng, size, holes=size, scribes=size)
+    else:
+        source = synthetic_data.write_idstv(source_dir, rng, size, pieces=size, angle=True)
+    pipeline = Pipeline()
+
+    def run(path):
+        if not pipeline.process(FileTask(path, workdir)):
+            raise RuntimeError(f"the pipeline failed on {path}; see the log")
+
+    return time_runs(fresh_copy(source, workdir), run, repeat), os.path.getsize(source)
+
+
+def bench_transform_id(workdir, size, repeat):
+    rng = random.Random(size)
+    ids = [synthetic_data.piece_id(rng, number % 50 + 1, number + 1) for number in range(size)]
+    return time_runs(lambda: ids, lambda values: [pdcCodeFinal.transform_id(value) for value in values], repeat), 0
+
+
+def bench_report(workdir, size, repeat, cached=False):
+    """The production report to Excel and CSV; cached reads the XML from a cache file filled before timing."""
+    import pdc_report
+    from report_sinks import CsvSink
+    from shift_calendar import load_shift_calendar
+    source = synthetic_data.write_production_xml(os.path.join(workdir, 'production.xml'), random.Random(size), size)
+    calendar = load_shift_calendar(machine=pdc_report.MACHINE)
+    output_base = os.path.join(workdir, 'report')
+    cache_dir = os.path.join(workdir, 'report_cache') if cached else None
+    if cached:
+        pdc_report.build_report(source, [], calendar, cache_dir)
+
+    def run(_):
+        sinks = [pdc_report.ExcelSink(output_base + '.xlsx'), CsvSink(output_base + '.csv')]
+        pdc_report.build_report(source, sinks, calendar, cache_dir)
+    return time_runs(lambda: None, run, repeat), os.path.getsize(source)
+
+
+def bench_watcher_state(workdir, size, repeat):
+    """The watcher's per-file state: half the files wait to settle, the other half were written by it.
+
+    peak_bytes / size is what one tracked file costs.
+    """
+    from pdc_watcher import Pipeline, WatchEngine
+    root = 'C:/Users/SandroP/OneDrive - Saskarc/Desktop'
+
+    def run(engine):
+        for number in range(size):
+            # Ten files per assembly folder, so the folders stay below the burst threshold
+            path = (f"{root}/W{8700 + number // 20000}/W8787-{number // 2000 % 10}-L/A{number // 10:05d}/"
+                    f"W8787-1-L_270-MA{number % 50:03d}-m{number:06d}.nc1")
+            if number % 2:
+                engine.pipeline.mark_written(path, number, number)
+            else:
+                engine.notify(path, root)
+    return time_runs(lambda: WatchEngine(Pipeline()), run, repeat), 0
+
+
+BENCHMARKS = {
+    'remove_SI_block': lambda workdir, size, repeat: bench_nc1(
+        workdir, size, repeat, pdcCodeFinal.remove_SI_block, by_scribes=True),
+    'process_nc1_files_BL': lambda workdir, size, repeat: bench_nc1(
+        workdir, size, repeat, pdcCodeFinal.process_nc1_files_BL, by_scribes=False),
+    'process_idstv_file_BL': lambda workdir, size, repeat: bench_idstv(
+        workdir, size, repeat, pdcCodeFinal.process_idstv_file_BL),
+    'process_idstv_file_AM': lambda workdir, size, repeat: bench_idstv(
+        workdir, size, repeat, pdcCodeFinal.process_idstv_file_AM),
+    'pipeline_nc1': lambda workdir, size, repeat: bench_pipeline(workdir, size, repeat, 'nc1'),
+    'pipeline_idstv': lambda workdir, size, repeat: bench_pipeline(workdir, size, repeat, 'idstv'),
+    'transform_id': bench_transform_id,
+    'pdc_report': bench_report,
+    'pdc_report_cached': lambda workdir, size, repeat: bench_report(workdir, size, repeat, cached=True),
+    'watcher_state': bench_watcher_state,
+}
+
+
+def code_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or 'unknown'
+    except OSError:
+        return 'unknown'
+
+
+def run_benchmarks(sizes, repeat, names=None):
+    results = []
+    for name, benchmark in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        for size in sizes[name]:
+            with tempfile.TemporaryDirectory() as workdir:
+                (timings, peak), input_bytes = benchmark(workdir, size, repeat)
+            result = {'name': name, 'size': size, 'input_bytes': input_bytes, 'runs': repeat,
+                      'min': min(timings), 'median': statistics.median(timings), 'mean': statistics.mean(timings),
+                      'peak_bytes': peak, 'peak_bytes_per_unit': peak / size}
+            results.append(result)
+            print(f"{name:24} size={size:<7} median={result['median'] * 1000:10.3f} ms  "
+                  f"min={result['min'] * 1000:10.3f} ms  peak={peak / 1024:10.1f} KiB ({peak / size:8.1f} B/unit)")
+    return results
+
+
+def compare(results, baseline_path):
+    """Print the median of each benchmark against the same benchmark in an earlier results file."""
+    with open(baseline_path, 'r') as file:
+        baseline = {(entry['name'], entry['size']): entry for entry in json.load(file)['results']}
+    print(f"\nCompared with {baseline_path}:")
+    for result in results:
+        old = baseline.get((result['name'], result['size']))
+        if old is None:
+            continue
+        ratio = result['median'] / old['median'] if old['median'] else float('inf')
+        print(f"{result['name']:24} size={result['size']:<7} {old['median'] * 1000:10.3f} ms -> "
+              f"{result['median'] * 1000:10.3f} ms  x{ratio:.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='bench_results.json', help='where to write the JSON results')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark and size')
+    parser.add_argument('--quick', action='store_true', help='only the two smallest sizes')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='run only these benchmarks')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(QUICK_SIZES if args.quick else SIZES, args.repeat, args.only)
+    report = {'version': code_version(), 'created': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'platform': platform.platform(), 'results': results}
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
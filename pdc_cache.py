@@ -0,0 +1,157 @@
+"""Content-addressed cache of rule results.
+
+CAD re-exports and re-issued jobs bring the same .nc1/.idstv contents back
+again and again. The cache keys each result by a hash of the input bytes,
+the version of pdc_rules (a hash of its source, so any rule change starts a
+fresh cache), the file kind and the rule variant. It stores the transformed
+output, or an empty "no change" marker, as one file per key on the local
+disk. A repeat input then costs one hash and one copy instead of the regex
+and ElementTree work.
+
+The least recently used entries are evicted once the cache is bigger than
+its limit; use is recorded in the file mtimes, so the order survives a
+restart.
+
+    python pdc_watcher.py --cache-dir C:/pdc_result_cache --cache-max-mb 512
+"""
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import pdc_rules
+from pdc_metrics import REGISTRY
+
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+UNCHANGED_SUFFIX = '.same'
+
+cache_lookups = REGISTRY.counter('pdc_cache_lookups_total', 'Result cache lookups', ['result'])
+cache_hit_ratio = REGISTRY.gauge('pdc_cache_hit_ratio', 'Share of result cache lookups that were hits')
+cache_bytes = REGISTRY.gauge('pdc_cache_bytes', 'Bytes held in the result cache')
+cache_evictions = REGISTRY.counter('pdc_cache_evictions_total', 'Result cache entries evicted')
+
+UNCHANGED = object()  # What get() returns for a cached "no change" result
+
+
+def rules_version():
+    with open(pdc_rules.__file__, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()[:12]
+
+
+def content_hash(data):
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version = rules_version()
+        self.entries = OrderedDict()  # file name -> size, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.lookups = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def load(self):
+        entries = []
+        with os.scandir(self.directory) as listing:
+            for entry in listing:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self.entries[name] = size
+            self.size += size
+        cache_bytes.set(self.size)
+
+    def key(self, digest, kind, variant):
+        """File name for a result; variant names the rule stages (and for .nc1, whether it is renamed)."""
+        variant_hash = hashlib.blake2b(repr((kind, variant)).encode(), digest_size=6).hexdigest()
+        return f"{digest}-{self.version}-{variant_hash}"
+
+    def count(self, hit):
+        with self.lock:
+            self.lookups += 1
+            self.hits += hit
+            cache_hit_ratio.set(self.hits / self.lookups)
+        cache_lookups.inc(result='hit' if hit else 'miss')
+
+    def get(self, key):
+        """The cached output bytes, UNCHANGED, or None on a miss."""
+        with self.lock:
+            if key + UNCHANGED_SUFFIX in self.entries:
+                name = key + UNCHANGED_SUFFIX
+            elif key in self.entries:
+                name = key
+            else:
+                name = None
+            if name is not None:
+                self.entries.move_to_end(name)
+        if name is None:
+            self.count(False)
+            return None
+        path = os.path.join(self.directory, name)
+        try:
+            os.utime(path)
+            if name.endswith(UNCHANGED_SUFFIX):
+                result = UNCHANGED
+            else:
+                with open(path, 'rb') as file:
+                    result = file.read()
+        except OSError:
+            self.forget(name)
+            self.count(False)
+            return None
+        self.count(True)
+        return result
+
+    def put(self, key, rewrite):
+        """Store a pdc_rules.Rewrite (or an unchanged marker when it has no changes)."""
+        name = key if rewrite.changed else key + UNCHANGED_SUFFIX
+        path = os.path.join(self.directory, name)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'wb') as file:
+                if rewrite.changed:
+                    rewrite.write_to(file)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logging.error(f"Cannot store result in cache: {e}")
+            return
+        size = rewrite.size() if rewrite.changed else 0
+        with self.lock:
+            self.size += size - self.entries.pop(name, 0)
+            self.entries[name] = size
+            evicted = []
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                old_name, old_size = self.entries.popitem(last=False)
+                self.size -= old_size
+                evicted.append(old_name)
+            cache_bytes.set(self.size)
+        for old_name in evicted:
+            try:
+                os.remove(os.path.join(self.directory, old_name))
+            except OSError:
+                pass
+        cache_evictions.inc(len(evicted))
+
+    def forget(self, name):
+        with self.lock:
+            self.size -= self.entries.pop(name, 0)
+            cache_bytes.set(self.size)
+
+    def cached(self, digest, kind, variant, data, compute):
+        """The Rewrite of data for a variant, from the cache or from compute() (which is then cached)."""
+        key = self.key(digest, kind, variant)
+        result = self.get(key)
+        if result is UNCHANGED:
+            return pdc_rules.Rewrite(data)
+        if result is not None:
+            return pdc_rules.Rewrite(data, content=result)
+        rewrite = compute()
+        self.put(key, rewrite)
+        return rewrite
@@ -0,0 +1,515 @@
+"""Differential test of the rule engines against the processors running in production.
+
+Every .nc1 and .idstv of a corpus is processed twice: once by the legacy
+processors (the event handler of pdcCodeFinal.py, or another of the pdcCode
+scripts with --reference) and once by each new engine, each time on a fresh
+copy in its own folder. Afterwards the folders must be byte for byte the
+same, file names included, since .nc1 files are renamed. The engines are:
+
+    rules      pdc_rules on the bytes in memory (only the rules are timed)
+    pipeline   the watcher's Pipeline: read, rules, temporary file, rename
+    cached     the Pipeline answering from a warm pdc_cache result cache
+    staging    the pdc_staging pipeline: local copy, rules, push back
+    async      the pdc_async engine: I/O threads, .idstv rules in a process pool
+
+The corpus is made of real exports (--samples), synthetic files from
+synthetic_data (--generated) and fuzzed copies of both (--fuzzed): lines
+dropped, repeated, swapped or cut short, tags and markers spliced in,
+lengths moved onto the 279 mm angle limit, names shortened below the rename
+length. A few synthetic files of at least pdc_rules.MMAP_THRESHOLD bytes
+(--large) make the pipelines take their memory-mapped path as well.
+
+The report puts the result of each engine next to its speed against the
+legacy code, per file kind. A speedup only counts when every output was
+identical: an engine with differences is marked rejected, its first
+differences are described down to the byte, and with --diff-dir the input,
+both outputs and a unified diff of each are kept. The exit status is 1 when
+any engine differs. Outputs that differ only in line endings are counted
+apart: the legacy code writes in text mode, so its line endings depend on
+the platform it runs on; --strict-newlines counts them as differences.
+
+    python pdc_difftest.py --samples N:/Jobs/W8787 --generated 200 --fuzzed 1000
+    python pdc_difftest.py --engines rules pipeline --jobs 4 --diff-dir difftest_diffs
+"""
+import argparse
+import difflib
+import importlib
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import pdc_rules
+import synthetic_data
+from pdc_bench import code_version
+
+REFERENCE = 'pdcCodeFinal'
+REFERENCES = ['pdcCode', 'pdcCodeV2', 'pdcCodeV3', 'pdcCodeV4', REFERENCE]  # The legacy scripts shipped with the tools
+GENERATED = 200
+FUZZED = 500
+LARGE = 2  # Files big enough to be memory-mapped, alternately .nc1 and .idstv
+LARGE_NC1_HOLES = 30000  # About 1.5 MB with a third as many SI lines
+LARGE_IDSTV_PIECES = 6000  # About 1.7 MB
+MAX_MISMATCHES = 50  # Mismatches described in the report
+EXCERPT_BYTES = 40
+
+# Text spliced into fuzzed files: the markers, tags and shapes the rules react to
+IDSTV_FRAGMENTS = [
+    '<Name>W8787 W_W8X31</Name>', '<Name>W8787 HSS_HSS4X4X1/4</Name>', '<Name>x C_y S_z</Name>', '<Name>abc</Name>',
+    '<RemnantLocation>', '</RemnantLocation>', '<RemnantLocation>q</RemnantLocation>', '<ProfileType>L</ProfileType>',
+    '<ProfileType>I</ProfileType>', '<Filename>W8787-1-L_270-MA001-m0001</Filename>',
+    '<PieceIdentification>short</PieceIdentification>',
+    '<DrawingIdentification>W8787-1-L_270-MA001-m0001xx</DrawingIdentification>', '<Length>278.99</Length>',
+    '<PI>', '</PI>', '<BA>', '</BA>', 'L_', 'HP_', '  ', '\n',
+]
+NC1_FRAGMENTS = ['SI', 'BO', 'AK', 'EN', 'ST', '  SI', 'SIX', '  v    100.00o   20.00  0.00  10rX', '  W8787-1-L_270-MA1',
+                 '  W8787-1-L_270-MA001-m0001-extra', '', '  ']
+
+length_pattern = re.compile(r'<Length>[^<]*</Length>')
+
+
+def folder_state(directory):
+    """File name -> contents of every file left in directory."""
+    state = {}
+    for name in os.listdir(directory):
+        with open(os.path.join(directory, name), 'rb') as file:
+            state[name] = file.read()
+    return state
+
+
+class LegacyReference:
+    """The event handler of one of the pdcCode scripts, called as if watchdog had seen the file arrive."""
+
+    def __init__(self, module_name=REFERENCE):
+        from watchdog.events import FileCreatedEvent, FileSystemEventHandler
+        module = importlib.import_module(module_name)
+        handlers = [value for value in vars(module).values() if isinstance(value, type)
+                    and issubclass(value, FileSystemEventHandler) and value is not FileSystemEventHandler]
+        if not handlers:
+            raise ValueError(f"{module_name} has no event handler")
+        self.handler = handlers[0]()
+        self.event = FileCreatedEvent
+
+    def run(self, path):
+        start = time.perf_counter()
+        self.handler.on_created(self.event(path))
+        return time.perf_counter() - start
+
+
+class RulesEngine:
+    """pdc_rules on the bytes in memory; reading and writing the files is not timed."""
+
+    def __init__(self, scratch):
+        pass
+
+    def run(self, path):
+        directory, filename = os.path.split(path)
+        with open(path, 'rb') as file:
+            data = file.read()
+        start = time.perf_counter()
+        if filename.endswith('.nc1'):
+            target, rewrite = pdc_rules.rewrite_nc1(filename, data)
+        else:
+            target, rewrite = filename, pdc_rules.rewrite_idstv(data)
+        output = rewrite.to_bytes()
+        seconds = time.perf_counter() - start
+        os.remove(path)
+        with open(os.path.join(directory, target), 'wb') as file:
+            file.write(output)
+        return seconds
+
+
+class PipelineEngine:
+    """The watcher's Pipeline, file I/O included."""
+
+    def __init__(self, scratch):
+        self.scratch = scratch
+        self.pipeline = self.make_pipeline(scratch)
+
+    def make_pipeline(self, scratch):
+        from pdc_watcher import Pipeline
+        return Pipeline()
+
+    def process(self, path):
+        from pdc_watcher import FileTask
+        task = FileTask(path, os.path.dirname(path))
+        start = time.perf_counter()
+        self.pipeline.process(task)
+        self.pipeline.flush()
+        return time.perf_counter() - start
+
+    def run(self, path):
+        return self.process(path)
+
+
+class CachedEngine(PipelineEngine):
+    """The Pipeline with a result cache; each input is processed once to fill it and the cache hit is compared."""
+
+    def make_pipeline(self, scratch):
+        from pdc_cache import ResultCache
+        from pdc_watcher import Pipeline
+        return Pipeline(cache=ResultCache(os.path.join(scratch, 'cache')))
+
+    def run(self, path):
+        warm_directory = os.path.join(self.scratch, 'warm')
+        os.makedirs(warm_directory, exist_ok=True)
+        warm_path = os.path.join(warm_directory, os.path.basename(path))
+        shutil.copyfile(path, warm_path)
+        self.process(warm_path)
+        shutil.rmtree(warm_directory)
+        return self.process(path)
+
+
+class StagingEngine(PipelineEngine):
+    """The pdc_staging pipeline, pushing its results back before the folder is compared."""
+
+    def make_pipeline(self, scratch):
+        from pdc_staging import StagingPipeline
+        return StagingPipeline(os.path.join(scratch, 'stage'))
+
+
+class AsyncPipelineEngine(PipelineEngine):
+    """The Pipeline driven by pdc_async's engine, one file at a time through its queue."""
+
+    def __init__(self, scratch):
+        from pdc_async import AsyncEngine
+        super().__init__(scratch)
+        self.engine = AsyncEngine(self.pipeline, workers=1)
+        self.engine.start()
+        self.pipeline.processes.submit(int).result()  # Start the worker process before anything is timed
+
+    def process(self, path):
+        from pdc_watcher import FileTask
+        task = FileTask(path, os.path.dirname(path))
+        start = time.perf_counter()
+        self.engine.run_tasks([task])
+        return time.perf_counter() - start
+
+
+ENGINES = {
+    'rules': RulesEngine,
+    'pipeline': PipelineEngine,
+    'cached': CachedEngine,
+    'staging': StagingEngine,
+    'async': AsyncPipelineEngine,
+}
+
+
+def sample_files(roots):
+    """(name, contents, origin) of every .nc1 and .idstv below roots."""
+    for root in roots:
+        for directory, _, filenames in os.walk(root):
+            for filename in sorted(filenames):
+                if filename.endswith(('.nc1', '.idstv')):
+                    path = os.path.join(directory, filename)
+                    with open(path, 'rb') as file:
+                        yield filename, file.read(), 'sample'
+
+
+def generated_files(count, seed):
+    rng = random.Random(seed)
+    for number in range(count):
+        if number % 3 == 2:
+            angle = rng.random() < 0.6
+            prefix = synthetic_data.job_prefix(phase=rng.randint(1, 9), profile_letter='L' if angle else 'B')
+            text = synthetic_data.idstv_text(rng, prefix, rng.randint(0, 40), angle)
+            yield f"{prefix}bar{number:05d}.idstv", text.encode(), 'generated'
+        else:
+            prefix = synthetic_data.job_prefix(phase=rng.randint(1, 9))
+            ident = synthetic_data.piece_id(rng, number % 50 + 1, number + 1)
+            text = synthetic_data.nc1_text(rng, prefix, ident, rng.uniform(150, 6000), rng.randint(0, 12),
+                                           rng.randint(0, 8), rng.randint(0, 6))
+            yield f"{prefix}{ident}.nc1", text.encode(), 'generated'
+
+
+def large_files(count, seed):
+    """Synthetic files above pdc_rules.MMAP_THRESHOLD, which Pipeline.read memory-maps."""
+    rng = random.Random(seed)
+    for number in range(count):
+        if number % 2:
+            prefix = synthetic_data.job_prefix(profile_letter='L')
+            text = synthetic_data.idstv_text(rng, prefix, LARGE_IDSTV_PIECES)
+            name = f"{prefix}large{number:03d}.idstv"
+        else:
+            prefix = synthetic_data.job_prefix()
+            ident = synthetic_data.piece_id(rng, number % 50 + 1, number + 1)
+            text = synthetic_data.nc1_text(rng, prefix, ident, rng.uniform(150, 6000), LARGE_NC1_HOLES,
+                                           LARGE_NC1_HOLES // 3)
+            name = f"{prefix}{ident}.nc1"
+        data = text.encode()
+        assert len(data) >= pdc_rules.MMAP_THRESHOLD, f"{name} is only {len(data)} bytes"
+        yield name, data, 'large'
+
+
+def mutate(rng, name, text):
+    """A fuzzed copy of one file: a few random edits of its lines, and sometimes of its name."""
+    fragments = NC1_FRAGMENTS if name.endswith('.nc1') else IDSTV_FRAGMENTS
+    lines = text.split('\n')
+    for _ in range(rng.randint(1, 4)):
+        position = rng.randrange(len(lines))
+        operation = rng.randrange(7)
+        if operation == 0 and len(lines) > 1:
+            del lines[position]
+        elif operation == 1:
+            lines.insert(position, lines[position])
+        elif operation == 2:
+            other = rng.randrange(len(lines))
+            lines[position], lines[other] = lines[other], lines[position]
+        elif operation == 3:
+            lines.insert(position, rng.choice(fragments))
+        elif operation == 4:
+            line = lines[position]
+            cut = rng.randint(0, len(line))
+            lines[position] = line[:cut] + rng.choice(fragments) + line[cut:]
+        elif operation == 5:
+            length = rng.choice(['278.99', '279', '279.00', '279.01', '0', '-5', '1e3', 'x'])
+            lines[position] = length_pattern.sub(f'<Length>{length}</Length>', lines[position])
+        else:
+            lines = lines[:position + 1]
+    if rng.random() < 0.15:
+        stem, extension = os.path.splitext(name)
+        name = stem[-rng.randint(1, 20):] + extension  # Around the 25 character rename limit
+    text = '\n'.join(lines)
+    if rng.random() < 0.1:
+        text = text[:rng.randint(0, len(text))]
+    return name, text
+
+
+def fuzzed_files(count, seed, bases):
+    """count fuzzed files, each made from one of bases (name, contents) that decodes as text."""
+    rng = random.Random(seed)
+    bases = [(name, data.decode('utf-8')) for name, data in bases if is_text(data)]
+    if not bases:
+        return
+    for _ in range(count):
+        name, text = mutate(rng, *rng.choice(bases))
+        yield name, text.encode(), 'fuzzed'
+
+
+def is_text(data):
+    try:
+        data.decode('utf-8')
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def build_corpus(samples, generated, fuzzed, seed, large=0):
+    corpus = list(sample_files(samples)) + list(generated_files(generated, seed))
+    corpus += list(fuzzed_files(fuzzed, seed + 1, [(name, data) for name, data, _ in corpus]))
+    return corpus + list(large_files(large, seed + 2))
+
+
+def first_difference(expected, actual):
+    """Where two outputs part: the byte offset, its line and the bytes around it on both sides."""
+    offset = next((i for i, (a, b) in enumerate(zip(expected, actual)) if a != b), min(len(expected), len(actual)))
+    start = max(0, offset - EXCERPT_BYTES)
+    return {'offset': offset, 'line': expected.count(b'\n', 0, offset) + 1, 'legacy_size': len(expected),
+            'engine_size': len(actual), 'legacy': repr(expected[start:offset + EXCERPT_BYTES]),
+            'engine': repr(actual[start:offset + EXCERPT_BYTES])}
+
+
+def compare_states(expected, actual):
+    """'same', 'newline' (the same apart from line endings) or 'differs', and what differs first."""
+    if expected == actual:
+        return 'same', None
+    if set(expected) != set(actual):
+        return 'differs', {'legacy_files': sorted(expected), 'engine_files': sorted(actual)}
+    normalized = all(expected[name].replace(b'\r\n', b'\n') == actual[name].replace(b'\r\n', b'\n')
+                     for name in expected)
+    name = next(name for name in sorted(expected) if expected[name] != actual[name])
+    return 'newline' if normalized else 'differs', dict(file=name, **first_difference(expected[name], actual[name]))
+
+
+class Checker:
+    """Runs one corpus file through the reference and the engines, each in a fresh folder under scratch."""
+
+    def __init__(self, scratch, engine_names, reference=REFERENCE):
+        self.scratch = scratch
+        self.reference = LegacyReference(reference)
+        self.engines = {}
+        for name in engine_names:
+            engine_scratch = os.path.join(scratch, name)
+            os.makedirs(engine_scratch, exist_ok=True)
+            self.engines[name] = ENGINES[name](engine_scratch)
+
+    def run_in_folder(self, runner, name, data):
+        directory = os.path.join(self.scratch, 'case')
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as file:
+            file.write(data)
+        error = None
+        try:
+            seconds = runner.run(path)
+        except Exception as e:
+            seconds, error = None, f"{type(e).__name__}: {e}"
+        return folder_state(directory), seconds, error
+
+    def check(self, index, name, data, origin):
+        # The legacy handler can raise (e.g. on a Length that is not a number); what it left behind is the reference
+        legacy_state, legacy_seconds, legacy_error = self.run_in_folder(self.reference, name, data)
+        result = {'index': index, 'name': name, 'kind': name.rsplit('.', 1)[-1], 'origin': origin,
+                  'legacy_seconds': legacy_seconds, 'legacy_error': legacy_error, 'engines': {}}
+        for engine_name, engine in self.engines.items():
+            state, seconds, error = self.run_in_folder(engine, name, data)
+            status, difference = ('error', {'error': error}) if error else compare_states(legacy_state, state)
+            entry = {'status': status, 'seconds': seconds}
+            if status != 'same':
+                entry.update(difference=difference, input=data, legacy_state=legacy_state, engine_state=state)
+            result['engines'][engine_name] = entry
+        return result
+
+
+checker = None  # The Checker of a worker process
+
+
+def start_worker(scratch_root, engine_names, reference):
+    global checker
+    scratch = os.path.join(scratch_root, str(os.getpid()))
+    os.makedirs(scratch, exist_ok=True)
+    checker = Checker(scratch, engine_names, reference)
+
+
+def check_item(item):
+    return checker.check(*item)
+
+
+def run_corpus(corpus, engine_names, reference=REFERENCE, jobs=1):
+    """Check every file of the corpus; yields one result per file, in corpus order."""
+    items = [(index, name, data, origin) for index, (name, data, origin) in enumerate(corpus)]
+    with tempfile.TemporaryDirectory() as scratch_root:
+        if jobs <= 1:
+            start_worker(scratch_root, engine_names, reference)
+            yield from map(check_item, items)
+            return
+        with ProcessPoolExecutor(max_workers=jobs, initializer=start_worker,
+                                 initargs=(scratch_root, engine_names, reference)) as executor:
+            yield from executor.map(check_item, items, chunksize=16)
+
+
+def keep_diff(diff_dir, result, engine_name, entry):
+    """Write the input, both outputs and a unified diff of a mismatch under diff_dir."""
+    case_dir = os.path.join(diff_dir, f"{result['index']:05d}-{result['name']}")
+    for label, state in [('legacy', entry['legacy_state']), (engine_name, entry['engine_state'])]:
+        os.makedirs(os.path.join(case_dir, label), exist_ok=True)
+        for name, data in state.items():
+            with open(os.path.join(case_dir, label, name), 'wb') as file:
+                file.write(data)
+    with open(os.path.join(case_dir, 'input_' + result['name']), 'wb') as file:
+        file.write(entry['input'])
+    lines = []
+    for name in sorted(set(entry['legacy_state']) | set(entry['engine_state'])):
+        expected = entry['legacy_state'].get(name, b'').decode('utf-8', 'replace').splitlines(keepends=True)
+        actual = entry['engine_state'].get(name, b'').decode('utf-8', 'replace').splitlines(keepends=True)
+        lines += difflib.unified_diff(expected, actual, f"legacy/{name}", f"{engine_name}/{name}")
+    with open(os.path.join(case_dir, f"{engine_name}.diff"), 'w', encoding='utf-8') as file:
+        file.writelines(line if line.endswith('\n') else line + '\n' for line in lines)
+
+
+def summarize(results, engine_names, strict_newlines=False):
+    """Per engine and file kind: how many outputs matched and how fast it was against the legacy code."""
+    summary = {}
+    for engine_name in engine_names:
+        rows = {}
+        for result in results:
+            entry = result['engines'][engine_name]
+            for kind in (result['kind'], 'all'):
+                row = rows.setdefault(kind, {'files': 0, 'same': 0, 'newline': 0, 'differs': 0, 'error': 0,
+                                             'legacy_seconds': 0.0, 'engine_seconds': 0.0})
+                row['files'] += 1
+                row[entry['status']] += 1
+                if entry['seconds'] is not None and result['legacy_seconds'] is not None:
+                    row['legacy_seconds'] += result['legacy_seconds']
+                    row['engine_seconds'] += entry['seconds']
+        for row in rows.values():
+            row['speedup'] = row['legacy_seconds'] / row['engine_seconds'] if row['engine_seconds'] else None
+            failures = row['differs'] + row['error'] + (row['newline'] if strict_newlines else 0)
+            row['accepted'] = failures == 0
+        summary[engine_name] = rows
+    return summary
+
+
+def print_summary(summary):
+    print(f"\n{'engine':10} {'kind':6} {'files':>6} {'same':>6} {'newline':>8} {'differs':>8} {'errors':>7} "
+          f"{'legacy ms':>10} {'engine ms':>10} {'speedup':>8}")
+    for engine_name, rows in summary.items():
+        for kind, row in sorted(rows.items(), key=lambda item: item[0] == 'all'):
+            speedup = f"x{row['speedup']:.2f}" if row['speedup'] else '-'
+            print(f"{engine_name:10} {kind:6} {row['files']:6} {row['same']:6} {row['newline']:8} {row['differs']:8} "
+                  f"{row['error']:7} {row['legacy_seconds'] * 1000:10.1f} {row['engine_seconds'] * 1000:10.1f} "
+                  f"{speedup:>8}{'' if row['accepted'] else '  REJECTED'}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', nargs='*', default=[], help='folders of real exports (searched recursively)')
+    parser.add_argument('--generated', type=int, default=GENERATED, help='synthetic files to add')
+    parser.add_argument('--fuzzed', type=int, default=FUZZED, help='fuzzed copies of samples and synthetic files')
+    parser.add_argument('--large', type=int, default=LARGE, help='synthetic files big enough to be memory-mapped')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engines', nargs='+', choices=list(ENGINES), default=list(ENGINES))
+    parser.add_argument('--reference', default=REFERENCE, choices=REFERENCES,
+                        help='legacy script to hold the engines against')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='worker processes; more finish sooner but make the timings noisier')
+    parser.add_argument('--strict-newlines', action='store_true', help='count line ending differences as failures')
+    parser.add_argument('--diff-dir', help='keep the input, outputs and a unified diff of each mismatch here')
+    parser.add_argument('--output', default='difftest_results.json', help='where to write the JSON report')
+    args = parser.parse_args(argv)
+
+    corpus = build_corpus(args.samples, args.generated, args.fuzzed, args.seed, args.large)
+    origins = {}
+    for _, _, origin in corpus:
+        origins[origin] = origins.get(origin, 0) + 1
+    print(f"Checking {len(corpus)} files ({', '.join(f'{count} {origin}' for origin, count in origins.items())}) "
+          f"against {args.reference} ...")
+
+    results = []
+    mismatches = []
+    legacy_errors = []
+    for result in run_corpus(corpus, args.engines, args.reference, args.jobs):
+        if result['legacy_error']:
+            legacy_errors.append({'name': result['name'], 'origin': result['origin'], 'error': result['legacy_error']})
+        for engine_name, entry in result['engines'].items():
+            if entry['status'] == 'same':
+                continue
+            if args.diff_dir:
+                keep_diff(args.diff_dir, result, engine_name, entry)
+            if len(mismatches) < MAX_MISMATCHES:
+                mismatches.append({'name': result['name'], 'origin': result['origin'], 'engine': engine_name,
+                                   'status': entry['status'], 'difference': entry['difference']})
+            for key in ('input', 'legacy_state', 'engine_state'):
+                del entry[key]
+        results.append(result)
+
+    summary = summarize(results, args.engines, args.strict_newlines)
+    report = {'version': code_version(), 'created': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'platform': platform.platform(), 'reference': args.reference,
+              'corpus': origins, 'summary': summary, 'mismatches': mismatches,
+              'legacy_errors': legacy_errors[:MAX_MISMATCHES], 'legacy_error_count': len(legacy_errors)}
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print_summary(summary)
+    if legacy_errors:
+        print(f"{len(legacy_errors)} files made the legacy handler raise, e.g. {legacy_errors[0]['error']}; "
+              "the engines are held against what it left behind.")
+    for mismatch in mismatches[:10]:
+        difference = mismatch['difference']
+        where = f" at byte {difference['offset']} (line {difference['line']})" if 'offset' in difference else ''
+        print(f"{mismatch['engine']}: {mismatch['status']} in {mismatch['name']} ({mismatch['origin']}){where}")
+    print(f"Report written to {args.output}")
+    if not all(row['accepted'] for rows in summary.values() for row in rows.values()):
+        return 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
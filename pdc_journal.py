@@ -0,0 +1,332 @@
+"""Journal of every file the watcher processed.
+
+pdcDebug.py's log mixes a few events that matter with thousands of debug
+lines and starts over on every run. The journal instead keeps one record per
+file attempt in SQLite: when, the job, the source and where it ended up
+(.nc1 files are renamed), the rule stages it went through, the outcome,
+bytes in and out, the seconds spent in each pipeline stage, the version of
+pdc_rules that ran (see pdc_cache.rules_version) and the error if it failed.
+
+Records are only ever appended. The watcher collects them in memory and
+writes them in one transaction every FLUSH_SECONDS, so a busy folder does
+not pay for a commit per file. Once a day the records older than
+RETAIN_DAYS move to one file per month (journal-2024-05.sqlite) and the
+live file is compacted; queries read the month files too.
+
+Lookups by job, by file name and by time are indexed. --path matches the end
+of the path, so a job-relative path is enough, and finds a file by its name
+before or after the rename.
+
+    python pdc_journal.py query --path W8787-1-L/270-MA201-m0024.nc1
+    python pdc_journal.py query --job W8787 --since 2024-05-02T06:00 --failed
+    python pdc_journal.py query --since 2024-05-02 --json > may2.jsonl
+    python pdc_journal.py rotate --retain-days 14
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from pdc_cache import rules_version
+from pdc_metrics import REGISTRY
+
+JOURNAL_DIR = 'pdc_journal'
+JOURNAL_FILE = 'journal.sqlite'
+MONTH_FILE_PATTERN = 'journal-????-??.sqlite'
+FLUSH_SECONDS = 2.0
+MAX_BUFFERED = 100000  # Records kept for a journal that cannot be written before the oldest are dropped
+RETAIN_DAYS = 30  # Records older than this move to the month files
+ROTATE_SECONDS = 24 * 3600
+QUERY_LIMIT = 50
+
+# {schema} is 'main' for the live file and the name a month file is attached as while records move there
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS {schema}.entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, at REAL, job TEXT, path TEXT, name TEXT, target TEXT,
+    target_name TEXT, kind TEXT, stages TEXT, outcome TEXT, bytes_in INTEGER, bytes_out INTEGER,
+    seconds REAL, stage_seconds TEXT, rules_version TEXT, error TEXT);
+CREATE INDEX IF NOT EXISTS {schema}.entries_at ON entries (at);
+CREATE INDEX IF NOT EXISTS {schema}.entries_job ON entries (job, at);
+CREATE INDEX IF NOT EXISTS {schema}.entries_name ON entries (name, at);
+CREATE INDEX IF NOT EXISTS {schema}.entries_target_name ON entries (target_name, at);
+"""
+COLUMNS = ('at', 'job', 'path', 'name', 'target', 'target_name', 'kind', 'stages', 'outcome', 'bytes_in',
+           'bytes_out', 'seconds', 'stage_seconds', 'rules_version', 'error')
+OUTCOMES = ('processed', 'unchanged', 'gone', 'failed')
+
+journal_entries = REGISTRY.counter('pdc_journal_entries_total', 'Records written to the journal', ['outcome'])
+journal_dropped = REGISTRY.counter('pdc_journal_dropped_total', 'Records lost while the journal could not be written')
+
+
+def month_file(directory, moment):
+    return os.path.join(directory, f"journal-{datetime.fromtimestamp(moment):%Y-%m}.sqlite")
+
+
+def month_bounds(moment):
+    """(start, end) of the calendar month of moment, as time.time() values."""
+    day = datetime.fromtimestamp(moment)
+    start = day.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    return start.timestamp(), end.timestamp()
+
+
+def stages_text(task):
+    if task.outputs:
+        return '; '.join(f"{name}: {','.join(stages)}" for name, _, stages in task.outputs)
+    return ','.join(task.stages)
+
+
+def normalize(path):
+    return path.replace('\\', '/')
+
+
+class Journal:
+    def __init__(self, directory=JOURNAL_DIR, retain_days=RETAIN_DAYS):
+        self.directory = directory
+        self.retain_days = retain_days
+        self.rules_version = rules_version()
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(directory, JOURNAL_FILE), check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")  # Queries can read while the watcher writes
+        self.connection.executescript(SCHEMA.format(schema='main'))
+        self.lock = threading.Lock()  # The connection
+        self.buffer_lock = threading.Lock()
+        self.buffer = []
+        self.stopped = threading.Event()
+        self.thread = None
+        self.next_rotation = time.monotonic() + 60  # Not in the middle of the watcher starting up
+
+    def record(self, task, outcome, bytes_in=None, bytes_out=None, targets=(), error=None):
+        """Note one attempt at task; it is written on the next flush."""
+        target = '\n'.join(targets) if targets else None
+        stage_seconds = json.dumps({stage: round(seconds, 6) for stage, seconds in task.timings.items()},
+                                   separators=(',', ':'))
+        if error is not None:
+            stage, exception = error
+            error = f"{stage}: {type(exception).__name__}: {exception}"
+        row = (time.time(), task.job, task.path, os.path.basename(task.path), target,
+               os.path.basename(targets[0]) if targets else None, task.kind, stages_text(task), outcome,
+               bytes_in, bytes_out, round(time.monotonic() - task.event_time, 6), stage_seconds,
+               self.rules_version, error)
+        with self.buffer_lock:
+            self.buffer.append(row)
+
+    def flush(self):
+        with self.buffer_lock:
+            rows, self.buffer = self.buffer, []
+        if not rows:
+            return
+        try:
+            with self.lock:
+                self.connection.execute("BEGIN")
+                try:
+                    self.connection.executemany(
+                        f"INSERT INTO entries ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                        rows)
+                except BaseException:
+                    self.connection.execute("ROLLBACK")
+                    raise
+                self.connection.execute("COMMIT")
+        except sqlite3.Error as e:
+            logging.error(f"Cannot write {len(rows)} journal records: {e}")
+            with self.buffer_lock:
+                self.buffer[:0] = rows  # Tried again on the next flush
+                excess = len(self.buffer) - MAX_BUFFERED
+                if excess > 0:
+                    del self.buffer[:excess]
+                    journal_dropped.inc(excess)
+            return
+        for row in rows:
+            journal_entries.inc(outcome=row[COLUMNS.index('outcome')])
+
+    def rotate(self, retain_days=None):
+        """Move the records older than retain_days into their month files and compact; returns how many."""
+        before = time.time() - 86400 * (self.retain_days if retain_days is None else retain_days)
+        moved = 0
+        with self.lock:
+            while True:
+                oldest = self.connection.execute("SELECT MIN(at) FROM entries WHERE at < ?", (before,)).fetchone()[0]
+                if oldest is None:
+                    break
+                start, end = month_bounds(oldest)
+                end = min(end, before)
+                self.connection.execute("ATTACH DATABASE ? AS month", (month_file(self.directory, oldest),))
+                try:
+                    self.connection.executescript(SCHEMA.format(schema='month'))
+                    self.connection.execute("BEGIN")
+                    try:
+                        self.connection.execute(
+                            f"INSERT INTO month.entries ({', '.join(COLUMNS)}) SELECT {', '.join(COLUMNS)} "
+                            f"FROM main.entries WHERE at >= ? AND at < ? ORDER BY id", (start, end))
+                        moved += self.connection.execute("DELETE FROM main.entries WHERE at >= ? AND at < ?",
+                                                         (start, end)).rowcount
+                    except BaseException:
+                        self.connection.execute("ROLLBACK")
+                        raise
+                    self.connection.execute("COMMIT")
+                finally:
+                    self.connection.execute("DETACH DATABASE month")
+            if moved:
+                self.connection.execute("VACUUM")
+        if moved:
+            logging.info(f"Journal: {moved} records older than {datetime.fromtimestamp(before):%Y-%m-%d} "
+                         f"moved to the month files.")
+        return moved
+
+    def files(self, since=None, until=None):
+        """The journal files that can hold records from since to until: the month files, then the live one."""
+        paths = []
+        for path in sorted(glob.glob(os.path.join(self.directory, MONTH_FILE_PATTERN))):
+            start, end = month_bounds(datetime.strptime(os.path.basename(path)[8:15], '%Y-%m').timestamp())
+            if (since is None or since < end) and (until is None or until > start):
+                paths.append(path)
+        return paths + [os.path.join(self.directory, JOURNAL_FILE)]
+
+    def query(self, job=None, path=None, since=None, until=None, outcomes=None, limit=QUERY_LIMIT):
+        """The newest records that match, newest first, as dicts."""
+        conditions, parameters = [], []
+        if job is not None:
+            conditions.append("job = ?")
+            parameters.append(job)
+        if path is not None:
+            path = normalize(path)
+            name = path.rsplit('/', 1)[-1]
+            conditions.append("(name = ? OR target_name = ?)")
+            parameters += [name, name]
+        if since is not None:
+            conditions.append("at >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("at < ?")
+            parameters.append(until)
+        if outcomes:
+            conditions.append(f"outcome IN ({', '.join('?' * len(outcomes))})")
+            parameters += list(outcomes)
+        sql = f"SELECT {', '.join(COLUMNS)} FROM entries"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY at DESC"
+
+        self.flush()
+        records = []
+        for file_path in self.files(since, until):
+            if file_path == os.path.join(self.directory, JOURNAL_FILE):
+                with self.lock:
+                    rows = self.connection.execute(sql, parameters)
+                    records += self.matching(rows, path, limit)
+            else:
+                connection = sqlite3.connect(f"file:{file_path}?mode=ro", uri=True)
+                try:
+                    records += self.matching(connection.execute(sql, parameters), path, limit)
+                finally:
+                    connection.close()
+        records.sort(key=lambda record: record['at'], reverse=True)
+        return records[:limit] if limit else records
+
+    @staticmethod
+    def matching(rows, path, limit):
+        """The rows whose path or target ends with path (only the names were matched in SQL), up to limit."""
+        records = []
+        for row in rows:
+            record = dict(zip(COLUMNS, row))
+            if path is not None:
+                candidates = [record['path']] + (record['target'] or '').split('\n')
+                if not any(normalize(candidate) == path or normalize(candidate).endswith('/' + path.lstrip('/'))
+                           for candidate in candidates if candidate):
+                    continue
+            records.append(record)
+            if limit and len(records) >= limit:
+                break
+        return records
+
+    def run(self):
+        while not self.stopped.wait(FLUSH_SECONDS):
+            self.flush()
+            if time.monotonic() >= self.next_rotation:
+                self.next_rotation = time.monotonic() + ROTATE_SECONDS
+                try:
+                    self.rotate()
+                except sqlite3.Error as e:
+                    logging.error(f"Cannot rotate the journal: {e}")
+
+    def start(self):
+        """Flush every FLUSH_SECONDS and rotate once a day in a background thread."""
+        self.thread = threading.Thread(target=self.run, name='journal', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+        with self.lock:
+            self.connection.close()
+
+
+def format_record(record):
+    at = datetime.fromtimestamp(record['at'])
+    sizes = ' ' * 22
+    if record['bytes_in'] is not None:
+        sizes = f"{record['bytes_in']:>9} -> {record['bytes_out'] or 0:<9}"
+    line = f"{at:%Y-%m-%d %H:%M:%S}  {record['outcome']:9} {record['seconds']:8.2f}s  {sizes} {record['path']}"
+    if record['target'] and record['target'] != record['path']:
+        line += '\n' + '\n'.join(f"{'':>54}-> {target}" for target in record['target'].split('\n'))
+    details = [f"stages {record['stages'] or '-'}", f"rules {record['rules_version']}"]
+    timings = json.loads(record['stage_seconds'] or '{}')
+    if timings:
+        details.append(' '.join(f"{stage} {seconds * 1000:.1f}ms" for stage, seconds in timings.items()))
+    line += f"\n{'':21}{'  '.join(details)}"
+    if record['error']:
+        line += f"\n{'':21}{record['error']}"
+    return line
+
+
+def parse_time(text):
+    return datetime.fromisoformat(text).timestamp()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--journal', default=JOURNAL_DIR, help='journal directory')
+    commands = parser.add_subparsers(dest='command', required=True)
+    query_parser = commands.add_parser('query', help='show the records of files, jobs or a time window')
+    query_parser.add_argument('--job', help='job folder name, e.g. W8787')
+    query_parser.add_argument('--path', help='file path, or its end (job-relative path or just the name)')
+    query_parser.add_argument('--since', type=parse_time, help='records at or after this time')
+    query_parser.add_argument('--until', type=parse_time, help='records before this time')
+    query_parser.add_argument('--outcome', nargs='+', choices=OUTCOMES, help='only these outcomes')
+    query_parser.add_argument('--failed', action='store_true', help='only failed attempts')
+    query_parser.add_argument('--limit', type=int, default=QUERY_LIMIT, help='newest records shown; 0 for all')
+    query_parser.add_argument('--json', action='store_true', help='one JSON object per line')
+    rotate_parser = commands.add_parser('rotate', help='move old records to the month files and compact')
+    rotate_parser.add_argument('--retain-days', type=float, default=RETAIN_DAYS)
+    args = parser.parse_args(argv)
+
+    journal = Journal(args.journal)
+    try:
+        if args.command == 'rotate':
+            print(f"{journal.rotate(args.retain_days)} records moved to the month files.")
+            return
+        outcomes = ['failed'] if args.failed else args.outcome
+        records = journal.query(args.job, args.path, args.since, args.until, outcomes, args.limit)
+        for record in reversed(records):
+            if args.json:
+                record['at'] = datetime.fromtimestamp(record['at']).isoformat(timespec='milliseconds')
+                record['stage_seconds'] = json.loads(record['stage_seconds'] or '{}')
+                print(json.dumps(record))
+            else:
+                print(format_record(record))
+        if not args.json:
+            print(f"{len(records)} records.")
+    finally:
+        journal.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""Counters, gauges and latency histograms for the watcher.
+
+Metrics live in a process-wide Registry. They can be scraped in Prometheus
+text format from a small HTTP server on localhost and are also written to a
+JSON snapshot file at a fixed interval, together with per-second rates since
+the previous snapshot.
+"""
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9464
+SNAPSHOT_SECONDS = 30
+
+# Seconds; suits anything from a 1 ms local read to a slow OneDrive sync
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def label_key(labelnames, labels):
+    return tuple(str(labels.get(name, '')) for name in labelnames)
+
+
+def format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=(), lock=None):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = lock or threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = label_key(self.labelnames, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(label_key(self.labelnames, labels), 0)
+
+    def total(self):
+        return sum(self.values.values())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+    def snapshot(self):
+        return {','.join(key) or 'total': value for key, value in sorted(self.values.items())}
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = label_key(self.labelnames, labels)
+        with self.lock:
+            self.values[key] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS, lock=None):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}  # label key -> [bucket counts..., +Inf count], sum
+        self.lock = lock or threading.Lock()
+
+    def observe(self, value, **labels):
+        key = label_key(self.labelnames, labels)
+        with self.lock:
+            counts, total = self.series.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.series[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantile(self, q, **labels):
+        """Estimate a quantile from the bucket counts, interpolating inside the bucket."""
+        series = self.series.get(label_key(self.labelnames, labels))
+        if series is None:
+            return None
+        return self.bucket_quantile(series[0], q)
+
+    def bucket_quantile(self, counts, q):
+        count = sum(counts)
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i > 0 else 0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, [('le', str(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+    def snapshot(self):
+        result = {}
+        for key, (counts, total) in sorted(self.series.items()):
+            count = sum(counts)
+            result[','.join(key) or 'total'] = {
+                'count': count, 'mean': total / count if count else None,
+                'p50': self.bucket_quantile(counts, 0.5), 'p90': self.bucket_quantile(counts, 0.9),
+                'p99': self.bucket_quantile(counts, 0.99)}
+        return result
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _add(self, cls, name, help_text, labelnames, **kwargs):
+        if name not in self.metrics:
+            self.metrics[name] = cls(name, help_text, labelnames, lock=self.lock, **kwargs)
+        return self.metrics[name]
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._add(Counter, name, help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._add(Gauge, name, help_text, labelnames)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def render_prometheus(self):
+        with self.lock:
+            lines = [line for metric in self.metrics.values() for line in metric.render()]
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        with self.lock:
+            return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+
+REGISTRY = Registry()
+
+
+def metrics_request_handler(registry):
+    # http.server is only imported when the endpoint is switched on; it is slow to import
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = registry.render_prometheus().encode('utf-8')
+                content_type = 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body = json.dumps(registry.snapshot(), indent=2).encode('utf-8')
+                content_type = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsRequestHandler
+
+
+def start_metrics_server(registry=REGISTRY, host=METRICS_HOST, port=METRICS_PORT):
+    """Serve /metrics (Prometheus text) and /metrics.json from a background thread."""
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer((host, port), metrics_request_handler(registry))
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+
+class SnapshotWriter(threading.Thread):
+    """Writes the registry to a JSON file every few seconds.
+
+    Counters named in rate_counters also get a per-second rate over the last
+    interval (files/sec, bytes/sec).
+    """
+
+    def __init__(self, path, registry=REGISTRY, interval=SNAPSHOT_SECONDS, rate_counters=()):
+        super().__init__(name='metrics-snapshot', daemon=True)
+        self.path = path
+        self.registry = registry
+        self.interval = interval
+        self.rate_counters = rate_counters
+        self.stopped = threading.Event()
+        self.previous = {}
+        self.previous_time = time.monotonic()
+
+    def write_snapshot(self):
+        now = time.monotonic()
+        elapsed = max(now - self.previous_time, 1e-9)
+        rates = {}
+        for name in self.rate_counters:
+            metric = self.registry.metrics.get(name)
+            if metric is not None:
+                total = metric.total()
+                rates[name + '_per_second'] = (total - self.previous.get(name, 0)) / elapsed
+                self.previous[name] = total
+        self.previous_time = now
+        document = {'time': datetime.now().isoformat(timespec='seconds'), 'rates': rates,
+                    'metrics': self.registry.snapshot()}
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(document, file, indent=2)
+        os.replace(temp_path, self.path)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write_snapshot()
+            except OSError:
+                pass
+
+    def stop(self):
+        self.stopped.set()
+        self.write_snapshot()
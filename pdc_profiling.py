@@ -0,0 +1,141 @@
+"""Per-file profiling for the watcher engine.
+
+Two modes, both off unless switched on from the command line:
+
+* CProfileRecorder profiles the first N files with cProfile and saves one
+  .prof file per file plus merged.prof (pstats format, readable by snakeviz
+  or flameprof).
+* SlowFileSampler samples the worker's stack every few milliseconds and keeps
+  the samples only for files that took longer than a threshold. Samples are
+  saved in folded-stack format (one "frame;frame;frame count" line per
+  stack), per file and merged, ready for flamegraph.pl or speedscope.
+
+When neither is enabled the engine calls the pipeline directly.
+"""
+import cProfile
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+SAMPLE_SECONDS = 0.005
+
+
+def safe_name(index, path):
+    return f"{index:05d}-" + re.sub(r'[^\w.-]', '_', os.path.basename(path))
+
+
+class CProfileRecorder:
+    """Profile the first max_files files with cProfile."""
+
+    def __init__(self, output_dir, max_files):
+        self.output_dir = output_dir
+        self.max_files = max_files
+        self.count = 0  # Files handed a profiler so far
+        self.finished = 0  # Of those, files whose profile is written
+        self.merged = None
+        self.count_lock = threading.Lock()
+        # cProfile can only be active in one thread at a time (Python 3.12+), so profiled files run one by one;
+        # the files after the first max_files never take this lock
+        self.lock = threading.Lock()
+        os.makedirs(output_dir, exist_ok=True)
+
+    def run(self, path, function, *args):
+        with self.count_lock:
+            if self.count >= self.max_files:
+                index = None
+            else:
+                self.count += 1
+                index = self.count
+        if index is None:
+            return function(*args)
+        with self.lock:
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(function, *args)
+            finally:
+                profile_path = os.path.join(self.output_dir, safe_name(index, path) + '.prof')
+                profiler.dump_stats(profile_path)
+                if self.merged is None:
+                    self.merged = pstats.Stats(profile_path)
+                else:
+                    self.merged.add(profile_path)
+                self.finished += 1
+                if self.finished == self.max_files:
+                    self.write_merged()
+
+    def write_merged(self):
+        if self.merged is not None:
+            self.merged.dump_stats(os.path.join(self.output_dir, 'merged.prof'))
+
+    def close(self):
+        with self.lock:
+            self.write_merged()
+
+
+class SlowFileSampler:
+    """Sample worker stacks and keep the samples of files slower than threshold seconds."""
+
+    def __init__(self, output_dir, threshold, interval=SAMPLE_SECONDS):
+        self.output_dir = output_dir
+        self.threshold = threshold
+        self.interval = interval
+        self.active = {}  # thread id -> Counter of folded stacks for the file it is processing
+        self.merged = Counter()
+        self.count = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        os.makedirs(output_dir, exist_ok=True)
+        threading.Thread(target=self.sample_loop, name='profile-sampler', daemon=True).start()
+
+    def sample_loop(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                if not self.active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, samples in self.active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[self.fold(frame)] += 1
+
+    @staticmethod
+    def fold(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+    def run(self, path, function, *args):
+        thread_id = threading.get_ident()
+        samples = Counter()
+        with self.lock:
+            self.active[thread_id] = samples
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                del self.active[thread_id]
+                if elapsed >= self.threshold and samples:
+                    self.count += 1
+                    self.write_folded(os.path.join(self.output_dir, safe_name(self.count, path) + '.folded'), samples)
+                    self.merged.update(samples)
+
+    @staticmethod
+    def write_folded(output_path, samples):
+        with open(output_path, 'w') as file:
+            for stack, count in samples.most_common():
+                file.write(f"{stack} {count}\n")
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            if self.merged:
+                self.write_folded(os.path.join(self.output_dir, 'merged.folded'), self.merged)
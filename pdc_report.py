@@ -1,9 +1,15 @@
-import openpyxl
+import argparse
 import os
 from xml.etree import ElementTree as ET
-from datetime import datetime, time, timedelta
+from datetime import datetime
+from shift_calendar import BREAK, SHIFT_SETTINGS_FILE, load_shift_calendar
+from report_sinks import REPORT_FORMATS, REPORT_HEADERS, PartRow, ReportSink, open_sinks
+from report_cache import REPORT_CACHE_DIR, PartRecord, part_records
 
-WORKING_TIME = 24
+MACHINE = 'Beamline'
+
+DASHBOARD_HEADERS = ["Production Efficiency", "Utilization", "Idle Ratio", "Parts/Hour", "Parts",
+                     "Production Time (hours)", "Total Run Time (hours)", "Idle Time (hours)"]
 
 def time_to_seconds(timestr):
     """Convert time string formatted as H:M:S to seconds."""
@@ -14,15 +20,6 @@ def seconds_to_decimal_hours(seconds):
     """Convert seconds to a decimal representing the number of hours."""
     return seconds / 3600
 
-def time_difference(time1, time2):
-    """Calculate the difference between two time strings formatted as H:M:S and return the result in seconds."""
-    seconds1 = time_to_seconds(time1)
-    seconds2 = time_to_seconds(time2)
-    difference = seconds2 - seconds1
-    if difference < 0:
-        difference += 24 * 60 * 60  # Adjust for time that goes over midnight
-    return difference
-
 def adjust_column_width(worksheet):
     for col in worksheet.columns:
         max_length = 0
@@ -36,181 +33,256 @@ def adjust_column_width(worksheet):
         adjusted_width = (max_length + 2)  # Adjust the width
         worksheet.column_dimensions[column].width = adjusted_width
 
-def get_shift_time():
-    """Prompt the user to input the start and end times for day and night shifts."""
-    day_shift_start = '07:00:00'
-    day_shift_end = '19:00:00'
-    night_shift_start = '19:01:00'
-    night_shift_end = '06:59:00'
-    
-    return day_shift_start, day_shift_end, night_shift_start, night_shift_end
-
-def determine_shift(start_time, day_shift_start, day_shift_end, night_shift_start, night_shift_end):
-    """Determine if a time falls within the day or night shift."""
-    start_seconds = time_to_seconds(start_time)
-    day_start_seconds = time_to_seconds(day_shift_start)
-    day_end_seconds = time_to_seconds(day_shift_end)
-    night_start_seconds = time_to_seconds(night_shift_start)
-    night_end_seconds = time_to_seconds(night_shift_end)
-
-    # Assuming that shifts do not overlap. The logic here may need to be adjusted based on how shifts are scheduled.
-    if day_start_seconds <= start_seconds < day_end_seconds:
-        return 'Day'
-    elif night_start_seconds <= start_seconds or start_seconds < night_end_seconds:  # Covering overnight shift
-        return 'Night'
-    else:
-        return 'Undefined'  # For times that do not fall into either shift
-
-# Get the XML file path from the user
-xml_file_path = input("Enter the path to the XML file: ").strip('"')
-
-# Parse the XML from file
-tree = ET.parse(xml_file_path)
-root = tree.getroot()
-
-# Create a new Excel workbook and a master sheet
-wb = openpyxl.Workbook()
-
-# Step 1: Create the Dashboard sheet as the first sheet
-dashboard = wb.create_sheet(title="Dashboard", index=0)  # index=0 makes it the first sheet
-
-# Step 2: Write the headers to the Dashboard
-dashboard.append(["Date", "Production Efficiency"])  # Add your headers here
-
-# Dictionary to keep track of unique dates (to avoid duplicate entries in the Dashboard)
-unique_dates = {}
-
-master_sheet = wb.create_sheet(title="Master Sheet")
-master_sheet.append(["Part Name", "Date", "Start Time", "Finish Time", "Total Run Time (hours)", "Idle Time (hours)", 
-                     "Production Time (hours)", "PT-TRT (hours)", "Shift"])  # The header for the master sheet
-
-# Dictionary to store daily idle times
-daily_idle_times = {}
-
-# Initial totals
-day_total_production_time_in_seconds = 0
-day_total_pt_seconds = 0
-day_total_pt_trt_seconds = 0
-previous_finish_time_in_seconds = None
-previous_date = None
-
-# Get shift times from the user
-day_shift_start, day_shift_end, night_shift_start, night_shift_end = get_shift_time()
-
-for part_report in root.findall('.//PartReports/PartReport'):
-    part_name = part_report.find('PartName').text
+def update_metrics(metrics, key, run_seconds, idle_seconds, pt_seconds, parts=1):
+    """Add one part's times to the running totals stored under key."""
+    totals = metrics.setdefault(key, {'parts': 0, 'run': 0, 'idle': 0, 'pt': 0})
+    totals['parts'] += parts
+    totals['run'] += run_seconds
+    totals['idle'] += idle_seconds
+    totals['pt'] += pt_seconds
+
+def metrics_row(totals, working_hours):
+    """Turn running totals into the efficiency figures shown on the Dashboard."""
+    run_hours = seconds_to_decimal_hours(totals['run'])
+    idle_hours = seconds_to_decimal_hours(totals['idle'])
+    pt_hours = seconds_to_decimal_hours(totals['pt'])
+    efficiency = pt_hours / working_hours if working_hours else 0
+    utilization = run_hours / working_hours if working_hours else 0
+    idle_ratio = idle_hours / (idle_hours + run_hours) if idle_hours + run_hours else 0
+    parts_per_hour = totals['parts'] / run_hours if run_hours else 0
+    return [efficiency, utilization, idle_ratio, parts_per_hour, totals['parts'], pt_hours, run_hours, idle_hours]
+
+def add_dashboard_chart(dashboard, chart, title, min_col, max_col, first_row, last_row, anchor):
+    """Plot the given Dashboard columns against the label column of the same rows."""
+    from openpyxl.chart import Reference
+    chart.title = title
+    data = Reference(dashboard, min_col=min_col, max_col=max_col, min_row=first_row - 1, max_row=last_row)
+    labels = Reference(dashboard, min_col=1, min_row=first_row, max_row=last_row)
+    chart.add_data(data, titles_from_data=True)
+    chart.set_categories(labels)
+    chart.width = 24
+    dashboard.add_chart(chart, anchor)
+
+def write_dashboard(dashboard, daily_metrics, shift_metrics, calendar):
+    """Fill the Dashboard with per-day and per-shift efficiency figures and charts.
+
+    A day is measured against the net working hours of its shifts in the calendar,
+    as each shift is measured against its own.
+    """
+    from openpyxl.chart import BarChart, LineChart
+    dashboard.append(["Date"] + DASHBOARD_HEADERS)
+    for date, totals in daily_metrics.items():
+        dashboard.append([date] + metrics_row(totals, calendar.working_hours(date)))
+    first_day_row, last_day_row = 2, dashboard.max_row
+
+    dashboard.append([])
+    dashboard.append(["Date / Shift"] + DASHBOARD_HEADERS)
+    first_shift_row = dashboard.max_row + 1
+    for (date, shift), totals in shift_metrics.items():
+        dashboard.append([f"{date} {shift}"] + metrics_row(totals, calendar.shift_hours.get(shift, 0)))
+    last_shift_row = dashboard.max_row
+
+    for row in dashboard.iter_rows(min_row=2, min_col=2, max_col=4):
+        for cell in row:
+            cell.number_format = '0.0%'
+    adjust_column_width(dashboard)
+
+    if last_day_row >= first_day_row:
+        add_dashboard_chart(dashboard, BarChart(), "Daily Production Efficiency", 2, 2,
+                            first_day_row, last_day_row, "K2")
+        add_dashboard_chart(dashboard, LineChart(), "Daily Utilization and Idle Ratio", 3, 4,
+                            first_day_row, last_day_row, "K18")
+    if last_shift_row >= first_shift_row:
+        add_dashboard_chart(dashboard, BarChart(), "Production Efficiency by Shift", 2, 2,
+                            first_shift_row, last_shift_row, "K34")
+
+class ExcelSink(ReportSink):
+    """The original workbook: Dashboard, Master Sheet and one sheet per day with its totals."""
+
+    def __init__(self, output_path):
+        # openpyxl is only imported when a workbook is written; the CSV, SQLite and live paths do without it
+        import openpyxl
+        self.output_path = output_path
+        self.wb = openpyxl.Workbook()
+        # Create the Dashboard sheet as the first sheet
+        self.dashboard = self.wb.create_sheet(title="Dashboard", index=0)
+        self.master_sheet = self.wb.create_sheet(title="Master Sheet")
+        self.master_sheet.append(REPORT_HEADERS)
+        self.ws = None
+        self.previous_date = None
+        self.day_totals = [0, 0, 0, 0]
+        self.production_time_totals = {}  # date -> production time total, divided by the day's hours in close()
+        self.calendar = None  # Set by write_summary
+
+    def write_day_totals(self):
+        """Append the totals row to the current day's sheet; the working time row follows in close()."""
+        self.ws.append(["Totals", "", "", ""] + self.day_totals)
+        adjust_column_width(self.ws)  # Auto-adjust columns' width
+        self.production_time_totals[self.previous_date] = self.day_totals[2]
+
+    def write_working_time(self, date, production_time):
+        """Divide a day's production time total by its working hours, as the Dashboard's efficiency does."""
+        working_hours = self.calendar.working_hours(date)
+        production_time_divided = production_time / working_hours if working_hours else 0
+        self.wb[date].append([f"Production Time / {working_hours:g}", "", "", "", "", "", production_time_divided,
+                              "", ""])
+
+    def write_row(self, row):
+        # Check if date changed and create a new sheet if needed
+        if row.date != self.previous_date:
+            if self.previous_date is not None:
+                self.write_day_totals()
+            self.day_totals = [0, 0, 0, 0]
+            self.ws = self.wb.create_sheet(title=row.date)
+            self.ws.append(REPORT_HEADERS)
+            self.previous_date = row.date
+        self.day_totals = [total + value for total, value in zip(self.day_totals, row[4:8])]
+        # Append the data to the master sheet as well as the current day's sheet
+        self.master_sheet.append(list(row))
+        self.ws.append(list(row))
+
+    def write_summary(self, daily_metrics, shift_metrics, calendar):
+        self.calendar = calendar
+        write_dashboard(self.dashboard, daily_metrics, shift_metrics, calendar)
+
+    def close(self):
+        adjust_column_width(self.master_sheet)
+        if self.ws is not None:
+            self.write_day_totals()
+        if self.calendar is not None:
+            for date, production_time in self.production_time_totals.items():
+                self.write_working_time(date, production_time)
+        # Remove the default sheet
+        if "Sheet" in self.wb.sheetnames:
+            del self.wb["Sheet"]
+        self.wb.save(self.output_path)
+
+def iter_part_reports(xml_file_path):
+    """Yield PartReport elements one at a time, freeing each once it has been read."""
+    for _, element in ET.iterparse(xml_file_path):
+        if element.tag == 'PartReport':
+            yield element
+            element.clear()
+
+def parse_part_report(part_report):
+    """The fields the report uses from one PartReport element."""
     creation_datetime = part_report.find('TimeWhenPartWasCreated').text
-    current_date = creation_datetime[:10]  # Here we extract the date from the datetime string
-
-    time_object = datetime.strptime(creation_datetime, '%Y-%m-%dT%H:%M:%S')
-
-    if current_date not in unique_dates:
-        dashboard.append([current_date])  # This adds a new row with the date
-        unique_dates[current_date] = True  # Mark this date as added
-
-     
-    if time_object.time() <= time(5, 0):  # Here we create a time object representing 5 AM
-        # Adjust the date
-        time_object -= timedelta(days=1)  # Here we subtract one day 
-        
-    current_date = time_object.strftime('%Y-%m-%d')  # Here we convert the time object back to a string    
-
-
-
-
-    # Check if date changed and create a new sheet if needed
-    if current_date != previous_date and previous_date is not None:
-        # Append totals to the previous worksheet
-        ws.append(["Totals", "", "", "",
-                   seconds_to_decimal_hours(day_total_production_time_in_seconds),
-                   seconds_to_decimal_hours(daily_idle_times.get(previous_date, 0)),
-                   seconds_to_decimal_hours(day_total_pt_seconds),
-                   seconds_to_decimal_hours(day_total_pt_trt_seconds)])
-
-        adjust_column_width(ws)  # Auto-adjust columns' width
-
-        #New Code that divides the production time total by 18hrs
-        production_time_divided = seconds_to_decimal_hours(day_total_pt_seconds) / WORKING_TIME
-
-        # Append this calculated value in a new row below the totals.
-        ws.append(["Production Time / 18", "", "", "", "", "", production_time_divided, "", ""])
-
-
-
-        # Reset totals for the new day
-        day_total_production_time_in_seconds = 0
-        day_total_pt_seconds = 0
-        day_total_pt_trt_seconds = 0
-        previous_finish_time_in_seconds = None
-
-    if current_date != previous_date:
-        ws = wb.create_sheet(title=current_date)
-        # Adjusting the headers to include 'Shift' and indicate hours
-        ws.append(["Part Name", "Date", "Start Time", "Finish Time", "Total Run Time (hours)", "Idle Time (hours)", 
-                   "Production Time (hours)", "PT-TRT (hours)", "Shift"])
-
-    start_time = creation_datetime[-8:]
     finish_datetime = part_report.find('TimeWhenPartWasFinished').text
-    finish_time = finish_datetime[-8:]
-
-    total_production_time_in_seconds = time_difference(start_time, finish_time)
-    day_total_production_time_in_seconds += total_production_time_in_seconds
-
-    production_time_seconds = time_to_seconds(part_report.find('TimeItTookToCreateThePart').text)
-    day_total_pt_seconds += production_time_seconds
-
-    pt_trt_in_seconds = total_production_time_in_seconds - production_time_seconds
-    day_total_pt_trt_seconds += pt_trt_in_seconds  # This line was missing in the original script, causing an incorrect total PT-TRT.
-
-   
-    if previous_finish_time_in_seconds is not None:
-        idle_time_in_seconds = time_to_seconds(start_time) - previous_finish_time_in_seconds
-        if idle_time_in_seconds < 0:
-            idle_time_in_seconds += 24 * 60 * 60  # Adjust for idle time that goes over midnight
-    else:
-        idle_time_in_seconds = 0
-
-    daily_idle_times[current_date] = daily_idle_times.get(current_date, 0) + idle_time_in_seconds
-
-    # Determine the shift for the current data row
-    shift = determine_shift(start_time, day_shift_start, day_shift_end, night_shift_start, night_shift_end)
-
-    # Prepare the row entry with time values converted to decimal hours.
-    row_entry = [part_name, current_date, start_time, finish_time, 
-                 seconds_to_decimal_hours(total_production_time_in_seconds),
-                 seconds_to_decimal_hours(idle_time_in_seconds), 
-                 seconds_to_decimal_hours(production_time_seconds), 
-                 seconds_to_decimal_hours(pt_trt_in_seconds), shift]
-
-    # Append the data to the master sheet as well as the current day's sheet
-    master_sheet.append(row_entry)
-    ws.append(row_entry)
-
-    previous_date = current_date
-    previous_finish_time_in_seconds = time_to_seconds(finish_time)
-
-# Adjust the column width of the master sheet and other sheets
-adjust_column_width(master_sheet)
-
-# Append totals to the last worksheet
-ws.append(["Totals", "", "", "",
-           seconds_to_decimal_hours(day_total_production_time_in_seconds),
-           seconds_to_decimal_hours(daily_idle_times.get(previous_date, 0)),
-           seconds_to_decimal_hours(day_total_pt_seconds),
-           seconds_to_decimal_hours(day_total_pt_trt_seconds)])
-
-#New code 
-production_time_divided = seconds_to_decimal_hours(day_total_pt_seconds) / WORKING_TIME
-
-# Append this calculated value in a new row below the totals for the last date.
-ws.append(["Production Time / 18", "", "", "", "", "", production_time_divided, "", ""])
-
-# Remove the default sheet
-if "Sheet" in wb.sheetnames:
-    del wb["Sheet"]
-
-# Save the workbook
-output_excel_path = os.path.join(os.path.dirname(xml_file_path), "Production_Report_Beamline.xlsx")
-wb.save(output_excel_path)
-
-print(f"Excel file created successfully at {output_excel_path}!")
\ No newline at end of file
+    return PartRecord(part_report.find('PartName').text,
+                      creation_datetime, datetime.fromisoformat(creation_datetime),
+                      finish_datetime, datetime.fromisoformat(finish_datetime),
+                      time_to_seconds(part_report.find('TimeItTookToCreateThePart').text))
+
+def iter_part_records(xml_file_path, cache_dir=None):
+    """Yield a PartRecord per PartReport, from the column cache in cache_dir when there is one (see report_cache)."""
+    parse = lambda: (parse_part_report(part_report) for part_report in iter_part_reports(xml_file_path))
+    if cache_dir is None:
+        return parse()
+    return part_records(xml_file_path, parse, cache_dir)
+
+class PartRowBuilder:
+    """Turns PartReport elements into PartRows while keeping the per-day and per-shift totals.
+
+    Shared by the batch report and the live report, which feeds it parts as the
+    machine appends them.
+    """
+
+    def __init__(self, calendar):
+        self.calendar = calendar
+        # Per-day and per-shift totals, collected while the parts stream through
+        self.daily_metrics = {}
+        self.shift_metrics = {}
+        self.previous_finish_object = None
+        self.previous_date = None
+
+    def add(self, part_report):
+        """Build the row for one PartReport element and add its times to the totals."""
+        return self.add_record(parse_part_report(part_report))
+
+    def add_record(self, record):
+        """Build the row for one PartRecord and add its times to the totals."""
+        calendar = self.calendar
+        part_name, creation_datetime, start_object, finish_datetime, finish_object, production_time_seconds = record
+
+        # Parts started before the day rollover (5 AM by default) count towards the previous day
+        current_date = calendar.production_date(start_object)
+        if current_date != self.previous_date:
+            self.previous_finish_object = None  # Idle time starts again each day
+
+        # Full timestamps are split over the calendar, so parts that run over midnight need no
+        # adjustment; time on breaks counts neither as run time nor as idle time
+        run_by_shift = calendar.split(start_object, finish_object)
+        run_by_shift.pop(BREAK, None)
+        total_production_time_in_seconds = sum(run_by_shift.values())
+        pt_trt_in_seconds = total_production_time_in_seconds - production_time_seconds
+
+        if self.previous_finish_object is not None:
+            idle_time_in_seconds = calendar.working_seconds(self.previous_finish_object, start_object)
+        else:
+            idle_time_in_seconds = 0
+
+        # Determine the shift for the current data row
+        shift = calendar.classify(start_object)
+
+        update_metrics(self.daily_metrics, current_date, total_production_time_in_seconds,
+                       idle_time_in_seconds, production_time_seconds)
+        # The part is counted in the shift it started in; run time that carries over into
+        # the next shift is credited to that shift
+        update_metrics(self.shift_metrics, (current_date, shift), run_by_shift.pop(shift, 0),
+                       idle_time_in_seconds, production_time_seconds)
+        for other_shift, run_seconds in run_by_shift.items():
+            update_metrics(self.shift_metrics, (current_date, other_shift), run_seconds, 0, 0, parts=0)
+
+        self.previous_date = current_date
+        self.previous_finish_object = finish_object
+
+        # Time values are reported in decimal hours
+        return PartRow(part_name, current_date, creation_datetime[-8:], finish_datetime[-8:],
+                       seconds_to_decimal_hours(total_production_time_in_seconds),
+                       seconds_to_decimal_hours(idle_time_in_seconds),
+                       seconds_to_decimal_hours(production_time_seconds),
+                       seconds_to_decimal_hours(pt_trt_in_seconds), shift)
+
+def build_report(xml_file_path, sinks, calendar, cache_dir=None):
+    """Read the production XML once, feeding every row to each sink and the Dashboard totals."""
+    builder = PartRowBuilder(calendar)
+    for record in iter_part_records(xml_file_path, cache_dir):
+        row = builder.add_record(record)
+        for sink in sinks:
+            sink.write_row(row)
+
+    for sink in sinks:
+        sink.write_summary(builder.daily_metrics, builder.shift_metrics, calendar)
+        sink.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the production report from the machine XML.')
+    parser.add_argument('xml', nargs='?', help='production XML; asked for when left out')
+    parser.add_argument('--formats', nargs='+', choices=REPORT_FORMATS, help='output formats (default xlsx)')
+    parser.add_argument('--pattern', help="shift pattern of the machine (default: its first in shift_settings.json)")
+    parser.add_argument('--cache-dir', default=REPORT_CACHE_DIR,
+                        help='where parsed XMLs are kept for the next report (see report_cache.py)')
+    parser.add_argument('--no-cache', action='store_true', help='always parse the XML')
+    args = parser.parse_args(argv)
+
+    # Get the XML file path from the user
+    xml_file_path = (args.xml or input("Enter the path to the XML file: ")).strip('"')
+    formats = args.formats
+    if formats is None and args.xml is None:
+        formats = input(f"Output formats ({', '.join(REPORT_FORMATS)}) [xlsx]: ").replace(',', ' ').split()
+    formats = formats or ['xlsx']
+
+    # Shift boundaries and the day rollover are worked out once for the whole report
+    try:
+        calendar = load_shift_calendar(SHIFT_SETTINGS_FILE, MACHINE, args.pattern)
+    except ValueError as e:
+        parser.error(str(e))
+    output_base = os.path.join(os.path.dirname(xml_file_path), "Production_Report_Beamline")
+    sinks = open_sinks(formats, output_base, excel_sink=ExcelSink)
+    build_report(xml_file_path, sinks, calendar, None if args.no_cache else args.cache_dir)
+
+    for sink in sinks:
+        print(f"Report file created successfully at {sink.output_path}!")
+
+if __name__ == "__main__":
+    main()
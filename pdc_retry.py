@@ -0,0 +1,205 @@
+"""Retry queue and dead-letter store for files the watcher failed to process.
+
+A file that fails (locked by the CAD export or the sync client, a share that
+dropped out) is retried with exponential backoff: 2, 4, 8 ... seconds, up to
+RETRY_MAX_SECONDS between attempts. After MAX_ATTEMPTS failures it becomes a
+dead letter recording the path, the stage that failed, the exception and the
+number of attempts. Both live in a SQLite file next to the watcher, so
+pending retries survive a restart.
+
+Dead letters can be listed and replayed in bulk. Replaying moves them back
+into the retry queue, where the running watcher picks them up on its next
+poll and processes them on its own workers; with --run they are processed
+right away by this command instead. It builds the same engine as the
+watcher, from the same settings and options (folder profiles and outputs,
+--stage-dir, --cache-dir, --archive-dir, the journal), so a replayed file
+comes out as if the watcher had processed it.
+
+    python pdc_retry.py list
+    python pdc_retry.py replay --all
+    python pdc_retry.py replay 12 13 --run
+    python pdc_retry.py replay --all --run --archive-dir D:/pdc_archive
+"""
+import argparse
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+RETRY_DB_FILE = 'pdc_retry.sqlite'
+MAX_ATTEMPTS = 6
+RETRY_BASE_SECONDS = 2
+RETRY_MAX_SECONDS = 300
+RETRY_POLL_SECONDS = 5  # How often the watcher looks for retries that are due
+CLAIM_SECONDS = 600  # A claimed retry is handed out again if its attempt never reports back
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS retries (
+    path TEXT PRIMARY KEY, root TEXT, stage TEXT, error TEXT, attempts INTEGER,
+    next_attempt REAL, first_failed TEXT, last_failed TEXT);
+CREATE INDEX IF NOT EXISTS retries_next_attempt ON retries (next_attempt);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT, root TEXT, stage TEXT, error_type TEXT, error TEXT,
+    attempts INTEGER, first_failed TEXT, failed_at TEXT);
+"""
+
+
+def backoff_seconds(attempts):
+    """Seconds to wait after the given number of failed attempts, with a little jitter."""
+    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+    return delay * random.uniform(0.9, 1.1)
+
+
+class RetryStore:
+    def __init__(self, path=RETRY_DB_FILE, max_attempts=MAX_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        # Paths with a row in retries, so a successful file costs no query unless it was retried
+        self.retrying = {row[0] for row in self.connection.execute("SELECT path FROM retries")}
+
+    @contextmanager
+    def transaction(self):
+        """Run the statements of the block as one transaction; called with self.lock held."""
+        self.connection.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def failed(self, task, stage, error):
+        """Schedule another attempt for task, or move it to the dead letters. Returns True if it will be retried."""
+        now = datetime.now().isoformat(timespec='seconds')
+        message = f"{type(error).__name__}: {error}"
+        with self.lock:
+            row = self.connection.execute("SELECT attempts, first_failed FROM retries WHERE path = ?",
+                                          (task.path,)).fetchone()
+            attempts, first_failed = (row[0] + 1, row[1]) if row else (1, now)
+            if attempts >= self.max_attempts:
+                # In one transaction, so a crash cannot lose the file or leave it in both tables
+                with self.transaction():
+                    self.connection.execute("DELETE FROM retries WHERE path = ?", (task.path,))
+                    self.connection.execute(
+                        "INSERT INTO dead_letters (path, root, stage, error_type, error, attempts, first_failed, "
+                        "failed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (task.path, task.root, stage, type(error).__name__, str(error), attempts, first_failed, now))
+                self.retrying.discard(task.path)
+                logging.error(f"{task.path} failed {attempts} times and was moved to the dead letters ({message}).")
+                return False
+            self.connection.execute(
+                "INSERT OR REPLACE INTO retries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (task.path, task.root, stage, message, attempts, time.time() + backoff_seconds(attempts),
+                 first_failed, now))
+            self.retrying.add(task.path)
+        logging.warning(f"{task.path} failed in {stage} (attempt {attempts}); retrying later.")
+        return True
+
+    def succeeded(self, path):
+        if path not in self.retrying:
+            return
+        with self.lock:
+            self.connection.execute("DELETE FROM retries WHERE path = ?", (path,))
+            self.retrying.discard(path)
+
+    def claim_due(self):
+        """Return (path, root) of the retries that are due and hold them back until they report back."""
+        now = time.time()
+        with self.lock:
+            rows = self.connection.execute("SELECT path, root FROM retries WHERE next_attempt <= ?",
+                                           (now,)).fetchall()
+            self.connection.executemany("UPDATE retries SET next_attempt = ? WHERE path = ?",
+                                        [(now + CLAIM_SECONDS, path) for path, _ in rows])
+            self.retrying.update(path for path, _ in rows)
+        return rows
+
+    def dead_letters(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT id, path, root, stage, error_type, error, attempts, failed_at FROM dead_letters "
+                "ORDER BY id").fetchall()
+
+    def replay(self, ids=None):
+        """Move dead letters (all of them, or the given ids) back into the retry queue; returns how many.
+
+        A replayed file keeps the time it first failed, so a dead letter it turns
+        into again still shows when the trouble started.
+        """
+        query = "SELECT id, path, root, COALESCE(first_failed, failed_at), failed_at FROM dead_letters"
+        with self.lock, self.transaction():
+            if ids is None:
+                rows = self.connection.execute(query).fetchall()
+            else:
+                rows = self.connection.execute(f"{query} WHERE id IN ({','.join('?' * len(ids))})",
+                                               list(ids)).fetchall()
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO retries (path, root, stage, error, attempts, next_attempt, first_failed, "
+                "last_failed) VALUES (?, ?, 'replay', '', 0, ?, ?, ?)",
+                [(path, root, time.time(), first_failed, failed_at) for _, path, root, first_failed, failed_at in rows])
+            self.connection.executemany("DELETE FROM dead_letters WHERE id = ?", [(row[0],) for row in rows])
+        with self.lock:
+            self.retrying.update(row[1] for row in rows)
+        return len(rows)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def main(argv=None):
+    from pdc_watcher import add_engine_arguments
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=RETRY_DB_FILE, help='retry and dead-letter database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='show the dead letters')
+    replay_parser = commands.add_parser('replay', help='send dead letters back to the retry queue')
+    replay_parser.add_argument('ids', nargs='*', type=int, help='dead letter ids')
+    replay_parser.add_argument('--all', action='store_true', help='replay every dead letter')
+    replay_parser.add_argument('--run', action='store_true', help='process them now instead of in the watcher')
+    add_engine_arguments(replay_parser.add_argument_group('with --run, the watcher options'))
+    args = parser.parse_args(argv)
+
+    store = RetryStore(args.db)
+    if args.command == 'list':
+        letters = store.dead_letters()
+        for letter_id, path, _, stage, error_type, error, attempts, failed_at in letters:
+            print(f"{letter_id:6}  {failed_at}  {stage:10} {attempts:2}x  {error_type}: {error}\n        {path}")
+        print(f"{len(letters)} dead letters.")
+        return
+    if not args.ids and not args.all:
+        parser.error('give dead letter ids or --all')
+    count = store.replay(None if args.all else args.ids)
+    print(f"{count} dead letters sent back to the retry queue.")
+    if args.run and count:
+        from pdc_watcher import build_engine, load_router
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+        router = load_router(args)
+        if router is None:
+            parser.error('cannot read the watched folders; see the log')
+        try:
+            engine = build_engine(args, router, store)
+        except ValueError as e:
+            parser.error(str(e))
+        engine.start()
+        tasks = []
+        for path, root in store.claim_due():
+            task = engine.make_task(path, root)
+            if task is not None and os.path.exists(path):
+                tasks.append(task)
+            else:
+                store.succeeded(path)  # Gone, or its folder's profile no longer touches it
+        engine.run_tasks(tasks)
+        engine.stop()
+        if engine.pipeline.journal is not None:
+            engine.pipeline.journal.close()
+        print(f"{len(tasks)} processed; see the log for any that failed again.")
+
+
+if __name__ == "__main__":
+    main()
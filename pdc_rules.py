@@ -0,0 +1,292 @@
+"""The production rules from pdcCodeFinal.py as pure functions on bytes.
+
+The watcher engine reads each file once, runs these on the contents and writes
+the result once, instead of every processor opening, rewriting and renaming the
+file on its own. The output must stay identical to what the pdcCodeFinal
+processors produce.
+
+Files are handled as bytes: every edit is an ASCII tag or ID change, so there is
+no need to decode, translate newlines and re-encode, and the result does not
+depend on the locale's default encoding. Line endings are kept as they are in
+the source. The .nc1 rules describe their changes as a list of (start, end,
+replacement) edits to the source buffer, and Rewrite writes the untouched
+slices and the replacements with writelines, so large inputs can be
+memory-mapped and are never copied as a whole. The .idstv BL rules are
+whole-file regex passes, which run straight over the (mapped) buffer and are
+several times faster than finding the tagged lines and rewriting them one by
+one.
+"""
+import mmap
+import os
+import re
+import xml.etree.ElementTree as ET
+
+name_patterns = [re.compile(rb'(<Name>).*?%s(.*?</Name>)' % marker)
+                 for marker in [b'W_', b'C_', b'S_', b'HSS_', b'L_', b'HP_']]
+remnant_location_pattern = re.compile(rb'<RemnantLocation>.*?</RemnantLocation>', re.DOTALL)
+REMNANT_LOCATION = b'<RemnantLocation>v</RemnantLocation>'
+ID_TAGS = ['Filename', 'DrawingIdentification', 'PieceIdentification']
+# Same as (<tag>)(.{25,})(</tag>) with the first 10 characters of the content dropped
+tag_patterns = [re.compile(rb'(<%s>).{10}(.{15,}</%s>)' % (tag.encode(), tag.encode())) for tag in ID_TAGS]
+# Cheap test for an angle bar (ProfileType L) before paying for an ElementTree parse
+angle_profile_pattern = re.compile(rb'<ProfileType(?:\s[^>]*)?>(?:L|&#76;|&#x4[cC];|<!\[CDATA\[L)')
+
+# Rule stages a folder profile can switch on; .idstv stages always run BL first, then AM
+STAGES = ('nc1_bl', 'idstv_bl', 'idstv_am')
+PROFILES = {
+    'BL': ('nc1_bl', 'idstv_bl'),
+    'AM': ('idstv_am',),
+    'both': STAGES,  # What CombinedHandler in pdcCodeFinal.py does
+}
+KIND_STAGES = {'nc1': ('nc1_bl',), 'idstv': ('idstv_bl', 'idstv_am')}
+
+ANGLE_MAX_LENGTH = 279
+NC1_PREFIX_LENGTH = 10
+NC1_MIN_NAME_LENGTH = 25
+MMAP_THRESHOLD = 1024 * 1024  # Inputs at least this big are memory-mapped instead of read
+
+
+class SourceFile:
+    """The bytes of a file, memory-mapped when it is large. Close it before replacing the file."""
+
+    def __init__(self, path, mmap_threshold=MMAP_THRESHOLD):
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size and size >= mmap_threshold:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = self.file.read()
+            self.file.close()
+
+    def __len__(self):
+        return len(self.data)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Rewrite:
+    """New file contents, as sorted (start, end, replacement) edits to source or as complete content."""
+
+    def __init__(self, source, edits=(), content=None):
+        self.source = source
+        self.edits = list(edits)
+        self.content = content
+
+    @property
+    def changed(self):
+        return self.content is not None or bool(self.edits)
+
+    def chunks(self):
+        """Untouched slices of the source and the replacements between them, in order."""
+        if self.content is not None:
+            yield self.content
+            return
+        view = memoryview(self.source)
+        position = 0
+        for start, end, replacement in self.edits:
+            if start > position:
+                yield view[position:start]
+            if replacement:
+                yield replacement
+            position = end
+        if position < len(view):
+            yield view[position:]
+
+    def size(self):
+        if self.content is not None:
+            return len(self.content)
+        return len(self.source) + sum(len(replacement) - (end - start) for start, end, replacement in self.edits)
+
+    def write_to(self, file):
+        file.writelines(self.chunks())
+
+    def to_bytes(self):
+        return b''.join(self.chunks())
+
+
+def nc1_target_name(filename):
+    """Name the .nc1 gets on the beamline: the 10 character job prefix is dropped from long names."""
+    if len(filename) >= NC1_MIN_NAME_LENGTH:
+        return filename[NC1_PREFIX_LENGTH:]
+    return filename
+
+
+def rewrite_nc1(filename, data):
+    """Beamline .nc1 rules: drop the SI (scribing) block and, for files that get renamed,
+    the job prefix (and indent) of the drawing and piece IDs on lines 4 and 5.
+
+    Returns the new file name and the Rewrite.
+    """
+    edits = []
+    kept_lines = []  # (offset, line) of the lines that stay
+    skip = False
+    offset = 0
+    removed_from = None
+    # bytes() of a memory map is a copy, but splitlines copies every line anyway; of bytes it is data itself
+    for line in bytes(data).splitlines(keepends=True):
+        stripped = line.strip()
+        if stripped.startswith(b"SI"):
+            skip = True
+        elif len(stripped) == 2:
+            skip = False
+        if skip:
+            if removed_from is None:
+                removed_from = offset
+        else:
+            if removed_from is not None:
+                edits.append((removed_from, offset, b''))
+                removed_from = None
+            kept_lines.append((offset, line))
+        offset += len(line)
+    if removed_from is not None:
+        edits.append((removed_from, offset, b''))
+
+    target_name = nc1_target_name(filename)
+    if target_name != filename and len(kept_lines) >= 5:
+        for line_offset, line in kept_lines[3:5]:
+            if len(line.strip()) >= 25:
+                edits.append((line_offset, line_offset + 12, b''))
+        edits.sort()
+    return target_name, Rewrite(data, edits)
+
+
+def transform_idstv_bl(content):
+    """Beamline .idstv rules applied the way pdcCodeFinal does: each pattern over the whole file.
+
+    content can be any bytes-like buffer, a memory map included. Returns the
+    new content as bytes, or None when no rule matched.
+    """
+    changes = 0
+    for pattern in name_patterns:
+        content, count = pattern.subn(rb'\1\2', content)
+        changes += count
+    content, count = remnant_location_pattern.subn(REMNANT_LOCATION, content)
+    changes += count
+    for pattern in tag_patterns:
+        content, count = pattern.subn(rb'\1\2', content)
+        changes += count
+    return content if changes else None
+
+
+def transform_id(value):
+    parts = value.split('-')
+    if len(parts) != 3:
+        return value
+    first_char_last, remaining_last = parts[2][0], parts[2][1:]
+    if remaining_last.isdigit():
+        parts[2] = first_char_last + remaining_last.lstrip('0')
+    if parts[1].isdigit():
+        parts[1] = parts[1].lstrip('0')
+    elif any(char.isdigit() for char in parts[1]):
+        alpha_part = ''.join(filter(str.isalpha, parts[1]))
+        num_part = ''.join(filter(str.isdigit, parts[1]))
+        parts[1] = alpha_part + num_part.lstrip('0')
+    return '-'.join(parts)
+
+
+def transform_idstv_am(content):
+    """Angle master .idstv rules; returns the rewritten XML as UTF-8 bytes, or None when
+    the file has no angle bar.
+
+    Short angle pieces get their IDs compacted with transform_id. Like
+    process_idstv_file_AM, the whole document is re-serialised by ElementTree
+    when it holds an L profile, even if no piece is short enough.
+    """
+    if not angle_profile_pattern.search(content):
+        return None
+    root = ET.fromstring(content)
+    has_angle = False
+    for ba in root.findall('.//BA'):
+        profile_type = ba.find('ProfileType')
+        if profile_type is not None and profile_type.text == 'L':
+            has_angle = True
+            for pi in root.findall(".//PI"):
+                length_element = pi.find("Length")
+                if length_element is not None and float(length_element.text) < ANGLE_MAX_LENGTH:
+                    for tag in ID_TAGS:
+                        tag_element = pi.find(tag)
+                        if tag_element is not None:
+                            tag_element.text = transform_id(tag_element.text)
+    if not has_angle:
+        return None
+    return ET.tostring(root, encoding="UTF-8", xml_declaration=True)
+
+
+def stages_for(kind, stages):
+    """The stages of a profile that apply to a file kind; empty when the profile leaves it alone."""
+    return tuple(stage for stage in KIND_STAGES.get(kind, ()) if stage in stages)
+
+
+def rewrite_idstv_bl(data):
+    return Rewrite(data, content=transform_idstv_bl(data))
+
+
+def rewrite_idstv_am(data, rewrite):
+    """The AM rules on top of an earlier rewrite of data (or on data itself when it has no edits)."""
+    if not angle_profile_pattern.search(data):
+        return rewrite
+    try:
+        angle_content = transform_idstv_am(rewrite.to_bytes())
+    except (ET.ParseError, ValueError, TypeError, IndexError, AttributeError):
+        # A bad Length or ID makes process_idstv_file_AM raise before it writes, so the BL result stands
+        return rewrite
+    return rewrite if angle_content is None else Rewrite(data, content=angle_content)
+
+
+def rewrite_idstv(data, stages=STAGES):
+    """Apply the BL rules and then the AM rules, as CombinedHandler does, or only one of them."""
+    rewrite = rewrite_idstv_bl(data) if 'idstv_bl' in stages else Rewrite(data)
+    if 'idstv_am' in stages:
+        rewrite = rewrite_idstv_am(data, rewrite)
+    return rewrite
+
+
+def rewrite_idstv_detached(data, stages=STAGES):
+    """rewrite_idstv as (edits, content) without the source, so a process pool sends back only the changes."""
+    rewrite = rewrite_idstv(data, stages)
+    return rewrite.edits, rewrite.content
+
+
+def rewrite_variants(filename, data, stage_sets):
+    """(target name, Rewrite) of one source for each set of stages.
+
+    Every variant is built from the same buffer, and the BL and AM results
+    are worked out once and shared by the variants that need them.
+    """
+    results = {}
+    if filename.endswith('.nc1'):
+        nc1_bl = None
+        for stages in stage_sets:
+            if 'nc1_bl' in stages:
+                nc1_bl = nc1_bl or rewrite_nc1(filename, data)
+                results[stages] = nc1_bl
+            else:
+                results[stages] = (filename, Rewrite(data))
+        return results
+    rewrites = {(): Rewrite(data)}
+    for stages in stage_sets:
+        key = tuple(stage for stage in ('idstv_bl', 'idstv_am') if stage in stages)
+        if key not in rewrites:
+            base = ('idstv_bl',) if 'idstv_bl' in key else ()
+            if base not in rewrites:
+                rewrites[base] = rewrite_idstv_bl(data)
+            rewrites[key] = rewrites[base] if key == base else rewrite_idstv_am(data, rewrites[base])
+        results[stages] = (filename, rewrites[key])
+    return results
+
+
+def target_path(path):
+    """Where the processed file ends up (only .nc1 files are renamed)."""
+    if path.endswith('.nc1'):
+        directory, filename = os.path.split(path)
+        return os.path.join(directory, nc1_target_name(filename))
+    return path
@@ -0,0 +1,119 @@
+"""Priority queue in front of the watcher workers.
+
+Files are no longer handled in arrival order. Each queued file gets a due
+time: the time it was queued, plus a delay that grows with its size
+(shortest job first), minus a head start when its job is on the shop floor.
+Workers take the file with the earliest due time. Because a file's due time
+never changes while later arrivals get later ones, a big or low-priority
+file is only ever overtaken for a bounded time and cannot starve.
+
+The jobs on the floor are listed by W-number in watcher_settings.json, which
+the watcher's settle loop re-reads when it changes, so a job can be marked
+urgent without restarting the watcher:
+
+    {"on_floor": ["W8787", "W8801"], "on_floor_head_start": 60, "seconds_per_mb": 5}
+"""
+import heapq
+import itertools
+import json
+import logging
+import os
+import queue
+import re
+import time
+
+from pdc_metrics import REGISTRY
+
+WATCHER_SETTINGS_FILE = 'watcher_settings.json'
+ON_FLOOR_HEAD_START = 60  # Seconds an on-floor file is moved forward in the queue
+SECONDS_PER_MB = 5  # Seconds a file is held back per MB, so small files go first
+SMALL_FILE_BYTES = 64 * 1024
+SETTINGS_CHECK_SECONDS = 10
+
+job_number_pattern = re.compile(r'(?<![A-Za-z0-9])W\d+', re.IGNORECASE)
+
+queue_wait = REGISTRY.histogram('pdc_queue_wait_seconds', 'Seconds a settled file waited for a worker',
+                                ['priority'])
+
+
+def job_number(path):
+    """The W-number of the job a file belongs to: the last one in its path, or None."""
+    numbers = job_number_pattern.findall(path)
+    return numbers[-1].upper() if numbers else None
+
+
+class PrioritySettings:
+    """The on-floor jobs and weights from watcher_settings.json, re-read when the file changes.
+
+    refresh() does file I/O and is called from outside the queue (the settle
+    loop); the scheduler only reads the attributes.
+    """
+
+    def __init__(self, path=WATCHER_SETTINGS_FILE):
+        self.path = path
+        self.mtime = None
+        self.next_check = 0.0
+        self.on_floor = set()
+        self.head_start = ON_FLOOR_HEAD_START
+        self.seconds_per_mb = SECONDS_PER_MB
+        self.refresh()
+
+    def refresh(self):
+        now = time.monotonic()
+        if now < self.next_check:
+            return
+        self.next_check = now + SETTINGS_CHECK_SECONDS
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self.mtime:
+            return
+        try:
+            with open(self.path, 'r') as file:
+                settings = json.load(file)
+        except (OSError, ValueError) as e:
+            logging.error(f"Cannot read {self.path}: {e}")
+            return
+        self.mtime = mtime
+        self.on_floor = {job.upper() for job in settings.get('on_floor', [])}
+        self.head_start = settings.get('on_floor_head_start', ON_FLOOR_HEAD_START)
+        self.seconds_per_mb = settings.get('seconds_per_mb', SECONDS_PER_MB)
+        logging.info(f"Jobs on the floor: {', '.join(sorted(self.on_floor)) or 'none'}.")
+
+
+class PriorityScheduler(queue.Queue):
+    """A queue.Queue of FileTasks (or lists of them) ordered by due time; None sorts last."""
+
+    def __init__(self, settings=None):
+        self.settings = settings or PrioritySettings()
+        super().__init__()
+
+    def _init(self, maxsize):
+        self.queue = []
+        self.order = itertools.count()  # Keeps equal due times first in, first out
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        heapq.heappush(self.queue, (self.due_time(item), next(self.order), item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[2]
+
+    def due_time(self, item):
+        if item is None:
+            return float('inf')
+        if isinstance(item, list):
+            return min(self.due_time(task) for task in item)
+        task = item
+        due = task.settled_time or time.monotonic()
+        size = task.size or 0
+        due += size / (1024 * 1024) * self.settings.seconds_per_mb
+        if job_number(task.path) in self.settings.on_floor:
+            due -= self.settings.head_start
+            task.priority = 'on_floor'
+        else:
+            task.priority = 'small' if size < SMALL_FILE_BYTES else 'large'
+        return due
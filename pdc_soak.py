@@ -0,0 +1,420 @@
+"""Soak test: the watcher under a steady stream of job drops.
+
+Starts pdc_watcher.py in its own process on a temporary folder and writes
+synthetic .nc1 and .idstv files into it at a steady rate, with a burst of
+files every so often (a whole job export landing at once) and a share of
+slow writers that keep their file open and write it in pieces, like a CAD
+export over the network. When the load stops and the watcher has caught up,
+its log is read back and the report gives:
+
+- latency from the moment a file was completely written to the moment the
+  watcher logged it as processed (p50/p90/p99/max), overall, per writer
+  (steady, burst, slow) and per file kind;
+- files that were never processed (dropped), processed more than once
+  (duplicates) or processed before their writer had finished (early);
+- CPU and resident memory of the watcher process, sampled every second, and
+  how fast the memory grew.
+
+The report is JSON like pdc_bench's, so the soak of a new release can be
+held against the last one with --compare before it goes to the shop.
+Options this command does not know are passed on to the watcher.
+
+    python pdc_soak.py --duration 3600 --rate 5 --burst 200 --burst-every 300 --output soak.json
+    python pdc_soak.py --duration 600 --compare soak.json --cache-dir C:/pdc_soak_cache
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import synthetic_data
+from pdc_bench import code_version
+
+DURATION = 300
+RATE = 2.0  # Files per second outside bursts
+BURST_FILES = 100
+BURST_EVERY = 60
+SLOW_SHARE = 0.1
+SLOW_SECONDS = 5.0
+SLOW_CHUNKS = 10
+IDSTV_SHARE = 0.3
+IDSTV_PIECES = 20
+DRAIN_SECONDS = 120  # How long to wait for the watcher to catch up after the load stops
+SAMPLE_SECONDS = 1.0
+START_TIMEOUT = 30
+WATCHER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdc_watcher.py')
+
+log_line_pattern = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}) - (\w+) - (.*)$')
+processed_pattern = re.compile(r'^Processed (.+?)(?: -> .*)?$')
+
+
+class LoadGenerator:
+    """Writes synthetic files into a folder and records when each one was complete."""
+
+    def __init__(self, directory, seed=0, idstv_share=IDSTV_SHARE, idstv_pieces=IDSTV_PIECES):
+        self.directory = directory
+        self.rng = random.Random(seed)
+        self.idstv_share = idstv_share
+        self.idstv_pieces = idstv_pieces
+        self.number = 0
+        self.written = {}  # path -> (time the write finished, writer, kind)
+        self.slow_writers = []
+        self.lock = threading.Lock()
+
+    def new_file(self):
+        """A fresh path and its contents, named like a Tekla export."""
+        self.number += 1
+        if self.rng.random() < self.idstv_share:
+            prefix = synthetic_data.job_prefix()
+            path = os.path.join(self.directory, f"{prefix}bar{self.number:05d}.idstv")
+            return path, synthetic_data.idstv_text(self.rng, prefix, self.idstv_pieces), 'idstv'
+        prefix = synthetic_data.job_prefix()
+        ident = synthetic_data.piece_id(self.rng, self.number % 50 + 1, self.number)
+        text = synthetic_data.nc1_text(self.rng, prefix, ident, self.rng.uniform(150, 6000))
+        return os.path.join(self.directory, f"{prefix}{ident}.nc1"), text, 'nc1'
+
+    def finished(self, path, writer, kind):
+        with self.lock:
+            self.written[path] = (time.time(), writer, kind)
+
+    def write(self, writer='steady'):
+        path, text, kind = self.new_file()
+        with open(path, 'w') as file:
+            file.write(text)
+        self.finished(path, writer, kind)
+
+    def write_slowly(self, seconds, chunks=SLOW_CHUNKS):
+        """Start a writer that holds the file open for seconds while it writes it in chunks."""
+        path, text, kind = self.new_file()
+
+        def run():
+            step = -(-len(text) // chunks)
+            with open(path, 'w') as file:
+                for start in range(0, len(text), step):
+                    file.write(text[start:start + step])
+                    file.flush()
+                    time.sleep(seconds / chunks)
+            self.finished(path, 'slow', kind)
+
+        writer = threading.Thread(target=run, name='slow-writer', daemon=True)
+        writer.start()
+        self.slow_writers.append(writer)
+
+    def run(self, duration, rate=RATE, burst=BURST_FILES, burst_every=BURST_EVERY, slow_share=SLOW_SHARE,
+            slow_seconds=SLOW_SECONDS):
+        start = time.monotonic()
+        next_file = start
+        next_burst = start + burst_every if burst and burst_every else float('inf')
+        while True:
+            now = time.monotonic()
+            if now - start >= duration:
+                break
+            if now >= next_burst:
+                for _ in range(burst):
+                    self.write('burst')
+                next_burst += burst_every
+            elif now >= next_file:
+                if self.rng.random() < slow_share:
+                    self.write_slowly(slow_seconds)
+                else:
+                    self.write()
+                next_file += 1 / rate if rate > 0 else float('inf')
+            time.sleep(max(0.0, min(next_file, next_burst, start + duration) - time.monotonic()))
+        for writer in self.slow_writers:
+            writer.join()
+
+
+def process_usage(pid):
+    """CPU seconds and resident bytes of a process, or None when neither psutil nor /proc can tell."""
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            times = process.cpu_times()
+            return times.user + times.system, process.memory_info().rss
+        except psutil.Error:
+            return None
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as file:
+            fields = file.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/status', 'r') as file:
+            rss = next(int(line.split()[1]) * 1024 for line in file if line.startswith('VmRSS:'))
+    except (OSError, StopIteration, ValueError, IndexError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK'), rss
+
+
+class ResourceSampler(threading.Thread):
+    """Samples the CPU use (percent of one core) and RSS of a process every interval."""
+
+    def __init__(self, pid, interval=SAMPLE_SECONDS):
+        super().__init__(name='resource-sampler', daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []  # (seconds since start, CPU percent, RSS bytes)
+        self.stopped = threading.Event()
+
+    def run(self):
+        start = previous_time = time.monotonic()
+        previous = process_usage(self.pid)
+        while previous is not None and not self.stopped.wait(self.interval):
+            usage = process_usage(self.pid)
+            now = time.monotonic()
+            if usage is None:
+                break
+            cpu_percent = (usage[0] - previous[0]) / (now - previous_time) * 100
+            self.samples.append((round(now - start, 1), round(cpu_percent, 1), usage[1]))
+            previous, previous_time = usage, now
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def read_log(path):
+    """Times each path was logged as processed, and the number of errors logged."""
+    processed = {}
+    error_count = 0
+    try:
+        with open(path, 'r', errors='replace') as file:
+            for line in file:
+                match = log_line_pattern.match(line.rstrip('\n'))
+                if match is None:
+                    continue
+                moment, level, message = match.groups()
+                if level == 'ERROR':
+                    error_count += 1
+                processed_match = processed_pattern.match(message)
+                if processed_match is not None:
+                    logged = datetime.strptime(moment, '%Y-%m-%d %H:%M:%S,%f').timestamp()
+                    processed.setdefault(processed_match.group(1), []).append(logged)
+    except FileNotFoundError:
+        pass
+    return processed, error_count
+
+
+def percentile(ordered, share):
+    """Nearest-rank percentile of an already sorted list."""
+    return ordered[min(len(ordered) - 1, max(0, int(round(share * len(ordered) + 0.5)) - 1))]
+
+
+def summarize(latencies):
+    if not latencies:
+        return {'count': 0}
+    ordered = sorted(latencies)
+    return {'count': len(ordered), 'mean': sum(ordered) / len(ordered), 'p50': percentile(ordered, 0.5),
+            'p90': percentile(ordered, 0.9), 'p99': percentile(ordered, 0.99), 'max': ordered[-1]}
+
+
+def growth_per_hour(samples):
+    """Least-squares slope of RSS over the second half of the run, in bytes per hour."""
+    points = [(seconds, rss) for seconds, _, rss in samples[len(samples) // 2:]]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    spread = sum((x - mean_x) ** 2 for x, _ in points)
+    if not spread:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / spread * 3600
+
+
+def wait_for(condition, timeout, interval=0.5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def watcher_started(log_path):
+    try:
+        with open(log_path, 'r', errors='replace') as file:
+            return 'Monitoring started' in file.read()
+    except FileNotFoundError:
+        return False
+
+
+def stop_watcher(process):
+    if process.poll() is not None:
+        return
+    if os.name == 'nt':
+        process.terminate()
+    else:
+        process.send_signal(signal.SIGINT)  # The watcher stops its engine and writes a last snapshot
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run_soak(workdir, args, watcher_args):
+    inbox = os.path.join(workdir, 'inbox')
+    os.makedirs(inbox, exist_ok=True)
+    settings_path = os.path.join(workdir, 'folders_settings.txt')
+    with open(settings_path, 'w') as file:
+        file.write(inbox + '\n')
+    log_path = os.path.join(workdir, 'pdc_watcher.log')  # The watcher logs into its working directory
+    snapshot_path = os.path.join(workdir, 'pdc_metrics.json')
+    command = [sys.executable, WATCHER_SCRIPT, '--settings', settings_path, '--workers', str(args.workers),
+               '--settle', str(args.settle), '--metrics-port', '0', '--snapshot', snapshot_path,
+               '--retry-db', os.path.join(workdir, 'pdc_retry.sqlite'),
+               '--watcher-settings', os.path.join(workdir, 'watcher_settings.json')] + watcher_args
+    process = subprocess.Popen(command, cwd=workdir)
+    sampler = ResourceSampler(process.pid, args.sample)
+    try:
+        if not wait_for(lambda: process.poll() is not None or watcher_started(log_path), START_TIMEOUT):
+            raise RuntimeError(f"The watcher did not start within {START_TIMEOUT} seconds; see {log_path}")
+        if process.poll() is not None:
+            raise RuntimeError(f"The watcher exited with code {process.returncode}; see {log_path}")
+        sampler.start()
+        generator = LoadGenerator(inbox, args.seed, args.idstv_share, args.idstv_pieces)
+        print(f"Writing files for {args.duration} s into {inbox} ...")
+        load_start = time.monotonic()
+        generator.run(args.duration, args.rate, args.burst, args.burst_every, args.slow_share, args.slow_seconds)
+        load_seconds = time.monotonic() - load_start
+        print(f"{len(generator.written)} files written; waiting for the watcher to catch up ...")
+        drained = wait_for(lambda: set(generator.written) <= set(read_log(log_path)[0]), args.drain, 1.0)
+    finally:
+        if sampler.is_alive():
+            sampler.stop()
+        stop_watcher(process)
+
+    processed, error_count = read_log(log_path)
+    latencies = {}
+    dropped, duplicates, early = [], [], []
+    for path, (finished, writer, kind) in sorted(generator.written.items()):
+        times = processed.get(path)
+        if not times:
+            dropped.append(path)
+            continue
+        if len(times) > 1:
+            duplicates.append(path)
+        if times[0] < finished:
+            early.append(path)
+        latency = max(times) - finished
+        for group in ('all', writer, kind):
+            latencies.setdefault(group, []).append(latency)
+
+    samples = sampler.samples
+    cpu = [cpu_percent for _, cpu_percent, _ in samples]
+    rss = [resident for _, _, resident in samples]
+    watcher_metrics = None
+    if os.path.exists(snapshot_path):
+        with open(snapshot_path, 'r') as file:
+            watcher_metrics = json.load(file).get('metrics')
+    return {
+        'version': code_version(), 'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(), 'platform': platform.platform(),
+        'settings': {'duration': args.duration, 'rate': args.rate, 'burst': args.burst,
+                     'burst_every': args.burst_every, 'slow_share': args.slow_share,
+                     'slow_seconds': args.slow_seconds, 'idstv_share': args.idstv_share,
+                     'idstv_pieces': args.idstv_pieces, 'workers': args.workers, 'settle': args.settle,
+                     'seed': args.seed, 'watcher_args': watcher_args},
+        'files': {'written': len(generator.written), 'processed': sum(path in processed for path in generator.written),
+                  'dropped': len(dropped), 'duplicates': len(duplicates), 'early': len(early),
+                  'errors_logged': error_count, 'caught_up': drained,
+                  'files_per_second': len(generator.written) / load_seconds if load_seconds else None},
+        'latency': {group: summarize(values) for group, values in sorted(latencies.items())},
+        'resources': {'samples': samples,
+                      'cpu_percent_mean': sum(cpu) / len(cpu) if cpu else None,
+                      'cpu_percent_max': max(cpu) if cpu else None,
+                      'rss_start': rss[0] if rss else None, 'rss_max': max(rss) if rss else None,
+                      'rss_end': rss[-1] if rss else None, 'rss_growth_per_hour': growth_per_hour(samples)},
+        'dropped_files': dropped[:50], 'duplicate_files': duplicates[:50], 'early_files': early[:50],
+        'watcher_metrics': watcher_metrics,
+    }
+
+
+def format_value(value, unit):
+    if value is None:
+        return '-'
+    if unit == 'ms':
+        return f"{value * 1000:.1f} ms"
+    if unit == 'MiB':
+        return f"{value / (1024 * 1024):.1f} MiB"
+    if unit == '%':
+        return f"{value:.1f} %"
+    return str(value)
+
+
+def key_figures(report):
+    latency = report['latency'].get('all', {})
+    resources = report['resources']
+    return [('latency p50', latency.get('p50'), 'ms'), ('latency p90', latency.get('p90'), 'ms'),
+            ('latency p99', latency.get('p99'), 'ms'), ('latency max', latency.get('max'), 'ms'),
+            ('dropped', report['files']['dropped'], ''), ('duplicates', report['files']['duplicates'], ''),
+            ('early', report['files']['early'], ''), ('errors logged', report['files']['errors_logged'], ''),
+            ('CPU mean', resources['cpu_percent_mean'], '%'), ('CPU max', resources['cpu_percent_max'], '%'),
+            ('RSS max', resources['rss_max'], 'MiB'), ('RSS growth/hour', resources['rss_growth_per_hour'], 'MiB')]
+
+
+def print_report(report):
+    print(f"\n{report['files']['written']} files written, {report['files']['processed']} processed "
+          f"({report['files']['files_per_second']:.1f} files/s offered).")
+    for name, value, unit in key_figures(report):
+        print(f"{name:16} {format_value(value, unit):>14}")
+
+
+def compare(report, baseline_path):
+    """Print the key figures of this soak next to those of an earlier report."""
+    with open(baseline_path, 'r') as file:
+        baseline = json.load(file)
+    print(f"\nCompared with {baseline_path} ({baseline['version']}):")
+    for (name, old, unit), (_, new, _) in zip(key_figures(baseline), key_figures(report)):
+        ratio = f"x{new / old:.2f}" if isinstance(old, (int, float)) and isinstance(new, (int, float)) and old else ''
+        print(f"{name:16} {format_value(old, unit):>14} -> {format_value(new, unit):>14}  {ratio}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=DURATION, help='seconds of load')
+    parser.add_argument('--rate', type=float, default=RATE, help='files per second outside bursts')
+    parser.add_argument('--burst', type=int, default=BURST_FILES, help='files written at once in a burst')
+    parser.add_argument('--burst-every', type=float, default=BURST_EVERY, help='seconds between bursts')
+    parser.add_argument('--slow-share', type=float, default=SLOW_SHARE, help='share of files written slowly')
+    parser.add_argument('--slow-seconds', type=float, default=SLOW_SECONDS,
+                        help='seconds a slow writer keeps its file open')
+    parser.add_argument('--idstv-share', type=float, default=IDSTV_SHARE, help='share of .idstv files')
+    parser.add_argument('--idstv-pieces', type=int, default=IDSTV_PIECES, help='pieces per .idstv file')
+    parser.add_argument('--workers', type=int, default=2, help='watcher workers')
+    parser.add_argument('--settle', type=float, default=1.0, help='watcher settle seconds')
+    parser.add_argument('--drain', type=float, default=DRAIN_SECONDS,
+                        help='seconds to wait for the watcher to catch up after the load')
+    parser.add_argument('--sample', type=float, default=SAMPLE_SECONDS, help='seconds between CPU/RSS samples')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='folder to run in (kept afterwards); a temporary one by default')
+    parser.add_argument('--output', default='soak_results.json', help='where to write the JSON report')
+    parser.add_argument('--compare', help='earlier report to compare against')
+    args, watcher_args = parser.parse_known_args(argv)
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        report = run_soak(os.path.abspath(args.workdir), args, watcher_args)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            report = run_soak(workdir, args, watcher_args)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print_report(report)
+    print(f"Report written to {args.output}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
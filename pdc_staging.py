@@ -0,0 +1,221 @@
+"""Local staging cache for folders on network shares and OneDrive.
+
+Working directly against N:\\ or a OneDrive folder costs a network round trip
+for every open, read, write and rename. With staging, the engine copies each
+settled file into a local cache directory in one read, runs the rules on the
+local copy and writes the result locally. The results are pushed back by a
+few writer threads per share: each source is stat'ed to check that it has
+not changed since it was staged, and each result is copied next to its
+target and renamed into place. A worker waits for its file's results to be
+pushed before it reports the file processed, so a failed push goes to the
+journal and the retry queue like any other failure.
+
+Any local folder works as the "share" too, so staging can be tried on a copy
+of a job on the local disk.
+
+    python pdc_watcher.py --stage-dir C:/pdc_cache
+"""
+import hashlib
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+
+from pdc_rules import SourceFile
+from pdc_throttle import directory_share
+from pdc_watcher import TEMP_SUFFIX, Pipeline, bytes_read, bytes_written, errors, stage_seconds
+
+PUSH_THREADS = 2  # Write-back threads per share (pdc_throttle can hold them back further)
+PUSH_BATCH = 64  # Results a writer thread takes off its queue at once
+
+
+def discard(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class StagedResult:
+    """A processed file waiting in the cache to be pushed back to its share."""
+
+    def __init__(self, task, local_path, target, source_stat):
+        self.task = task
+        self.local_path = local_path
+        self.target = target
+        self.source_stat = source_stat  # (size, mtime_ns) of the source when it was staged
+        self.replaced = False  # The target was replaced by the result
+        self.error = None  # Why the push failed
+        self.pushed = threading.Event()  # Set once the push is over, whatever its outcome
+
+
+class WriteBack:
+    """Pushes staged results back with at most PUSH_THREADS writers per share."""
+
+    def __init__(self, pipeline, threads_per_share=PUSH_THREADS, batch_size=PUSH_BATCH):
+        self.pipeline = pipeline
+        self.threads_per_share = threads_per_share
+        self.batch_size = batch_size
+        self.queues = {}  # share -> queue.Queue of StagedResult
+        self.lock = threading.Lock()
+
+    def submit(self, result):
+        share = directory_share(os.path.dirname(result.target))
+        with self.lock:
+            results = self.queues.get(share)
+            if results is None:
+                results = self.queues[share] = queue.Queue()
+                for i in range(self.threads_per_share):
+                    threading.Thread(target=self.push_loop, args=(share, results),
+                                     name=f'push-{share}-{i}', daemon=True).start()
+        results.put(result)
+
+    def push_loop(self, share, results):
+        while True:
+            batch = [results.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(results.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.push(batch)
+            except Exception as e:
+                logging.exception(f"Unexpected error pushing results to {share}")
+                for result in batch:
+                    if not result.replaced and result.error is None:
+                        result.error = e
+            finally:
+                for result in batch:
+                    result.pushed.set()
+                    results.task_done()
+
+    def push(self, batch):
+        """Check that the source of each result is unchanged, then replace its target.
+
+        Each source is stat'ed on its own: a batch holds only the results of
+        the workers waiting on it, and listing a job folder of thousands of
+        files for them would cost more than the pushes.
+        """
+        for result in batch:
+            path = result.task.path
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+            except OSError as e:
+                errors.inc(stage='push', type=type(e).__name__)
+                logging.error(f"Cannot check {path}; its result was not pushed: {e}")
+                result.error = e
+                discard(result.local_path)  # The retry stages and processes the file again
+                continue
+            if stat is None or (stat.st_size, stat.st_mtime_ns) != result.source_stat:
+                logging.warning(f"{path} changed or disappeared while it was staged; not replaced.")
+                discard(result.local_path)
+                continue
+            self.push_one(result)
+
+    def push_one(self, result):
+        task = result.task
+        start = time.perf_counter()
+        try:
+            temp_path = result.target + TEMP_SUFFIX
+            with self.pipeline.io(result.target, 'write'):
+                if task.outputs:
+                    os.makedirs(os.path.dirname(result.target), exist_ok=True)
+                shutil.copyfile(result.local_path, temp_path)
+                stat = os.stat(temp_path)
+                self.pipeline.mark_written(result.target, stat.st_size, stat.st_mtime_ns)
+                os.replace(temp_path, result.target)
+                if result.target != task.path and not task.outputs:
+                    os.remove(task.path)
+            result.replaced = True
+            os.remove(result.local_path)
+        except Exception as e:
+            if not result.replaced:
+                result.error = e
+                discard(result.local_path)
+            errors.inc(stage='push', type=type(e).__name__)
+            logging.error(f"Error pushing {result.target}: {type(e).__name__}: {e}")
+        finally:
+            stage_seconds.observe(time.perf_counter() - start, stage='push', kind=task.kind)
+
+    def join(self):
+        with self.lock:
+            results = list(self.queues.values())
+        for share_results in results:
+            share_results.join()
+
+
+class StagingPipeline(Pipeline):
+    """Pipeline that reads and writes through a local cache directory."""
+
+    async_capable = False  # process() cleans up the staged copy, and done() blocks on the push
+
+    def __init__(self, cache_dir, threads_per_share=PUSH_THREADS, io_limits=None, cache=None, archive=None,
+                 journal=None):
+        super().__init__(io_limits, cache, archive, journal)
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.write_back = WriteBack(self, threads_per_share)
+        self.staged = {}  # task path -> (local copy, (size, mtime_ns) of the source)
+        self.pushing = {}  # task path -> StagedResults submitted for it
+
+    def local_path(self, path, suffix=''):
+        digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{digest}-{os.path.basename(path)}{suffix}")
+
+    def read(self, task):
+        local = self.local_path(task.path)
+        with self.stage('stage_in', task), self.io(task.path, 'read'):
+            stat = os.stat(task.path)
+            shutil.copyfile(task.path, local)
+        with self.lock:
+            self.staged[task.path] = (local, (stat.st_size, stat.st_mtime_ns))
+        source = SourceFile(local)
+        bytes_read.inc(len(source), kind=task.kind)
+        return source
+
+    def write(self, task, rewrite, target):
+        local_result = self.local_path(target, '.result')
+        with open(local_result, 'wb') as file:
+            rewrite.write_to(file)
+        bytes_written.inc(rewrite.size(), kind=task.kind)
+        return local_result
+
+    def rename(self, task, temp_path, target):
+        with self.lock:
+            _, source_stat = self.staged[task.path]
+            result = StagedResult(task, temp_path, target, source_stat)
+            self.pushing.setdefault(task.path, []).append(result)
+        self.write_back.submit(result)
+
+    def process(self, task):
+        try:
+            return super().process(task)
+        finally:
+            with self.lock:
+                local, _ = self.staged.pop(task.path, (None, None))
+                self.pushing.pop(task.path, None)
+            if local is not None and os.path.exists(local):
+                os.remove(local)
+
+    def done(self, task, bytes_in, bytes_out, targets):
+        """Wait until the results of task are pushed; it only counts as processed once they are in place."""
+        with self.lock:
+            results = self.pushing.pop(task.path, [])
+        for result in results:
+            result.pushed.wait()
+        for result in results:
+            if result.error is not None:
+                task.error = ('push', result.error)
+                return self.failed(task, result.error, bytes_in, bytes_out, targets)
+        if not all(result.replaced for result in results):
+            self.log_journal(task, 'gone', bytes_in, bytes_out, targets)  # Its next version is processed instead
+            return False
+        return super().done(task, bytes_in, bytes_out, targets)
+
+    def flush(self):
+        self.write_back.join()
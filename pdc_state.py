@@ -0,0 +1,235 @@
+"""Compact per-file state for the watcher.
+
+A watcher on job folders with hundreds of thousands of files keeps state
+for many of them at once: the files waiting to settle after a job drop, and
+the files it wrote itself, whose events it ignores for a while. Kept as
+dicts of full paths to lists or objects, that cost over half a kilobyte per
+file, and the written files were never forgotten.
+
+Here every directory is stored once and numbered (PathTable), and a file is
+its directory number and its name. FileTable keeps the values of each file
+in array columns at an integer file id, finds the id through a dict of
+names per directory, and hands the ids of removed files out again. Files
+leave the tables when they are done with, and a directory leaves its
+PathTable with the last file that refers to it, so a watcher that runs for
+days holds only what it is tracking right now.
+
+None of these classes lock; their owners do.
+"""
+import math
+import os
+from array import array
+
+
+def split_path(path):
+    """(directory with its trailing separator, name), so that directory + name gives path back exactly."""
+    cut = path.rfind(os.sep)
+    if os.altsep:
+        cut = max(cut, path.rfind(os.altsep))
+    return path[:cut + 1], path[cut + 1:]
+
+
+class PathTable:
+    """Directories, each stored once and numbered, and counted by the references to them.
+
+    A directory is forgotten when its last reference is released, and its
+    number is handed out again.
+    """
+
+    def __init__(self):
+        self.directories = []  # directory id -> directory, None when the id is free
+        self.ids = {}
+        self.references = array('l')  # directory id -> references held to it
+        self.free = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def directory_id(self, directory):
+        """The id of directory, or None when nothing refers to it."""
+        return self.ids.get(directory)
+
+    def acquire(self, directory):
+        """The id of directory, numbering it when it is new, with one more reference to it."""
+        directory_id = self.ids.get(directory)
+        if directory_id is None:
+            if self.free:
+                directory_id = self.free.pop()
+                self.directories[directory_id] = directory
+            else:
+                directory_id = len(self.directories)
+                self.directories.append(directory)
+                self.references.append(0)
+            self.ids[directory] = directory_id
+        self.references[directory_id] += 1
+        return directory_id
+
+    def release(self, directory_id):
+        """Drop one reference to a directory; the last one forgets it."""
+        self.references[directory_id] -= 1
+        if not self.references[directory_id]:
+            del self.ids[self.directories[directory_id]]
+            self.directories[directory_id] = None
+            self.free.append(directory_id)
+
+    def compact(self):
+        """Give back the room of forgotten directories at the end of the table."""
+        size = len(self.directories)
+        while self.directories and self.directories[-1] is None:
+            self.directories.pop()
+            self.references.pop()
+        if len(self.directories) < size:
+            self.free = [directory_id for directory_id in self.free if directory_id < len(self.directories)]
+
+
+class FileTable:
+    """Per-file values in array columns, addressed by integer file ids.
+
+    columns maps each column name to an array type code ('d' for times,
+    'q' for sizes and so on); missing values are stored as the column's
+    default, NaN for floats and -1 for integers. The directory_columns hold
+    directory ids: they are given and set as directories, and the table
+    keeps a reference to each one in paths while it is stored.
+    """
+
+    def __init__(self, columns, paths=None, directory_columns=()):
+        self.paths = PathTable() if paths is None else paths
+        self.directory_columns = frozenset(directory_columns)
+        self.names = {}  # directory id -> {file name: file id}
+        self.directory = array('l')  # file id -> directory id, -1 when the id is free
+        self.name = []  # file id -> file name
+        self.columns = {column: array(code) for column, code in columns.items()}
+        self.defaults = {column: math.nan if code in 'fd' else -1 for column, code in columns.items()}
+        self.free = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def find(self, path):
+        """The file id of path, or None when it is not in the table."""
+        directory, name = split_path(path)
+        directory_id = self.paths.directory_id(directory)
+        if directory_id is None:
+            return None
+        return self.names.get(directory_id, {}).get(name)
+
+    def add(self, path, **values):
+        """Add path (or update it when it is already there) and return its file id."""
+        directory, name = split_path(path)
+        directory_id = self.paths.acquire(directory)
+        names = self.names.setdefault(directory_id, {})
+        file_id = names.get(name)
+        if file_id is not None:
+            self.paths.release(directory_id)  # The file holds its reference already
+            for column, value in values.items():
+                self.set(file_id, column, value)
+            return file_id
+        values = {column: self.paths.acquire(value) if column in self.directory_columns and value is not None
+                  else value for column, value in values.items()}
+        if self.free:
+            file_id = self.free.pop()
+            self.directory[file_id] = directory_id
+            self.name[file_id] = name
+            for column, cells in self.columns.items():
+                cells[file_id] = values.get(column, self.defaults[column])
+        else:
+            file_id = len(self.directory)
+            self.directory.append(directory_id)
+            self.name.append(name)
+            for column, cells in self.columns.items():
+                cells.append(values.get(column, self.defaults[column]))
+        names[name] = file_id
+        self.count += 1
+        return file_id
+
+    def remove(self, file_id):
+        directory_id = self.directory[file_id]
+        names = self.names[directory_id]
+        del names[self.name[file_id]]
+        if not names:
+            del self.names[directory_id]
+        self.paths.release(directory_id)
+        for column in self.directory_columns:
+            self.set(file_id, column, None)
+        self.directory[file_id] = -1
+        self.name[file_id] = None
+        self.free.append(file_id)
+        self.count -= 1
+
+    def path(self, file_id):
+        return self.paths.directories[self.directory[file_id]] + self.name[file_id]
+
+    def get(self, file_id, column):
+        value = self.columns[column][file_id]
+        return None if value == self.defaults[column] or value != value else value
+
+    def set(self, file_id, column, value):
+        if column in self.directory_columns:
+            old = self.columns[column][file_id]
+            value = None if value is None else self.paths.acquire(value)
+            if old != -1:
+                self.paths.release(old)
+        self.columns[column][file_id] = self.defaults[column] if value is None else value
+
+    def ids(self):
+        """The file ids in use."""
+        return [file_id for names in self.names.values() for file_id in names.values()]
+
+    def ids_beside(self, path):
+        """The file ids of the files in the same directory as path."""
+        directory_id = self.paths.directory_id(split_path(path)[0])
+        return list(self.names.get(directory_id, {}).values())
+
+    def compact(self):
+        """Give back the room of removed files at the end of the columns."""
+        size = len(self.directory)
+        while self.directory and self.directory[-1] == -1:
+            self.directory.pop()
+            self.name.pop()
+            for cells in self.columns.values():
+                cells.pop()
+        if len(self.directory) < size:
+            self.free = [file_id for file_id in self.free if file_id < len(self.directory)]
+        self.paths.compact()
+
+
+class ExpiringPaths:
+    """Paths remembered until a deadline in time.monotonic() seconds, with optional values of their own."""
+
+    def __init__(self, paths=None, columns=None):
+        self.table = FileTable({'until': 'd', **(columns or {})}, paths)
+
+    def __len__(self):
+        return len(self.table)
+
+    def add(self, path, until, **values):
+        self.table.add(path, until=until, **values)
+
+    def get(self, path, now):
+        """The values of path while it is remembered, else None; an expired path is forgotten on the spot."""
+        file_id = self.table.find(path)
+        if file_id is None:
+            return None
+        if self.table.columns['until'][file_id] < now:
+            self.table.remove(file_id)
+            return None
+        return {name: column[file_id] for name, column in self.table.columns.items()}
+
+    def active(self, path, now):
+        """True while path is remembered."""
+        return self.get(path, now) is not None
+
+    def forget(self, path):
+        file_id = self.table.find(path)
+        if file_id is not None:
+            self.table.remove(file_id)
+
+    def prune(self, now):
+        """Forget every expired path; returns how many were forgotten."""
+        until = self.table.columns['until']
+        expired = [file_id for file_id in self.table.ids() if until[file_id] < now]
+        for file_id in expired:
+            self.table.remove(file_id)
+        self.table.compact()
+        return len(expired)
@@ -0,0 +1,127 @@
+"""Per-share I/O concurrency limits that adapt to the latency the share shows.
+
+Every share (drive letter or UNC share on Windows, mount point elsewhere)
+gets its own AdaptiveLimiter. Reads, writes and renames against a share take
+a slot from its limiter. The number of slots is tuned AIMD style, like TCP
+congestion control: it grows by one after a full round of operations that
+all finished under the latency ceiling, and is halved when an operation
+takes longer. A busy share is therefore never flooded by the workers, and a
+fast one is not held back.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+from pdc_metrics import REGISTRY
+
+LATENCY_CEILING = 0.5  # Seconds one read, write or rename may take before the share is backed off
+INITIAL_CONCURRENCY = 2
+MAX_CONCURRENCY = 16
+SHARE_CACHE_SIZE = 4096  # Folders whose share is remembered
+
+concurrency_limit = REGISTRY.gauge('pdc_io_concurrency_limit', 'Concurrent I/O operations allowed per share',
+                                   ['share'])
+io_in_flight = REGISTRY.gauge('pdc_io_in_flight', 'I/O operations running per share', ['share'])
+io_seconds = REGISTRY.histogram('pdc_io_seconds', 'Seconds per I/O operation against a share', ['share', 'op'])
+
+
+def share_of(path):
+    """The share or mount a path lives on: the drive or UNC share on Windows, the mount point elsewhere."""
+    drive = os.path.splitdrive(os.path.abspath(path))[0]
+    if drive:
+        return drive.upper()
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+@lru_cache(maxsize=SHARE_CACHE_SIZE)
+def directory_share(directory):
+    """share_of for a folder, remembered, since resolving a mount point walks up the tree."""
+    return share_of(directory)
+
+
+class AdaptiveLimiter:
+    """A semaphore whose size follows additive increase / multiplicative decrease."""
+
+    def __init__(self, name, latency_ceiling=LATENCY_CEILING, initial=INITIAL_CONCURRENCY, maximum=MAX_CONCURRENCY):
+        self.name = name
+        self.latency_ceiling = latency_ceiling
+        self.maximum = maximum
+        self.limit = min(initial, maximum)
+        self.in_flight = 0
+        self.fast_operations = 0  # Operations under the ceiling since the limit last changed
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+        concurrency_limit.set(self.limit, share=name)
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+            io_in_flight.set(self.in_flight, share=self.name)
+
+    def release(self, latency):
+        with self.condition:
+            self.in_flight -= 1
+            io_in_flight.set(self.in_flight, share=self.name)
+            now = time.monotonic()
+            if latency > self.latency_ceiling:
+                # One slow round halves the limit once, not once per operation that was in it
+                if self.limit > 1 and now - self.last_decrease > self.latency_ceiling:
+                    self.limit = max(1, self.limit // 2)
+                    self.last_decrease = now
+                    logging.info(f"I/O on {self.name} took {latency:.2f} s; concurrency lowered to {self.limit}.")
+                self.fast_operations = 0
+            else:
+                self.fast_operations += 1
+                if self.fast_operations >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self.fast_operations = 0
+            concurrency_limit.set(self.limit, share=self.name)
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self, op):
+        self.acquire()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            latency = time.perf_counter() - start
+            io_seconds.observe(latency, share=self.name, op=op)
+            self.release(latency)
+
+
+class ShareLimits:
+    """One AdaptiveLimiter per share, created the first time a path on it is used."""
+
+    def __init__(self, latency_ceiling=LATENCY_CEILING, maximum=MAX_CONCURRENCY):
+        self.latency_ceiling = latency_ceiling
+        self.maximum = maximum
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def limiter(self, path):
+        share = directory_share(os.path.dirname(path))  # Outside the lock: it may stat the file system
+        with self.lock:
+            limiter = self.limiters.get(share)
+            if limiter is None:
+                limiter = self.limiters[share] = AdaptiveLimiter(share, self.latency_ceiling, maximum=self.maximum)
+            return limiter
+
+    def slot(self, path, op):
+        return self.limiter(path).slot(op)
+
+
+def group_folders(folders):
+    """The watched folders grouped by the share they are on."""
+    groups = {}
+    for folder in folders:
+        groups.setdefault(share_of(folder), []).append(folder)
+    return groups
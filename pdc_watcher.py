@@ -0,0 +1,863 @@
+"""Watcher engine for the beamline and angle master rules.
+
+Replaces the read-modify-write-per-processor loop of pdcCodeFinal.py with a
+staged pipeline: every event is held until the file stops changing (settle),
+queued for a worker, read once, transformed with pdc_rules, written to a
+temporary file and renamed into place. When a job export drops many files
+into one folder at once, the folder switches to burst mode: its events are
+only noted, and once the folder is quiet it is listed once and the new files
+are processed as a batch. A folder that never goes quiet has the files that
+have settled swept every BURST_MAX_SECONDS. Each stage is timed and counted in
+pdc_metrics, and failures are logged and counted by type instead of being
+swallowed, and retried with backoff through pdc_retry. Every attempt is
+recorded in the journal (pdc_journal), which pdc_journal.py queries.
+
+One process serves every folder. Each folder has a machine profile (BL, AM,
+both, or a custom list of rule stages) in watcher_settings.json, and a file
+only goes through the stages its folder's profile asks for, in one read.
+Without "folders" there, every folder in folders_settings.txt gets both, as
+in pdcCodeFinal.py:
+
+    {"profiles": {"saw": ["nc1_bl"]},
+     "folders": [{"path": "N:/Beamline", "profile": "BL"},
+                 {"path": "N:/Beamline/Angles", "profile": "AM"},
+                 {"path": "N:/Saw", "profile": "saw"}]}
+
+A folder inside another watched folder takes its files from the outer one's
+observer, so no file is seen twice.
+
+A folder with "outputs" is left as it is: each file is read once and one
+variant per machine profile is written into that profile's output folder,
+under the same relative path:
+
+    {"path": "N:/Exports", "outputs": {"BL": "N:/Beamline", "AM": "N:/AngleMaster"}}
+
+    python pdc_watcher.py            # watch the folders
+    python pdc_watcher.py --batch    # process what is already in them and exit
+    python pdc_watcher.py --engine async   # overlap share round trips with the rules, see pdc_async.py
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+
+import pdc_rules
+from pdc_cache import CACHE_MAX_BYTES, ResultCache, content_hash
+from pdc_journal import JOURNAL_DIR
+from pdc_metrics import METRICS_PORT, REGISTRY, SnapshotWriter, start_metrics_server
+from pdc_retry import RETRY_DB_FILE, RETRY_POLL_SECONDS, RetryStore
+from pdc_scheduler import WATCHER_SETTINGS_FILE, PriorityScheduler, PrioritySettings, queue_wait
+from pdc_state import ExpiringPaths, FileTable
+
+FOLDERS_SETTINGS_FILE = 'folders_settings.txt'
+LOG_FILE = 'pdc_watcher.log'
+METRICS_SNAPSHOT_FILE = 'pdc_metrics.json'
+PROFILE_DIR = 'profiles'
+WATCHED_EXTENSIONS = ('.nc1', '.idstv')
+TEMP_SUFFIX = '.pdctmp'
+SETTLE_SECONDS = 1.0  # A file must stop changing for this long before it is processed
+WORKERS = 2
+SELF_WRITE_SECONDS = 10  # Events for files the engine wrote itself are ignored for this long, while unchanged
+BURST_EVENTS = 20  # This many events in one folder within BURST_WINDOW seconds start a burst
+BURST_WINDOW = 2.0
+BURST_MAX_SECONDS = 5.0  # A folder that never goes quiet has its settled files swept at least this often
+PRUNE_SECONDS = 60  # How often finished entries are dropped from the per-file state
+ROUTER_CACHE_MAX = 10000  # Directories whose folder is remembered before the router starts over
+STOP_SECONDS = 30  # How long stop() waits for the workers to finish the files they have
+
+events_received = REGISTRY.counter('pdc_events_received_total', 'File system events received', ['kind', 'event'])
+files_processed = REGISTRY.counter('pdc_files_processed_total', 'Files processed', ['kind', 'job'])
+bytes_read = REGISTRY.counter('pdc_bytes_read_total', 'Bytes read from processed files', ['kind'])
+bytes_written = REGISTRY.counter('pdc_bytes_written_total', 'Bytes written to processed files', ['kind'])
+stage_seconds = REGISTRY.histogram('pdc_stage_seconds', 'Seconds spent in each processing stage', ['stage', 'kind'])
+errors = REGISTRY.counter('pdc_errors_total', 'Processing errors', ['stage', 'type'])
+queue_depth = REGISTRY.gauge('pdc_queue_depth', 'Settled files waiting for a worker')
+pending_files = REGISTRY.gauge('pdc_pending_files', 'Files waiting to settle')
+bursts_detected = REGISTRY.counter('pdc_bursts_total', 'Folders switched to a batch sweep after an event burst')
+burst_files = REGISTRY.counter('pdc_burst_files_total', 'Files processed through a burst sweep', ['kind'])
+
+
+def file_kind(path):
+    return os.path.splitext(path)[1].lstrip('.').lower()
+
+
+def read_folders(settings_path=FOLDERS_SETTINGS_FILE):
+    with open(settings_path, 'r') as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+# outputs: (profile, output folder, stages) for each variant of a fan-out folder, () to edit in place
+WatchedFolder = namedtuple('WatchedFolder', ['path', 'profile', 'stages', 'outputs'], defaults=[()])
+
+
+def read_watched_folders(watcher_settings=WATCHER_SETTINGS_FILE, folders_settings=FOLDERS_SETTINGS_FILE):
+    """The folders to watch with their profiles, from watcher_settings.json or else folders_settings.txt."""
+    settings = {}
+    if os.path.exists(watcher_settings):
+        with open(watcher_settings, 'r') as file:
+            settings = json.load(file)
+    if not settings.get('folders'):
+        return [WatchedFolder(folder, 'both', pdc_rules.PROFILES['both']) for folder in read_folders(folders_settings)]
+    profiles = dict(pdc_rules.PROFILES)
+    for name, stages in settings.get('profiles', {}).items():
+        unknown = set(stages) - set(pdc_rules.STAGES)
+        if unknown:
+            raise ValueError(f"Profile {name} has unknown stages {', '.join(sorted(unknown))}; "
+                             f"choose from {', '.join(pdc_rules.STAGES)}")
+        profiles[name] = tuple(stages)
+    folders = []
+    for entry in settings['folders']:
+        profile = entry.get('profile', 'both')
+        outputs = entry.get('outputs', {})
+        for name in [profile] + list(outputs):
+            if name not in profiles:
+                raise ValueError(f"Folder {entry['path']} has unknown profile {name}")
+        folders.append(WatchedFolder(entry['path'], profile, profiles[profile],
+                                     tuple((name, path, profiles[name]) for name, path in outputs.items())))
+    return folders
+
+
+class FolderRouter:
+    """Finds the watched folder a file belongs to; a nested folder wins over the folders around it."""
+
+    def __init__(self, folders):
+        self.folders = sorted(folders, key=lambda folder: len(self.normalize(folder.path)), reverse=True)
+        self.directories = {}  # directory -> WatchedFolder (or None), so each folder is matched once
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize(path):
+        return os.path.normcase(os.path.abspath(path))
+
+    def route(self, path):
+        directory = os.path.dirname(path)
+        with self.lock:
+            if directory in self.directories:
+                return self.directories[directory]
+        normalized = self.normalize(directory)
+        found = None
+        for folder in self.folders:
+            folder_path = self.normalize(folder.path)
+            if normalized == folder_path or normalized.startswith(folder_path.rstrip(os.sep) + os.sep):
+                found = folder
+                break
+        with self.lock:
+            if len(self.directories) >= ROUTER_CACHE_MAX:
+                self.directories.clear()
+            self.directories[directory] = found
+        return found
+
+    def observed(self):
+        """The folders that need an observer: those not inside another watched folder."""
+        paths = [self.normalize(folder.path) for folder in self.folders]
+        return [folder for folder, path in zip(self.folders, paths)
+                if not any(path.startswith(other.rstrip(os.sep) + os.sep) for other in paths if other != path)]
+
+
+class FileTask:
+    """One file on its way through the pipeline."""
+
+    __slots__ = ('path', 'root', 'kind', 'stages', 'outputs', 'event_time', 'settled_time', 'size', 'priority',
+                 'error', 'timings')
+
+    def __init__(self, path, root, event_time=None, stages=pdc_rules.STAGES):
+        self.path = path
+        self.root = root
+        self.kind = file_kind(path)
+        self.stages = pdc_rules.stages_for(self.kind, stages)  # The rule stages this file goes through
+        self.outputs = ()  # Set for files of a fan-out folder, see WatchedFolder
+        self.event_time = event_time if event_time is not None else time.monotonic()
+        self.settled_time = None
+        self.size = None  # Bytes when settled, used by the scheduler
+        self.priority = None  # Set by the scheduler: 'on_floor', 'small' or 'large'
+        self.error = None  # (stage, exception) of the last failed attempt
+        self.timings = {}  # stage -> seconds of the last attempt, for the journal
+
+    @property
+    def job(self):
+        """The job folder (first folder below the watched root), used to label metrics."""
+        relative = os.path.relpath(self.path, self.root)
+        head = relative.replace('\\', '/').split('/')[0]
+        return head if head != relative else os.path.basename(self.root)
+
+
+class Burst:
+    """A folder receiving a job drop: new file names are collected until the folder is quiet."""
+
+    __slots__ = ('root', 'first_event', 'last_event', 'names')
+
+    def __init__(self, root, now):
+        self.root = root
+        self.first_event = now
+        self.last_event = now
+        self.names = {}  # name -> time of its last event
+
+    def split_quiet(self, now, settle_seconds):
+        """Take the files without events for settle_seconds out of this burst, as a burst of their own."""
+        quiet = Burst(self.root, self.first_event)
+        quiet.names = {name: moment for name, moment in self.names.items() if now - moment >= settle_seconds}
+        for name in quiet.names:
+            del self.names[name]
+        self.first_event = now
+        return quiet
+
+
+class Pipeline:
+    """Read, transform, write and rename a single file, timing each stage."""
+
+    # pdc_async runs begin, read, plan, write, rename and done itself instead of calling process();
+    # a subclass that needs its own process() sets this to False
+    async_capable = True
+
+    def __init__(self, io_limits=None, cache=None, archive=None, journal=None):
+        # Paths we wrote, with the size and mtime we left them with; their events are ignored for a while
+        self.recently_written = ExpiringPaths(columns={'size': 'q', 'mtime_ns': 'q'})
+        self.lock = threading.Lock()
+        self.io_limits = io_limits  # pdc_throttle.ShareLimits, or None for no limit
+        self.cache = cache  # pdc_cache.ResultCache, or None to always run the rules
+        self.archive = archive  # pdc_archive.Archive to keep originals before they are replaced, or None
+        self.journal = journal  # pdc_journal.Journal recording every attempt, or None
+        self.processes = None  # Executor running the .idstv rules in other processes (see pdc_async), or None
+
+    def io(self, path, op):
+        """Hold a slot on the share of path while doing I/O on it, when limits are on."""
+        if self.io_limits is None:
+            return nullcontext()
+        return self.io_limits.slot(path, op)
+
+    @contextmanager
+    def stage(self, name, task):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            errors.inc(stage=name, type=type(e).__name__)
+            task.error = (name, e)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            task.timings[name] = elapsed
+            stage_seconds.observe(elapsed, stage=name, kind=task.kind)
+
+    def mark_written(self, path, size, mtime_ns):
+        """Note that path is about to become our file of size and mtime_ns (those of the file renamed onto it)."""
+        with self.lock:
+            self.recently_written.add(path, time.monotonic() + SELF_WRITE_SECONDS, size=size, mtime_ns=mtime_ns)
+
+    def written_by_us(self, path):
+        """True when path is a file we wrote recently and it is still as we left it.
+
+        A file exported again to the same path has another size or mtime, so it is
+        processed even within SELF_WRITE_SECONDS of our write.
+        """
+        with self.lock:
+            written = self.recently_written.get(path, time.monotonic())
+        if written is None:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        if stat is not None and (stat.st_size, stat.st_mtime_ns) == (written['size'], written['mtime_ns']):
+            return True
+        with self.lock:
+            self.recently_written.forget(path)
+        return False
+
+    def prune(self):
+        """Forget the written files whose events no longer need ignoring."""
+        with self.lock:
+            self.recently_written.prune(time.monotonic())
+
+    def read(self, task):
+        with self.io(task.path, 'read'):
+            source = pdc_rules.SourceFile(task.path)
+        bytes_read.inc(len(source), kind=task.kind)
+        return source
+
+    def cached_rewrite(self, digest, task, variant, data, compute):
+        """compute() the Rewrite of data, or take it from the result cache when there is one."""
+        if self.cache is None:
+            return compute()
+        return self.cache.cached(digest, task.kind, variant, data, compute)
+
+    def rewrite_idstv(self, data, stages):
+        """pdc_rules.rewrite_idstv, in the process pool when there is one."""
+        if self.processes is None:
+            return pdc_rules.rewrite_idstv(data, stages)
+        edits, content = self.processes.submit(pdc_rules.rewrite_idstv_detached, bytes(data), stages).result()
+        return pdc_rules.Rewrite(data, edits, content)
+
+    def transform(self, task, data):
+        """Return (target path, Rewrite); the Rewrite is None when nothing changes."""
+        digest = None if self.cache is None else content_hash(data)
+        filename = os.path.basename(task.path)
+        if task.kind == 'nc1':
+            # The output depends on the file name only through whether it is renamed
+            target_name = pdc_rules.nc1_target_name(filename)
+            rewrite = self.cached_rewrite(digest, task, (task.stages, target_name != filename), data,
+                                          lambda: pdc_rules.rewrite_nc1(filename, data)[1])
+            target = os.path.join(os.path.dirname(task.path), target_name)
+        else:
+            rewrite = self.cached_rewrite(digest, task, task.stages, data,
+                                          lambda: self.rewrite_idstv(data, task.stages))
+            target = task.path
+        if target == task.path and not rewrite.changed:
+            return target, None
+        return target, rewrite
+
+    def transform_outputs(self, task, data):
+        """Return [(target path, Rewrite)] with one variant per output folder of a fan-out task."""
+        filename = os.path.basename(task.path)
+        stage_sets = [stages for _, _, stages in task.outputs]
+        digest = None if self.cache is None else content_hash(data)
+        variants = {}
+
+        def compute(stages):
+            # All variants are worked out together on the first miss, so they can share results
+            if not variants:
+                variants.update(pdc_rules.rewrite_variants(filename, data, stage_sets))
+            return variants[stages][1]
+
+        relative = os.path.relpath(os.path.dirname(task.path), task.root)
+        writes = []
+        for _, output_dir, stages in task.outputs:
+            target_name = filename
+            if task.kind == 'nc1' and 'nc1_bl' in stages:
+                target_name = pdc_rules.nc1_target_name(filename)
+            variant = (stages, target_name != filename) if task.kind == 'nc1' else stages
+            rewrite = self.cached_rewrite(digest, task, variant, data, lambda: compute(stages))
+            writes.append((os.path.normpath(os.path.join(output_dir, relative, target_name)), rewrite))
+        return writes
+
+    def plan(self, task, data):
+        """Return the [(target path, Rewrite)] to write for task; empty when the file stays as it is."""
+        if task.outputs:
+            return self.transform_outputs(task, data)
+        target, rewrite = self.transform(task, data)
+        return [] if rewrite is None else [(target, rewrite)]
+
+    def write(self, task, rewrite, target):
+        temp_path = target + TEMP_SUFFIX
+        if task.outputs:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+        with self.io(temp_path, 'write'), open(temp_path, 'wb') as file:
+            rewrite.write_to(file)
+        bytes_written.inc(rewrite.size(), kind=task.kind)
+        return temp_path
+
+    def rename(self, task, temp_path, target):
+        with self.io(target, 'rename'):
+            stat = os.stat(temp_path)  # A rename keeps size and mtime, so this is what the target will look like
+            self.mark_written(target, stat.st_size, stat.st_mtime_ns)
+            os.replace(temp_path, target)
+            if target != task.path and not task.outputs:
+                os.remove(task.path)
+
+    def begin(self, task):
+        """Start an attempt at task: note how long it waited in the queue and clear the last attempt."""
+        task.timings = {}
+        task.error = None
+        if task.settled_time is not None:
+            waited = time.monotonic() - task.settled_time
+            stage_seconds.observe(waited, stage='queue', kind=task.kind)
+            queue_wait.observe(waited, priority=task.priority)
+            task.timings['queue'] = waited
+
+    def process(self, task):
+        """Run one file through every stage; returns True when it was processed without error."""
+        self.begin(task)
+        source = None
+        bytes_in = bytes_out = None
+        targets = ()
+        try:
+            with self.stage('read', task):
+                source = self.read(task)
+            bytes_in = len(source)
+            with self.stage('transform', task):
+                writes = self.plan(task, source.data)
+            if writes:
+                targets = [target for target, _ in writes]
+                bytes_out = sum(rewrite.size() for _, rewrite in writes)
+                if self.archive is not None and not task.outputs:
+                    with self.stage('archive', task):
+                        self.archive.snapshot(task.path, task.job, source.data, targets)
+                with self.stage('write', task):
+                    renames = [(self.write(task, rewrite, target), target) for target, rewrite in writes]
+                    del writes
+                source.close()  # The source may be memory-mapped and must be closed before it is replaced
+                with self.stage('rename', task):
+                    for temp_path, target in renames:
+                        self.rename(task, temp_path, target)
+        except FileNotFoundError:
+            return self.gone(task)
+        except Exception as e:
+            return self.failed(task, e, bytes_in, bytes_out, targets)
+        finally:
+            if source is not None:
+                source.close()
+        return self.done(task, bytes_in, bytes_out, targets)
+
+    def gone(self, task):
+        logging.info(f"{task.path} disappeared before it could be processed.")
+        task.error = None
+        self.log_journal(task, 'gone')
+        return False
+
+    def failed(self, task, error, bytes_in=None, bytes_out=None, targets=()):
+        logging.error(f"Error processing {task.path}: {type(error).__name__}: {error}")
+        if task.error is None:
+            task.error = ('process', error)
+        self.log_journal(task, 'failed', bytes_in, bytes_out, targets)
+        return False
+
+    def done(self, task, bytes_in, bytes_out, targets):
+        self.log_journal(task, 'processed' if targets else 'unchanged', bytes_in, bytes_out, targets)
+        files_processed.inc(kind=task.kind, job=task.job)
+        stage_seconds.observe(time.monotonic() - task.event_time, stage='total', kind=task.kind)
+        if task.outputs:
+            logging.info(f"Processed {task.path} -> {', '.join(name for name, _, _ in task.outputs)}")
+        elif targets and targets[0] != task.path:
+            logging.info(f"Processed {task.path} -> {os.path.basename(targets[0])}")
+        else:
+            logging.info(f"Processed {task.path}")
+        return True
+
+    def log_journal(self, task, outcome, bytes_in=None, bytes_out=None, targets=()):
+        if self.journal is not None:
+            self.journal.record(task, outcome, bytes_in, bytes_out, targets, task.error)
+
+    def flush(self):
+        """Wait for writes still in flight; results are written synchronously here, see pdc_staging."""
+
+
+class WatchEngine:
+    """Holds events until files settle and feeds them to a pool of worker threads."""
+
+    def __init__(self, pipeline=None, workers=WORKERS, settle_seconds=SETTLE_SECONDS, profiler=None, retries=None,
+                 priority_settings=None, router=None):
+        self.pipeline = pipeline or Pipeline()
+        self.profiler = profiler  # See pdc_profiling; None keeps profiling out of the worker loop
+        self.retries = retries  # pdc_retry.RetryStore, or None to only log failures
+        self.router = router  # FolderRouter giving each file its folder's profile; None runs every stage
+        self.next_retry_poll = 0.0
+        self.settle_seconds = settle_seconds
+        self.workers = workers
+        self.next_prune = time.monotonic() + PRUNE_SECONDS
+        # Files waiting to settle: the watched root, first event, and last size, mtime and change time seen
+        self.pending = FileTable({'root': 'l', 'event_time': 'd', 'size': 'q', 'mtime': 'd', 'changed': 'd'},
+                                 directory_columns=['root'])
+        self.pending_lock = threading.Lock()
+        self.event_rates = {}  # directory -> [window start, events in window]
+        self.bursts = {}  # directory -> Burst
+        self.queue = PriorityScheduler(priority_settings)
+        self.stopped = threading.Event()
+        self.threads = [threading.Thread(target=self.settle_loop, name='settle', daemon=True)]
+        self.threads += [threading.Thread(target=self.worker_loop, name=f'worker-{i}', daemon=True)
+                         for i in range(workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self, timeout=STOP_SECONDS):
+        self.stopped.set()
+        for _ in self.threads:
+            self.queue.put(None)
+        # Workers may still be finishing a file, whose results go to the journal and the profiler below
+        deadline = time.monotonic() + timeout
+        for thread in self.threads:
+            if thread.is_alive():
+                thread.join(max(0.0, deadline - time.monotonic()))
+                if thread.is_alive():
+                    logging.warning(f"Thread {thread.name} did not stop within {timeout} seconds.")
+        self.pipeline.flush()
+        if self.profiler is not None:
+            self.profiler.close()
+
+    def make_task(self, path, root, event_time=None):
+        """A FileTask with the stages of its folder's profile, or None when the profile leaves the file alone."""
+        stages = pdc_rules.STAGES
+        folder = None
+        if self.router is not None:
+            folder = self.router.route(path)
+            if folder is not None:
+                root, stages = folder.path, folder.stages
+        task = FileTask(path, root, event_time, stages)
+        if folder is not None and folder.outputs:
+            task.outputs = folder.outputs
+        return task if task.stages or task.outputs else None
+
+    def notify(self, path, root, event='created'):
+        """Record an event; the file is processed once it has settled."""
+        if not path.endswith(WATCHED_EXTENSIONS) or self.pipeline.written_by_us(path):
+            return
+        task = self.make_task(path, root)
+        if task is None:
+            return
+        events_received.inc(kind=file_kind(path), event=event)
+        now = time.monotonic()
+        directory, name = os.path.split(path)
+        with self.pending_lock:
+            burst = self.bursts.get(directory) or self.detect_burst(directory, root, now)
+            if burst is not None:
+                burst.last_event = now
+                if event != 'modified' or name in burst.names:
+                    burst.names[name] = now
+                return
+            file_id = self.pending.find(path)
+            if file_id is not None:
+                self.pending.set(file_id, 'changed', now)
+            elif event != 'modified':  # Only new files are processed, as in pdcCodeFinal
+                self.pending.add(path, root=root, event_time=now, changed=now)
+            pending_files.set(len(self.pending))
+
+    def detect_burst(self, directory, root, now):
+        """Count an event for directory; start a burst when the rate passes BURST_EVENTS per BURST_WINDOW.
+
+        Files of the folder that are already waiting to settle move into the burst.
+        Called with pending_lock held.
+        """
+        rate = self.event_rates.get(directory)
+        if rate is None or now - rate[0] > BURST_WINDOW:
+            self.event_rates[directory] = [now, 1]
+            return None
+        rate[1] += 1
+        if rate[1] < BURST_EVENTS:
+            return None
+        del self.event_rates[directory]
+        burst = self.bursts[directory] = Burst(root, rate[0])
+        for file_id in self.pending.ids_beside(os.path.join(directory, '')):
+            burst.names[self.pending.name[file_id]] = now
+            self.pending.remove(file_id)
+        bursts_detected.inc()
+        logging.info(f"Event burst in {directory}; processing it as a batch once it settles.")
+        return burst
+
+    def sweep(self, directory, burst):
+        """List a settled burst folder once and queue its new files in one batch per worker."""
+        tasks = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name in burst.names and entry.is_file():
+                        task = self.make_task(entry.path, burst.root, burst.first_event)
+                        if task is None:
+                            continue
+                        task.size = entry.stat().st_size  # Free on Windows, where scandir returns it
+                        tasks.append(task)
+        except OSError as e:
+            errors.inc(stage='sweep', type=type(e).__name__)
+            logging.error(f"Cannot list {directory}: {e}")
+            return
+        logging.info(f"Burst in {directory} settled: {len(tasks)} files.")
+        tasks.sort(key=lambda task: task.size)
+        for i in range(self.workers):
+            batch = tasks[i::self.workers]
+            if batch:
+                self.enqueue(batch)
+
+    def settle_loop(self):
+        while not self.stopped.wait(self.settle_seconds / 4):
+            self.queue.settings.refresh()  # Here rather than in put(), which holds the queue's lock
+            now = time.monotonic()
+            with self.pending_lock:
+                paths = [self.pending.path(file_id) for file_id in self.pending.ids()]
+            for path in paths:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    stat = None
+                task = None
+                with self.pending_lock:
+                    file_id = self.pending.find(path)  # Looked up again: it may have moved into a burst
+                    if file_id is None:
+                        continue
+                    columns = self.pending.columns
+                    if stat is None:
+                        self.pending.remove(file_id)
+                    elif (stat.st_size, stat.st_mtime) != (columns['size'][file_id], columns['mtime'][file_id]):
+                        columns['size'][file_id], columns['mtime'][file_id] = stat.st_size, stat.st_mtime
+                        columns['changed'][file_id] = now
+                    elif now - columns['changed'][file_id] >= self.settle_seconds:
+                        root = self.pending.paths.directories[columns['root'][file_id]]
+                        event_time, size = columns['event_time'][file_id], stat.st_size
+                        self.pending.remove(file_id)
+                        task = self.make_task(path, root, event_time)
+                if task is not None:
+                    task.size = size
+                    self.enqueue(task)
+            with self.pending_lock:
+                settled = [(directory, burst) for directory, burst in self.bursts.items()
+                           if now - burst.last_event >= self.settle_seconds]
+                for directory, _ in settled:
+                    del self.bursts[directory]
+                # Under steady traffic a folder never goes quiet; sweep what has settled so far
+                settled += [(directory, burst.split_quiet(now, self.settle_seconds))
+                            for directory, burst in self.bursts.items()
+                            if now - burst.first_event >= BURST_MAX_SECONDS]
+                for directory, rate in list(self.event_rates.items()):
+                    if now - rate[0] > BURST_WINDOW:
+                        del self.event_rates[directory]
+            for directory, burst in settled:
+                if burst.names:
+                    self.sweep(directory, burst)
+            if self.retries is not None and now >= self.next_retry_poll:
+                self.next_retry_poll = now + RETRY_POLL_SECONDS
+                self.enqueue_retries()
+            if now >= self.next_prune:
+                self.next_prune = now + PRUNE_SECONDS
+                self.prune()
+            pending_files.set(len(self.pending))
+
+    def prune(self):
+        """Drop per-file state that is no longer needed, so a long-running watcher stays the same size."""
+        self.pipeline.prune()
+        with self.pending_lock:
+            self.pending.compact()
+
+    def enqueue_retries(self):
+        for path, root in self.retries.claim_due():
+            task = self.make_task(path, root)
+            if task is not None and os.path.exists(path):
+                self.enqueue(task)
+            else:
+                self.retries.succeeded(path)  # Gone, or already renamed by an earlier attempt
+
+    def enqueue(self, task):
+        """Queue a FileTask, or a list of them that one worker processes in turn."""
+        settled_time = time.monotonic()
+        for file_task in task if isinstance(task, list) else [task]:
+            file_task.settled_time = settled_time
+            stage_seconds.observe(settled_time - file_task.event_time, stage='settle', kind=file_task.kind)
+        self.queue.put(task)
+        queue_depth.set(self.queue.qsize())
+
+    def worker_loop(self):
+        while True:
+            task = self.queue.get()
+            queue_depth.set(self.queue.qsize())
+            try:
+                if task is None:
+                    return
+                if isinstance(task, list):
+                    for file_task in task:
+                        if self.run_task(file_task):
+                            burst_files.inc(kind=file_task.kind)
+                else:
+                    self.run_task(task)
+            finally:
+                self.queue.task_done()
+
+    def run_task(self, task):
+        if self.profiler is None:
+            processed = self.pipeline.process(task)
+        else:
+            processed = self.profiler.run(task.path, self.pipeline.process, task)
+        if self.retries is not None:
+            if processed:
+                self.retries.succeeded(task.path)
+            elif task.error is not None:
+                self.retries.failed(task, *task.error)
+        return processed
+
+    def run_tasks(self, tasks):
+        """Queue tasks and wait until all are processed; failures are left to the retry queue."""
+        for task in tasks:
+            self.enqueue(task)
+        self.queue.join()
+        self.pipeline.flush()
+        return len(tasks)
+
+    def run_batch(self, folders):
+        """Process every watched file already in folders."""
+        tasks = []
+        for root in folders:
+            directories = [root]
+            while directories:
+                with os.scandir(directories.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            directories.append(entry.path)
+                        elif entry.name.endswith(WATCHED_EXTENSIONS):
+                            task = self.make_task(entry.path, root)
+                            if task is not None:
+                                task.size = entry.stat().st_size
+                                tasks.append(task)
+        return self.run_tasks(tasks)
+
+
+def make_event_handler(engine, root):
+    from watchdog.events import FileSystemEventHandler
+
+    class EngineEventHandler(FileSystemEventHandler):
+        def on_created(self, event):
+            if not event.is_directory:
+                engine.notify(event.src_path, root, 'created')
+
+        def on_modified(self, event):
+            if not event.is_directory:
+                engine.notify(event.src_path, root, 'modified')
+
+        def on_moved(self, event):
+            if not event.is_directory:
+                engine.notify(event.dest_path, root, 'moved')
+
+    return EngineEventHandler()
+
+
+def add_engine_arguments(parser):
+    """The options that decide how files are processed, shared with pdc_retry.py's replay --run."""
+    parser.add_argument('--settings', default=FOLDERS_SETTINGS_FILE, help='file listing the folders to watch')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--engine', choices=['thread', 'async'], default='thread',
+                        help='worker threads, or an asyncio loop that reads ahead (see pdc_async.py)')
+    parser.add_argument('--io-workers', type=int, help='threads for file I/O with --engine async')
+    parser.add_argument('--prefetch', type=int, help='files read ahead with --engine async')
+    parser.add_argument('--stage-dir', help='local cache directory; files are processed there and pushed back')
+    parser.add_argument('--io-ceiling', type=float, metavar='SECONDS',
+                        help='limit concurrent I/O per share, backing off when one operation takes longer')
+    parser.add_argument('--io-max', type=int, default=16, help='most concurrent I/O operations per share')
+    parser.add_argument('--cache-dir', help='keep results by input hash here and reuse them for repeat inputs')
+    parser.add_argument('--cache-max-mb', type=int, default=CACHE_MAX_BYTES // (1024 * 1024))
+    parser.add_argument('--archive-dir', help='archive originals here before changing them (see pdc_archive.py)')
+    parser.add_argument('--journal-dir', default=JOURNAL_DIR, help='journal of processed files (see pdc_journal.py)')
+    parser.add_argument('--no-journal', action='store_true', help='keep no journal')
+    parser.add_argument('--watcher-settings', default=WATCHER_SETTINGS_FILE,
+                        help='folder profiles, jobs on the floor and queue weights')
+
+
+def load_router(args):
+    """A FolderRouter over the watched folders that can be reached, or None when the settings cannot be read."""
+    try:
+        watched = read_watched_folders(args.watcher_settings, args.settings)
+    except FileNotFoundError:
+        logging.error(f"File {args.settings} not found.")
+        return None
+    except ValueError as e:
+        logging.error(f"Invalid {args.watcher_settings}: {e}")
+        return None
+    for folder in list(watched):
+        if not os.path.exists(folder.path):
+            logging.error(f"Cannot access path: {folder.path}")
+            watched.remove(folder)
+        else:
+            logging.info(f"{folder.path}: profile {folder.profile} ({', '.join(folder.stages)})")
+    return FolderRouter(watched)
+
+
+def build_engine(args, router, retries, settle_seconds=SETTLE_SECONDS, profiler=None):
+    """The Pipeline and engine the add_engine_arguments options ask for; start() it before use.
+
+    Raises ValueError for combinations the engine cannot run, such as --stage-dir with --engine async.
+    """
+    if args.engine == 'async' and (args.stage_dir or profiler is not None):
+        raise ValueError('--stage-dir and the profilers need --engine thread')
+    io_limits = None
+    if args.io_ceiling:
+        from pdc_throttle import ShareLimits, group_folders
+        io_limits = ShareLimits(args.io_ceiling, args.io_max)
+        for share, share_folders in group_folders([folder.path for folder in router.observed()]).items():
+            logging.info(f"Share {share}: {', '.join(share_folders)}")
+    cache = None
+    if args.cache_dir:
+        cache = ResultCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
+    archive = None
+    if args.archive_dir:
+        from pdc_archive import Archive
+        archive = Archive(args.archive_dir)
+    journal = None
+    if not args.no_journal:
+        from pdc_journal import Journal
+        journal = Journal(args.journal_dir)
+        journal.start()
+    if args.stage_dir:
+        from pdc_staging import StagingPipeline
+        pipeline = StagingPipeline(args.stage_dir, io_limits=io_limits, cache=cache, archive=archive, journal=journal)
+    else:
+        pipeline = Pipeline(io_limits, cache, archive, journal)
+
+    engine_class, engine_options = WatchEngine, {}
+    if args.engine == 'async':
+        from pdc_async import AsyncEngine
+        engine_class = AsyncEngine
+        engine_options = {name: value for name, value in [('io_workers', args.io_workers),
+                                                          ('prefetch', args.prefetch)] if value is not None}
+    return engine_class(pipeline, workers=args.workers, settle_seconds=settle_seconds, profiler=profiler,
+                        retries=retries, priority_settings=PrioritySettings(args.watcher_settings), router=router,
+                        **engine_options)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch', action='store_true', help='process the files already in the folders and exit')
+    add_engine_arguments(parser)
+    parser.add_argument('--settle', type=float, default=SETTLE_SECONDS, help='seconds a file must be unchanged')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT, help='0 disables the metrics endpoint')
+    parser.add_argument('--snapshot', default=METRICS_SNAPSHOT_FILE, help='JSON metrics snapshot file')
+    parser.add_argument('--profile-files', type=int, metavar='N', help='cProfile the first N files')
+    parser.add_argument('--profile-slow', type=float, metavar='SECONDS',
+                        help='sample files that take longer than SECONDS and keep their stacks')
+    parser.add_argument('--profile-dir', default=PROFILE_DIR, help='where profiles are written')
+    parser.add_argument('--retry-db', default=RETRY_DB_FILE, help='retry queue and dead letters (see pdc_retry.py)')
+    args = parser.parse_args(argv)
+    if args.engine == 'async' and (args.stage_dir or args.profile_files or args.profile_slow is not None):
+        parser.error('--stage-dir and the profilers need --engine thread')
+
+    logging.basicConfig(level=logging.INFO, filename=LOG_FILE, filemode='a',
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    router = load_router(args)
+    if router is None:
+        return
+    folders = [folder.path for folder in router.observed()]
+
+    snapshot_writer = SnapshotWriter(args.snapshot, rate_counters=[
+        'pdc_files_processed_total', 'pdc_bytes_read_total', 'pdc_bytes_written_total'])
+    snapshot_writer.start()
+    if args.metrics_port:
+        start_metrics_server(port=args.metrics_port)
+
+    profiler = None
+    if args.profile_files:
+        from pdc_profiling import CProfileRecorder
+        profiler = CProfileRecorder(args.profile_dir, args.profile_files)
+    elif args.profile_slow is not None:
+        from pdc_profiling import SlowFileSampler
+        profiler = SlowFileSampler(args.profile_dir, args.profile_slow)
+
+    engine = build_engine(args, router, RetryStore(args.retry_db), args.settle, profiler)
+    journal = engine.pipeline.journal
+    engine.start()
+    if args.batch:
+        count = engine.run_batch(folders)
+        logging.info(f"Batch finished: {count} files.")
+        engine.stop()
+        snapshot_writer.stop()
+        if journal is not None:
+            journal.close()
+        return
+
+    from watchdog.observers import Observer
+    observer = Observer()
+    for folder in folders:
+        observer.schedule(make_event_handler(engine, folder), folder, recursive=True)
+    observer.start()
+    logging.info(f"Monitoring started on folders: {', '.join(folders)}.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        observer.stop()
+        engine.stop()
+        snapshot_writer.stop()
+        if journal is not None:
+            journal.close()
+    observer.join()
+
+
+if __name__ == "__main__":
+    main()
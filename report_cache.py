@@ -0,0 +1,177 @@
+"""Binary column cache of production XMLs for the production report.
+
+Reports are built again and again from the same archived production XML,
+with other shift settings or for other dates, and parsing the XML and its
+timestamps is most of the work. The first run therefore also stores what
+the report reads from each PartReport as columns in a small binary file:
+start and finish (microseconds since 1970, as written in the XML), the
+production time in seconds, and the part names as one UTF-8 block with the
+offset where each one ends. Later runs map that file into memory and read
+the columns where they lie, without parsing anything.
+
+A cache file is named after the XML's path and records the XML's size and
+modification time; when either has changed, the XML is parsed again and
+the file rewritten. XMLs whose timestamps carry a time zone or are not in
+the plain YYYY-MM-DDTHH:MM:SS form are never cached, since their rows could
+not be rebuilt to the character.
+
+Only the standard library is used (array, mmap, struct).
+
+    python pdc_report.py archive/2024-05.xml --formats csv
+    python pdc_report.py archive/2024-05.xml --cache-dir D:/report_cache
+"""
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+from array import array
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+REPORT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.pdc_report_cache')
+CACHE_SUFFIX = '.parts'
+MAGIC = b'PDCPARTS'
+FORMAT_VERSION = 1
+BYTE_ORDER_MARK = 0x01020304  # Reads back differently on a machine of the other byte order
+# magic, format version, byte order mark, parts, XML size, XML mtime in ns, bytes of part names
+HEADER = struct.Struct('=8sIIqqqq')
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+NAME_MISSING = 1  # Flag for a PartReport without PartName text
+
+# What the report needs from one PartReport; created and finished are the timestamps as written
+PartRecord = namedtuple('PartRecord', ['part_name', 'created', 'start', 'finished', 'finish', 'production_seconds'])
+
+
+def cache_path(xml_file_path, cache_dir):
+    key = hashlib.blake2b(os.path.normcase(os.path.abspath(xml_file_path)).encode('utf-8'), digest_size=16)
+    return os.path.join(cache_dir, key.hexdigest() + CACHE_SUFFIX)
+
+
+class PartColumns:
+    """The columns of one cache file, read in place from a memory map."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.views = []
+        try:
+            magic, version, mark, self.count, self.source_size, self.source_mtime, names_size = \
+                HEADER.unpack_from(self.map)
+            if (magic, version, mark) != (MAGIC, FORMAT_VERSION, BYTE_ORDER_MARK):
+                raise ValueError(f"{path} is not a cache file of this version")
+            position = HEADER.size
+            columns = []
+            for _ in range(4):
+                columns.append(self.view(position, self.count * 8, 'q'))
+                position += self.count * 8
+            self.start, self.finish, self.production, self.name_ends = columns
+            self.flags = self.view(position, self.count, 'B')
+            self.names = self.view(position + self.count, names_size, 'B')
+            if position + self.count + names_size != len(self.map):
+                raise ValueError(f"{path} is truncated")
+        except (struct.error, ValueError, TypeError):
+            self.close()
+            raise
+
+    def view(self, position, size, code):
+        if position + size > len(self.map):
+            raise ValueError("cache file is truncated")
+        view = memoryview(self.map)[position:position + size].cast(code)
+        self.views.append(view)
+        return view
+
+    def matches(self, stat):
+        return (self.source_size, self.source_mtime) == (stat.st_size, stat.st_mtime_ns)
+
+    def records(self):
+        names = bytes(self.names)
+        name_start = 0
+        # tolist() turns each column into Python ints in one go, which beats indexing the views part by part
+        for start, finish, production_seconds, name_end, flags in zip(
+                self.start.tolist(), self.finish.tolist(), self.production.tolist(), self.name_ends.tolist(),
+                self.flags.tolist()):
+            part_name = None if flags & NAME_MISSING else names[name_start:name_end].decode('utf-8')
+            name_start = name_end
+            start = EPOCH + timedelta(microseconds=start)
+            finish = EPOCH + timedelta(microseconds=finish)
+            yield PartRecord(part_name, start.isoformat(), start, finish.isoformat(), finish, production_seconds)
+
+    def close(self):
+        # The views must go before the map can be closed (and, on Windows, before the file can be replaced)
+        for view in self.views:
+            view.release()
+        self.views = []
+        self.map.close()
+
+
+class ColumnWriter:
+    """Collects PartRecords into columns and writes them as a cache file."""
+
+    def __init__(self):
+        self.start = array('q')
+        self.finish = array('q')
+        self.production = array('q')
+        self.name_ends = array('q')
+        self.flags = array('B')
+        self.names = bytearray()
+        self.cacheable = True
+
+    def add(self, record):
+        if not self.cacheable:
+            return
+        start, finish = record.start, record.finish
+        if (start.tzinfo is not None or finish.tzinfo is not None or record.created != start.isoformat()
+                or record.finished != finish.isoformat()):
+            self.cacheable = False
+            return
+        self.start.append((start - EPOCH) // MICROSECOND)
+        self.finish.append((finish - EPOCH) // MICROSECOND)
+        self.production.append(record.production_seconds)
+        if record.part_name is not None:
+            self.names += record.part_name.encode('utf-8')
+        self.flags.append(NAME_MISSING if record.part_name is None else 0)
+        self.name_ends.append(len(self.names))
+
+    def write(self, path, stat):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, FORMAT_VERSION, BYTE_ORDER_MARK, len(self.start), stat.st_size,
+                                   stat.st_mtime_ns, len(self.names)))
+            for column in (self.start, self.finish, self.production, self.name_ends, self.flags):
+                column.tofile(file)
+            file.write(self.names)
+        os.replace(temp_path, path)
+
+
+def part_records(xml_file_path, parse, cache_dir=REPORT_CACHE_DIR):
+    """Yield the PartRecords of an XML from its cache file, or from parse() while filling the cache."""
+    stat = os.stat(xml_file_path)
+    path = cache_path(xml_file_path, cache_dir)
+    try:
+        columns = PartColumns(path)
+    except FileNotFoundError:
+        columns = None
+    except (OSError, ValueError, struct.error) as e:
+        logging.warning(f"Ignoring report cache {path}: {e}")
+        columns = None
+    if columns is not None:
+        try:
+            if columns.matches(stat):
+                yield from columns.records()
+                return
+        finally:
+            columns.close()
+
+    writer = ColumnWriter()
+    for record in parse():
+        writer.add(record)
+        yield record
+    if writer.cacheable and os.stat(xml_file_path).st_mtime_ns == stat.st_mtime_ns:
+        try:
+            writer.write(path, stat)
+        except OSError as e:
+            logging.warning(f"Cannot write report cache {path}: {e}")
@@ -0,0 +1,245 @@
+"""Live production report.
+
+Follows the Peddinghaus production XML while the machine appends PartReports,
+keeps today's day and shift totals in memory and publishes them as JSON, both
+from a small local HTTP endpoint and as a summary file next to the XML.
+Only the bytes added since the last read are parsed.
+
+    python report_live.py "N:/Machine/Production.xml"
+    python report_live.py Production.xml --host 0.0.0.0 --port 8080 --interval 30
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.etree import ElementTree as ET
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+from pdc_report import DASHBOARD_HEADERS, MACHINE, PartRowBuilder, metrics_row
+from shift_calendar import SHIFT_SETTINGS_FILE, load_shift_calendar
+
+LIVE_HOST = '127.0.0.1'
+LIVE_PORT = 8765
+POLL_SECONDS = 10  # Fallback for network drives that do not report every change
+IDLE_GAP_MINUTES = 10  # Idle gaps at least this long are listed in the summary
+MAX_IDLE_GAPS = 20
+
+part_report_start = re.compile(rb'<PartReport[\s>]')
+PART_REPORT_END = b'</PartReport>'
+
+
+class XmlTail:
+    """Reads the PartReports written to the XML since the previous call.
+
+    Only complete PartReport elements are parsed; the offset is moved to the end
+    of the last one, so a part that is still being written is picked up next time
+    and closing tags rewritten after it are never read as new parts. A part that
+    is not well-formed XML is skipped, so it is not read again on every poll.
+    """
+
+    def __init__(self, xml_file_path):
+        self.xml_file_path = xml_file_path
+        self.offset = 0
+
+    def read_new(self):
+        """Return the new PartReport elements, or None if the file was replaced by a shorter one."""
+        size = os.path.getsize(self.xml_file_path)
+        if size < self.offset:
+            self.offset = 0
+            return None
+        if size == self.offset:
+            return []
+        with open(self.xml_file_path, 'rb') as file:
+            file.seek(self.offset)
+            data = file.read()
+        start = part_report_start.search(data)
+        end = data.rfind(PART_REPORT_END)
+        if start is None or end < start.start():
+            return []
+        end += len(PART_REPORT_END)
+        try:
+            part_reports = ET.fromstring(b'<PartReports>' + data[start.start():end] + b'</PartReports>').findall(
+                'PartReport')
+        except ET.ParseError:
+            part_reports = self.parse_parts(data[start.start():end])
+        self.offset += end
+        return part_reports
+
+    def parse_parts(self, data):
+        """The PartReports of data parsed one by one, leaving out the ones that are not well-formed."""
+        part_reports = []
+        position = 0
+        while True:
+            start = part_report_start.search(data, position)
+            if start is None:
+                return part_reports
+            end = data.find(PART_REPORT_END, start.end())
+            if end == -1:
+                return part_reports
+            position = end + len(PART_REPORT_END)
+            try:
+                part_reports.append(ET.fromstring(data[start.start():position]))
+            except ET.ParseError as e:
+                print(f"Skipped a PartReport in {self.xml_file_path} that is not valid XML ({e}): "
+                      f"{data[start.start():position][:200]!r}")
+
+
+class LiveReport:
+    """In-memory totals for the current production day."""
+
+    def __init__(self, xml_file_path, calendar):
+        self.xml_file_path = xml_file_path
+        self.calendar = calendar
+        self.tail = XmlTail(xml_file_path)
+        self.builder = PartRowBuilder(calendar)
+        self.idle_gaps = []
+        self.last_row = None
+        self.lock = threading.Lock()
+        self.summary = {}
+
+    def refresh(self):
+        """Read newly appended parts and rebuild the summary. Returns the number of new parts."""
+        part_reports = self.tail.read_new()
+        with self.lock:
+            if part_reports is None:  # New file for a new day, start over
+                self.builder = PartRowBuilder(self.calendar)
+                self.idle_gaps = []
+                part_reports = self.tail.read_new() or []
+            for part_report in part_reports:
+                try:
+                    row = self.builder.add(part_report)
+                except (AttributeError, TypeError, ValueError) as e:
+                    # A missing element, or a time that does not parse; the totals stay as they were
+                    print(f"Skipped PartReport {part_report.findtext('PartName')!r} in {self.xml_file_path}: "
+                          f"{type(e).__name__}: {e}")
+                    continue
+                if row.date != getattr(self.last_row, 'date', row.date):
+                    self.idle_gaps = []
+                    self.prune(row.date)
+                if row.idle_time * 60 >= IDLE_GAP_MINUTES:
+                    self.idle_gaps = (self.idle_gaps + [{'before_part': row.part_name, 'start_time': row.start_time,
+                                                         'minutes': round(row.idle_time * 60, 1)}])[-MAX_IDLE_GAPS:]
+                self.last_row = row
+            self.summary = self.build_summary()
+        return len(part_reports)
+
+    def prune(self, current_date):
+        """Forget the totals of earlier days so a long-running daemon does not grow."""
+        builder = self.builder
+        builder.daily_metrics = {date: totals for date, totals in builder.daily_metrics.items() if date == current_date}
+        builder.shift_metrics = {key: totals for key, totals in builder.shift_metrics.items() if key[0] == current_date}
+
+    def build_summary(self):
+        summary = {'file': self.xml_file_path, 'updated': datetime.now().isoformat(timespec='seconds')}
+        if self.last_row is None:
+            return summary
+        date = self.last_row.date
+        day_hours = self.calendar.working_hours(date)
+        summary.update({
+            'date': date,
+            'last_part': self.last_row.part_name,
+            'last_finish_time': self.last_row.finish_time,
+            'day': dict(zip(DASHBOARD_HEADERS, metrics_row(self.builder.daily_metrics[date], day_hours))),
+            'shifts': {shift: dict(zip(DASHBOARD_HEADERS, metrics_row(totals, self.calendar.shift_hours.get(shift, 0))))
+                       for (day, shift), totals in self.builder.shift_metrics.items() if day == date},
+            'idle_gaps': self.idle_gaps,
+        })
+        return summary
+
+    def summary_json(self):
+        with self.lock:
+            return json.dumps(self.summary, indent=2)
+
+    def write_summary_file(self, summary_path):
+        """Replace the summary file in one step so readers never see it half written."""
+        temp_path = summary_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            file.write(self.summary_json())
+        os.replace(temp_path, summary_path)
+
+
+class SummaryRequestHandler(BaseHTTPRequestHandler):
+    live_report = None
+
+    def do_GET(self):
+        if self.path not in ('/', '/summary'):
+            self.send_error(404)
+            return
+        body = self.live_report.summary_json().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class XmlChangeHandler(FileSystemEventHandler):
+    """Wakes the refresh loop when the production XML changes."""
+
+    def __init__(self, xml_file_path, changed):
+        self.xml_file_path = os.path.abspath(xml_file_path)
+        self.changed = changed
+
+    def on_modified(self, event):
+        if os.path.abspath(event.src_path) == self.xml_file_path:
+            self.changed.set()
+
+    on_created = on_modified
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('xml', nargs='?', help='production XML; asked for when left out')
+    parser.add_argument('--host', default=LIVE_HOST, help='address the JSON endpoint listens on')
+    parser.add_argument('--port', type=int, default=LIVE_PORT, help='port of the JSON endpoint')
+    parser.add_argument('--interval', type=float, default=POLL_SECONDS,
+                        help='seconds between reads when the drive reports no change')
+    parser.add_argument('--pattern', help="shift pattern of the machine (default: its first in shift_settings.json)")
+    args = parser.parse_args(argv)
+
+    xml_file_path = (args.xml or input("Enter the path to the XML file: ")).strip('"')
+    summary_path = os.path.join(os.path.dirname(xml_file_path), "Production_Live_Summary.json")
+    try:
+        calendar = load_shift_calendar(SHIFT_SETTINGS_FILE, MACHINE, args.pattern)
+    except ValueError as e:
+        parser.error(str(e))
+
+    live_report = LiveReport(xml_file_path, calendar)
+    live_report.refresh()
+    live_report.write_summary_file(summary_path)
+
+    SummaryRequestHandler.live_report = live_report
+    server = ThreadingHTTPServer((args.host, args.port), SummaryRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    changed = threading.Event()
+    observer = Observer()
+    observer.schedule(XmlChangeHandler(xml_file_path, changed), os.path.dirname(os.path.abspath(xml_file_path)))
+    observer.start()
+    print(f"Live report for {xml_file_path} at http://{args.host}:{args.port}/summary and {summary_path}")
+
+    try:
+        while True:
+            changed.wait(args.interval)
+            changed.clear()
+            time.sleep(0.5)  # Let the machine finish its write
+            try:
+                if live_report.refresh():
+                    live_report.write_summary_file(summary_path)
+            except (OSError, ET.ParseError) as e:
+                print(f"Could not read {xml_file_path}: {e}")
+    except KeyboardInterrupt:
+        observer.stop()
+        server.shutdown()
+    observer.join()
+
+
+if __name__ == "__main__":
+    main()
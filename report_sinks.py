@@ -0,0 +1,147 @@
+"""Output sinks for the production report.
+
+Every sink receives the same stream of PartRow records from pdc_report.py, so
+the report can be written as Excel, CSV, SQLite or Parquet (or several at once)
+from a single pass over the production XML.
+"""
+import csv
+import sqlite3
+from collections import namedtuple
+
+# Column headers as they appear in the Excel report, and the matching row fields
+REPORT_HEADERS = ["Part Name", "Date", "Start Time", "Finish Time", "Total Run Time (hours)", "Idle Time (hours)",
+                  "Production Time (hours)", "PT-TRT (hours)", "Shift"]
+PartRow = namedtuple('PartRow', ['part_name', 'date', 'start_time', 'finish_time', 'total_run_time',
+                                 'idle_time', 'production_time', 'pt_trt', 'shift'])
+
+REPORT_FORMATS = ['xlsx', 'csv', 'sqlite', 'parquet']
+
+
+class ReportSink:
+    """Base class for report outputs. Subclasses override what they need."""
+
+    def write_row(self, row):
+        pass
+
+    def write_summary(self, daily_metrics, shift_metrics, calendar):
+        pass
+
+    def close(self):
+        pass
+
+
+class CsvSink(ReportSink):
+    """Streams rows straight to a CSV file; nothing is kept in memory."""
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.file = open(output_path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(REPORT_HEADERS)
+
+    def write_row(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        self.file.close()
+
+
+class SqliteSink(ReportSink):
+    """Writes rows to a part_reports table indexed on date and shift.
+
+    Re-running the report replaces the rows for the dates it covers, so one
+    database can collect months of reports.
+    """
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, output_path, table='part_reports'):
+        self.output_path = output_path
+        self.table = table
+        self.connection = sqlite3.connect(output_path)
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (part_name TEXT, date TEXT, start_time TEXT, finish_time TEXT, "
+            "total_run_time REAL, idle_time REAL, production_time REAL, pt_trt REAL, shift TEXT)")
+        self.connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_date ON {table} (date)")
+        self.connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_shift ON {table} (shift, date)")
+        self.cleared_dates = set()
+        self.pending = []
+
+    def write_row(self, row):
+        if row.date not in self.cleared_dates:
+            self.connection.execute(f"DELETE FROM {self.table} WHERE date = ?", (row.date,))
+            self.cleared_dates.add(row.date)
+        self.pending.append(row)
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.connection.executemany(f"INSERT INTO {self.table} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", self.pending)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.connection.commit()
+        self.connection.close()
+
+
+class ParquetSink(ReportSink):
+    """Writes rows to a columnar Parquet file, one row group per batch.
+
+    Needs pyarrow, which is only imported when this sink is used.
+    """
+
+    BATCH_SIZE = 50000
+
+    def __init__(self, output_path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output needs pyarrow (pip install pyarrow)")
+        self.pa = pyarrow
+        self.schema = pyarrow.schema([
+            ('part_name', pyarrow.string()), ('date', pyarrow.string()),
+            ('start_time', pyarrow.string()), ('finish_time', pyarrow.string()),
+            ('total_run_time', pyarrow.float64()), ('idle_time', pyarrow.float64()),
+            ('production_time', pyarrow.float64()), ('pt_trt', pyarrow.float64()),
+            ('shift', pyarrow.string())])
+        self.output_path = output_path
+        self.writer = pyarrow.parquet.ParquetWriter(output_path, self.schema)
+        self.pending = []
+
+    def write_row(self, row):
+        self.pending.append(row)
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            columns = [list(column) for column in zip(*self.pending)]
+            self.writer.write_table(self.pa.Table.from_arrays(columns, schema=self.schema))
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def open_sinks(formats, output_base, excel_sink=None):
+    """Create one sink per requested format, writing to output_base plus the format's extension.
+
+    The Excel sink lives in pdc_report.py, so the caller passes its factory in.
+    """
+    sinks = []
+    for output_format in formats:
+        output_path = f"{output_base}.{output_format}"
+        if output_format == 'xlsx':
+            sinks.append(excel_sink(output_path))
+        elif output_format == 'csv':
+            sinks.append(CsvSink(output_path))
+        elif output_format == 'sqlite':
+            sinks.append(SqliteSink(output_path))
+        elif output_format == 'parquet':
+            sinks.append(ParquetSink(output_path))
+        else:
+            raise ValueError(f"Unknown report format: {output_format}")
+    return sinks
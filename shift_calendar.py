@@ -0,0 +1,193 @@
+"""Shift calendar for the production report.
+
+Shift and break times are turned into seconds-of-the-week once, when the
+calendar is built, so putting a timestamp into a shift is one binary search
+instead of parsing the shift times again for every part. Breaks are
+segments of their own in that table: time on a break is split out as
+BREAK, and the report leaves it out of run and idle time.
+
+A machine can have several patterns (a summer and a winter rota, say). In
+shift_settings.json "machines" maps a machine to one pattern name or to a
+list of them, the first being its default, and a pattern named
+"<machine>/<name>" is used for that machine before a shared one called
+<name>:
+
+    {"patterns": {"default": {...}, "Beamline/summer": {...}},
+     "machines": {"Beamline": ["default", "summer"]}}
+"""
+import bisect
+import json
+from datetime import datetime, timedelta
+
+SHIFT_SETTINGS_FILE = 'shift_settings.json'
+
+DAY_SECONDS = 24 * 60 * 60
+WEEK_SECONDS = 7 * DAY_SECONDS
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+UNDEFINED = 'Undefined'  # Time outside every shift
+BREAK = 'Break'  # Time on a break, in split()
+
+# The shift times the report used before the calendar existed, without the minute left out at 19:00 and 07:00
+DEFAULT_PATTERN = {
+    'shifts': [{'name': 'Day', 'start': '07:00:00', 'end': '19:00:00'},
+               {'name': 'Night', 'start': '19:00:00', 'end': '07:00:00'}],
+    'breaks': [],
+    'workdays': WEEKDAYS,
+    'day_rollover': '05:00:00',
+}
+
+
+def time_to_seconds(timestr):
+    """Convert time string formatted as H:M:S (or H:M) to seconds."""
+    fields = [int(field) for field in timestr.split(':')]
+    h, m, s = (fields + [0, 0])[:3]
+    return h * 3600 + m * 60 + s
+
+
+def span_length(start_seconds, end_seconds):
+    """Length of a daily span, allowing spans that go over midnight."""
+    return (end_seconds - start_seconds) % DAY_SECONDS or DAY_SECONDS
+
+
+def week_spans(start, length, days):
+    """(start, end) in week seconds of a daily span on each of days, cut in two where it runs past Sunday."""
+    spans = []
+    for day in days:
+        week_start = day * DAY_SECONDS + start
+        week_end = week_start + length
+        if week_end > WEEK_SECONDS:  # Sunday night carries on into Monday morning
+            spans.append((week_start, WEEK_SECONDS))
+            spans.append((0, week_end - WEEK_SECONDS))
+        else:
+            spans.append((week_start, week_end))
+    return spans
+
+
+def overlap(start1, length1, start2, length2):
+    """Seconds two daily spans have in common, including spans that wrap past midnight."""
+    total = 0
+    for offset in (-DAY_SECONDS, 0, DAY_SECONDS):
+        begin = max(start1, start2 + offset)
+        end = min(start1 + length1, start2 + offset + length2)
+        total += max(0, end - begin)
+    return total
+
+
+class ShiftCalendar:
+    """Sorted shift boundaries for one week, built once per shift pattern."""
+
+    def __init__(self, shifts, breaks=(), workdays=WEEKDAYS, day_rollover='05:00:00'):
+        self.rollover_seconds = time_to_seconds(day_rollover)
+        days = sorted({WEEKDAYS.index(day[:3].title()) for day in workdays})
+
+        # Net working hours of one occurrence of each shift, breaks taken out
+        break_spans = [(time_to_seconds(b['start']), span_length(time_to_seconds(b['start']), time_to_seconds(b['end'])))
+                       for b in breaks]
+        # Breaks are laid on every day of the week; they only count where they fall inside a shift
+        week_breaks = sorted(span for b_start, b_length in break_spans
+                             for span in week_spans(b_start, b_length, range(len(WEEKDAYS))))
+        self.shift_hours = {}
+        segments = []  # (start, end, name, shift): name is BREAK on a break within shift
+        for shift in shifts:
+            start = time_to_seconds(shift['start'])
+            length = span_length(start, time_to_seconds(shift['end']))
+            on_break = sum(overlap(start, length, b_start, b_length) for b_start, b_length in break_spans)
+            self.shift_hours[shift['name']] = (length - on_break) / 3600
+            for week_start, week_end in week_spans(start, length, days):
+                position = week_start
+                for b_start, b_end in week_breaks:
+                    if b_end <= position or b_start >= week_end:
+                        continue
+                    if b_start > position:
+                        segments.append((position, b_start, shift['name'], shift['name']))
+                    segments.append((max(b_start, position), min(b_end, week_end), BREAK, shift['name']))
+                    position = min(b_end, week_end)
+                if position < week_end:
+                    segments.append((position, week_end, shift['name'], shift['name']))
+
+        segments.sort()
+        self._starts = [segment[0] for segment in segments]
+        self._ends = [segment[1] for segment in segments]
+        self._names = [segment[2] for segment in segments]
+        self._shifts = [segment[3] for segment in segments]
+
+    @staticmethod
+    def week_seconds(moment):
+        """Seconds since Monday 00:00 of the week moment falls in."""
+        return moment.weekday() * DAY_SECONDS + moment.hour * 3600 + moment.minute * 60 + moment.second
+
+    def _segment(self, position):
+        """Return the segment at position: its name (a shift, BREAK or UNDEFINED), its shift and where it ends."""
+        i = bisect.bisect_right(self._starts, position) - 1
+        if i >= 0 and position < self._ends[i]:
+            return self._names[i], self._shifts[i], self._ends[i]
+        next_start = self._starts[i + 1] if i + 1 < len(self._starts) else WEEK_SECONDS
+        return UNDEFINED, UNDEFINED, next_start
+
+    def classify(self, moment):
+        """Return the name of the shift moment falls in (on a break too), or 'Undefined' outside all shifts."""
+        return self._segment(self.week_seconds(moment))[1]
+
+    def production_date(self, moment):
+        """Date the moment is reported under; times up to the rollover belong to the previous day."""
+        seconds = moment.hour * 3600 + moment.minute * 60 + moment.second
+        if seconds <= self.rollover_seconds:
+            moment -= timedelta(days=1)
+        return moment.strftime('%Y-%m-%d')
+
+    def split(self, start, finish):
+        """Split the time between start and finish into seconds per shift, with time on breaks under BREAK."""
+        remaining = int((finish - start).total_seconds())
+        position = self.week_seconds(start)
+        totals = {}
+        while remaining > 0:
+            name, _, boundary = self._segment(position)
+            step = min(remaining, boundary - position)
+            totals[name] = totals.get(name, 0) + step
+            remaining -= step
+            position = (position + step) % WEEK_SECONDS
+        return totals
+
+    def working_seconds(self, start, finish):
+        """Seconds between start and finish that are not on a break."""
+        by_shift = self.split(start, finish)
+        return sum(by_shift.values()) - by_shift.get(BREAK, 0)
+
+    def working_hours(self, date):
+        """Net working hours of the production day date ('YYYY-MM-DD'): shift time from rollover to rollover,
+        without breaks."""
+        start = datetime.strptime(date, '%Y-%m-%d') + timedelta(seconds=self.rollover_seconds)
+        by_shift = self.split(start, start + timedelta(days=1))
+        return (DAY_SECONDS - by_shift.get(BREAK, 0) - by_shift.get(UNDEFINED, 0)) / 3600
+
+
+def read_settings(settings_path):
+    try:
+        with open(settings_path, 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def machine_patterns(settings, machine):
+    """The pattern names machine may use, its default first."""
+    names = settings.get('machines', {}).get(machine, 'default')
+    return [names] if isinstance(names, str) else list(names)
+
+
+def load_shift_calendar(settings_path=SHIFT_SETTINGS_FILE, machine=None, pattern_name=None):
+    """Build the calendar for machine, with its default pattern or the one named, from the shift settings file.
+
+    Machines without an entry use the "default" pattern, and a missing settings
+    file gives the original day/night shifts.
+    """
+    settings = read_settings(settings_path)
+    names = machine_patterns(settings, machine)
+    if pattern_name is None:
+        pattern_name = names[0]
+    elif pattern_name not in names:
+        raise ValueError(f"{machine} has no shift pattern {pattern_name!r} (it has {', '.join(names)})")
+    patterns = settings.get('patterns', {})
+    pattern = dict(DEFAULT_PATTERN)
+    pattern.update(patterns.get(f"{machine}/{pattern_name}", patterns.get(pattern_name, {})))
+    return ShiftCalendar(**pattern)
@@ -0,0 +1,147 @@
+"""Synthetic CAD exports and production XMLs for benchmarks and load tests.
+
+The generated files follow the layout the processors expect: .nc1 files with a
+DSTV header (drawing and piece IDs on lines 4 and 5 carrying the 10 character
+job prefix) and BO/SI/AK blocks, .idstv files with BA and PI elements for angle
+and non-angle profiles, and production XMLs with PartReports. Everything is
+driven by a seeded random.Random so runs are repeatable.
+"""
+import os
+import random
+from datetime import datetime, timedelta
+
+JOB = 'W8787'
+PROFILES = [('W', 'W8X31', 'I'), ('C', 'C10X15.3', 'U'), ('S', 'S8X18.4', 'I'), ('HSS', 'HSS4X4X1/4', 'M'),
+            ('L', 'L3X3X1/4', 'L'), ('HP', 'HP10X42', 'I')]
+
+
+def job_prefix(job=JOB, phase=1, profile_letter='L'):
+    """The 10 character prefix Tekla puts in front of file names and IDs, e.g. 'W8787-1-L_'."""
+    return f"{job}-{phase}-{profile_letter}_"
+
+
+def piece_id(rng, drawing_number, piece_number):
+    """An ID in the DSTV 'length-drawing-piece' form, e.g. '270-MA201-m0024'."""
+    return f"{rng.choice([270, 271, 300, 450])}-MA{drawing_number:03d}-m{piece_number:04d}"
+
+
+def nc1_text(rng, prefix, ident, length, holes=8, scribes=6, contour_points=5):
+    """A DSTV .nc1 file with BO (holes), SI (scribing) and AK (contour) blocks."""
+    lines = ['ST',
+             '** Created by Tekla Structures',
+             f'  {JOB}',
+             f'  {prefix}{ident}',
+             f'  {prefix}{ident}',
+             '  1',
+             '  A36',
+             '  1',
+             '  L3X3X1/4',
+             '  L',
+             f'  {length:.2f}',
+             '  76.20',
+             '  76.20',
+             '  6.35',
+             '  6.35',
+             '  0.00',
+             '  0.00',
+             '  0.00',
+             '  0.00',
+             '  0.00',
+             'BO']
+    for _ in range(holes):
+        lines.append(f'  v {rng.uniform(10, length):10.2f}o {rng.uniform(10, 60):8.2f}  17.46')
+    lines.append('SI')
+    for _ in range(scribes):
+        lines.append(f'  v {rng.uniform(10, length):10.2f}o {rng.uniform(10, 60):8.2f}  0.00  10r{ident}')
+    lines.append('AK')
+    for _ in range(contour_points):
+        lines.append(f'  v {rng.uniform(0, length):10.2f}  {rng.uniform(0, 76):8.2f}  0.00  0.00  0.00  0.00  0.00')
+    lines.append('EN')
+    return '\n'.join(lines) + '\n'
+
+
+def idstv_text(rng, prefix, pieces, angle=True, directory='C:\\Jobs\\W8787\\W8787-1-L\\'):
+    """An .idstv export with one BA (bar) element and a PI element per piece.
+
+    Angle profiles get ProfileType L, which is what process_idstv_file_AM looks
+    for; about a third of the pieces are shorter than the 279 mm angle limit.
+    """
+    letter, profile, profile_type = PROFILES[4] if angle else rng.choice(PROFILES[:4] + PROFILES[5:])
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>', '<DSTV>', '  <BA>',
+             f'    <Name>{JOB} {letter}_{profile}</Name>',
+             f'    <ProfileType>{profile_type}</ProfileType>',
+             '    <RemnantLocation>',
+             '      <Side>o</Side>',
+             '    </RemnantLocation>',
+             '  </BA>']
+    for number in range(pieces):
+        ident = piece_id(rng, number % 50 + 1, number + 1)
+        length = rng.uniform(150, 278) if rng.random() < 0.35 else rng.uniform(300, 6000)
+        parts.extend(['  <PI>',
+                      f'    <Name>{JOB} {letter}_{profile}</Name>',
+                      f'    <Filename>{prefix}{ident}</Filename>',
+                      f'    <DrawingIdentification>{prefix}{ident}</DrawingIdentification>',
+                      f'    <PieceIdentification>{prefix}{ident}</PieceIdentification>',
+                      f'    <Length>{length:.2f}</Length>',
+                      f'    <Directory>{directory}</Directory>',
+                      '  </PI>'])
+    parts.append('</DSTV>')
+    return '\n'.join(parts) + '\n'
+
+
+def production_xml_text(rng, part_reports, start=datetime(2024, 2, 5, 6, 0, 0)):
+    """A production XML with part_reports PartReports running back to back with random idle gaps."""
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>', '<ProductionData>', '  <PartReports>']
+    moment = start
+    for number in range(part_reports):
+        production_seconds = rng.randint(60, 1200)
+        finish = moment + timedelta(seconds=production_seconds + rng.randint(10, 120))
+        parts.extend(['    <PartReport>',
+                      f'      <PartName>{piece_id(rng, number % 50 + 1, number + 1)}</PartName>',
+                      f'      <TimeWhenPartWasCreated>{moment:%Y-%m-%dT%H:%M:%S}</TimeWhenPartWasCreated>',
+                      f'      <TimeWhenPartWasFinished>{finish:%Y-%m-%dT%H:%M:%S}</TimeWhenPartWasFinished>',
+                      f'      <TimeItTookToCreateThePart>{str(timedelta(seconds=production_seconds))}'
+                      '</TimeItTookToCreateThePart>',
+                      '    </PartReport>'])
+        moment = finish + timedelta(seconds=rng.choice([0, 30, 60, 300, 1800]))
+    parts.extend(['  </PartReports>', '</ProductionData>'])
+    return '\n'.join(parts) + '\n'
+
+
+def write_nc1(directory, rng, number, holes=8, scribes=6, prefix=None):
+    """Write one synthetic .nc1 named like a Tekla export and return its path."""
+    prefix = prefix or job_prefix()
+    ident = piece_id(rng, number % 50 + 1, number + 1)
+    path = os.path.join(directory, f"{prefix}{ident}.nc1")
+    with open(path, 'w') as file:
+        file.write(nc1_text(rng, prefix, ident, rng.uniform(150, 6000), holes, scribes))
+    return path
+
+
+def write_idstv(directory, rng, number, pieces=20, angle=True, prefix=None):
+    """Write one synthetic .idstv and return its path."""
+    prefix = prefix or job_prefix(profile_letter='L' if angle else 'B')
+    path = os.path.join(directory, f"{prefix}bar{number:04d}.idstv")
+    with open(path, 'w') as file:
+        file.write(idstv_text(rng, prefix, pieces, angle))
+    return path
+
+
+def write_production_xml(path, rng, part_reports):
+    """Write a synthetic production XML and return its path."""
+    with open(path, 'w') as file:
+        file.write(production_xml_text(rng, part_reports))
+    return path
+
+
+def write_job(directory, files, seed=0, idstv_share=0.2):
+    """Fill directory with a mixed W-job drop of .nc1 and .idstv files and return their paths."""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for number in range(files):
+        if rng.random() < idstv_share:
+            paths.append(write_idstv(directory, rng, number, pieces=rng.randint(5, 40), angle=rng.random() < 0.5))
+        else:
+            paths.append(write_nc1(directory, rng, number, holes=rng.randint(2, 30), scribes=rng.randint(0, 12)))
+    return paths
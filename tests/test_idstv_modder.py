@@ -0,0 +1,44 @@
+"""DirectoryMapping and retarget_content in idstv_modderV2."""
+import pytest
+
+from idstv_modderV2 import DirectoryMapping, retarget_content
+
+
+@pytest.mark.parametrize('mappings, directory, expected', [
+    # The longest old prefix wins
+    ([('C:\\Users\\SandroP\\Desktop', 'N:\\Jobs'), ('C:\\Users', 'D:\\Old')],
+     'C:\\Users\\SandroP\\Desktop\\W8787\\W8787-1-L\\', 'N:\\Jobs\\W8787\\W8787-1-L\\'),
+    ([('C:\\Users\\SandroP\\Desktop', 'N:\\Jobs'), ('C:\\Users', 'D:\\Old')], 'C:\\Users\\Bob\\x', 'D:\\Old\\Bob\\x'),
+    # Case and slash direction do not matter, and the rest takes the new prefix's slash
+    ([('N:\\Jobs\\W8787', 'N:\\Jobs')], 'n:/jobs/w8787/W8787-1-L/', 'N:\\Jobs\\W8787-1-L\\'),
+    ([('N:/Jobs', 'S:/Archive')], 'N:\\JOBS\\W8787\\W8787-1-L\\', 'S:/Archive/W8787/W8787-1-L/'),
+    # Casefolding changes the length of the prefix (ß -> ss); the rest must still be cut in the right place
+    ([('C:\\Users\\Groß\\Jobs', 'N:\\Jobs')], 'C:\\Users\\Groß\\Jobs\\W8787\\W8787-1-L\\',
+     'N:\\Jobs\\W8787\\W8787-1-L\\'),
+    ([('C:\\Users\\GROSS\\Jobs', 'N:\\Jobs')], 'C:\\Users\\groß\\Jobs\\W8787', 'N:\\Jobs\\W8787'),
+    # The old prefix itself, with and without a trailing slash
+    ([('N:\\Jobs\\W8787', 'N:\\Jobs')], 'N:\\Jobs\\W8787', 'N:\\Jobs'),
+    ([('N:\\Jobs\\W8787', 'N:\\Jobs')], 'N:\\Jobs\\W8787\\', 'N:\\Jobs\\'),
+    # Only whole components match
+    ([('N:\\Jobs\\W8787', 'N:\\Jobs')], 'N:\\Jobs\\W8787-1-L\\', 'N:\\Jobs\\W8787-1-L\\'),
+    ([('N:\\Jobs\\W8787', 'N:\\Jobs')], 'N:\\Jobs\\W9999\\x', 'N:\\Jobs\\W9999\\x'),
+    # New inside old: a directory already under the new folder is left alone
+    ([('N:\\Jobs', 'N:\\Jobs\\Archive')], 'N:\\Jobs\\W1', 'N:\\Jobs\\Archive\\W1'),
+    ([('N:\\Jobs', 'N:\\Jobs\\Archive')], 'n:/jobs/archive/W1', 'n:/jobs/archive/W1'),
+])
+def test_target(mappings, directory, expected):
+    assert DirectoryMapping(mappings).target(directory) == expected
+
+
+def test_fixed_target():
+    assert DirectoryMapping(fixed='N:\\Jobs\\W8787\\').target('C:\\anything') == 'N:\\Jobs\\W8787\\'
+
+
+def test_retarget_content_keeps_bytes_and_counts_changes():
+    content = ('<Root>\r\n<Directory>C:\\Users\\Groß\\Jobs\\W8787\\</Directory>\r\n'
+               '<Directory>N:\\Elsewhere</Directory>\r\n</Root>\r\n').encode('utf-8')
+    new_content, changed = retarget_content(content, DirectoryMapping([('C:\\Users\\Groß\\Jobs', 'N:\\Jobs')]))
+    assert changed == 1
+    assert new_content == (b'<Root>\r\n<Directory>N:\\Jobs\\W8787\\</Directory>\r\n'
+                           b'<Directory>N:\\Elsewhere</Directory>\r\n</Root>\r\n')
+    assert retarget_content(new_content, DirectoryMapping([('C:\\Users\\Groß\\Jobs', 'N:\\Jobs')]))[1] == 0
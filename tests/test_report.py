@@ -0,0 +1,41 @@
+"""Dashboard and day sheet figures of the Excel production report."""
+import random
+
+import pytest
+
+import synthetic_data
+from pdc_report import DASHBOARD_HEADERS, ExcelSink, build_report
+from shift_calendar import ShiftCalendar
+
+# Two shifts of 8 net hours on weekdays
+WEEKDAY_PATTERN = {
+    'shifts': [{'name': 'Day', 'start': '07:00', 'end': '15:30'},
+               {'name': 'Evening', 'start': '15:30', 'end': '24:00'}],
+    'breaks': [{'start': '12:00', 'end': '12:30'}, {'start': '20:00', 'end': '20:30'}],
+    'workdays': ['Mon', 'Tue', 'Wed', 'Thu', 'Fri'],
+}
+
+
+def test_days_are_measured_against_their_working_hours(tmp_path):
+    openpyxl = pytest.importorskip('openpyxl')
+    xml_path = tmp_path / 'production.xml'
+    xml_path.write_text(synthetic_data.production_xml_text(random.Random(5), 40))
+    report_path = str(tmp_path / 'report.xlsx')
+    build_report(str(xml_path), [ExcelSink(report_path)], ShiftCalendar(**WEEKDAY_PATTERN))
+
+    workbook = openpyxl.load_workbook(report_path)
+    dashboard = list(workbook['Dashboard'].iter_rows(values_only=True))
+    day = dict(zip(DASHBOARD_HEADERS, dashboard[1][1:]))
+    assert dashboard[1][0] == '2024-02-05'
+    assert day['Production Efficiency'] == pytest.approx(day['Production Time (hours)'] / 16)
+    assert day['Utilization'] == pytest.approx(day['Total Run Time (hours)'] / 16)
+    assert dashboard[3][0] == 'Date / Shift'
+    shifts = {row[0]: dict(zip(DASHBOARD_HEADERS, row[1:])) for row in dashboard[4:]}
+    assert {'2024-02-05 Day', '2024-02-05 Evening'} <= set(shifts)
+    for name in ['2024-02-05 Day', '2024-02-05 Evening']:
+        assert shifts[name]['Production Efficiency'] == pytest.approx(shifts[name]['Production Time (hours)'] / 8)
+
+    *_, totals, working_time = workbook['2024-02-05'].iter_rows(values_only=True)
+    assert totals[0] == 'Totals' and working_time[0] == 'Production Time / 16'
+    assert working_time[6] == pytest.approx(totals[6] / 16)
+    assert working_time[6] == pytest.approx(day['Production Efficiency'])
@@ -0,0 +1,53 @@
+"""LiveReport and XmlTail in report_live."""
+import random
+
+import pytest
+
+import synthetic_data
+from report_live import LiveReport
+from shift_calendar import SHIFT_SETTINGS_FILE, ShiftCalendar, load_shift_calendar
+
+BROKEN_PARTS = (
+    '    <PartReport><PartName>broken</PartName><TimeWhenPartWasCreated>2024-02-05T23:00:00</PartReport>\n'
+    '    <PartReport><PartName>unfinished</PartName>'
+    '<TimeWhenPartWasCreated>2024-02-05T23:00:00</TimeWhenPartWasCreated></PartReport>\n'
+    '    <PartReport><PartName>bad-time</PartName><TimeWhenPartWasCreated>yesterday</TimeWhenPartWasCreated>'
+    '<TimeWhenPartWasFinished>x</TimeWhenPartWasFinished><TimeItTookToCreateThePart>1</TimeItTookToCreateThePart>'
+    '</PartReport>\n'
+)
+
+
+def part_reports(seed, count):
+    """count PartReport elements as they appear between <PartReports> and </PartReports>."""
+    text = synthetic_data.production_xml_text(random.Random(seed), count)
+    return text.split('<PartReports>')[1].split('  </PartReports>')[0]
+
+
+def test_malformed_parts_are_skipped(tmp_path, capsys):
+    path = tmp_path / 'production.xml'
+    text = synthetic_data.production_xml_text(random.Random(2), 5)
+    path.write_text(text.split('  </PartReports>')[0])
+    report = LiveReport(str(path), load_shift_calendar(SHIFT_SETTINGS_FILE, 'Beamline'))
+    assert report.refresh() == 5
+    with open(path, 'a') as file:
+        file.write(BROKEN_PARTS)
+    assert report.refresh() == 2
+    output = capsys.readouterr().out
+    assert 'not valid XML' in output and "'unfinished'" in output and "'bad-time'" in output
+    assert report.refresh() == 0
+    with open(path, 'a') as file:
+        file.write(part_reports(3, 1).replace('2024-02-05', '2024-02-06'))
+    assert report.refresh() == 1
+    assert report.summary['last_part'] == report.last_row.part_name
+
+
+def test_the_day_is_measured_against_its_working_hours(tmp_path):
+    path = tmp_path / 'production.xml'
+    path.write_text(synthetic_data.production_xml_text(random.Random(4), 10))
+    calendar = ShiftCalendar(shifts=[{'name': 'Day', 'start': '06:00', 'end': '18:00'}],
+                             breaks=[{'start': '12:00', 'end': '13:00'}])
+    report = LiveReport(str(path), calendar)
+    report.refresh()
+    day = report.summary['day']
+    assert day['Production Efficiency'] == pytest.approx(day['Production Time (hours)'] / 11)
+    assert report.summary['shifts']['Day']['Production Efficiency'] == day['Production Efficiency']
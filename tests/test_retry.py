@@ -0,0 +1,39 @@
+"""RetryStore in pdc_retry: backoff, dead letters and replay."""
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from pdc_retry import RetryStore
+
+
+def fail(store, task, times):
+    return [store.failed(task, 'read', PermissionError('locked')) for _ in range(times)]
+
+
+def test_a_file_becomes_a_dead_letter_and_is_replayed(tmp_path):
+    store = RetryStore(str(tmp_path / 'retry.sqlite'), max_attempts=3)
+    task = SimpleNamespace(path='N:/Jobs/W1/a.nc1', root='N:/Jobs')
+    assert fail(store, task, 3) == [True, True, False]
+    [(letter_id, path, _, stage, error_type, _, attempts, _)] = store.dead_letters()
+    assert (path, stage, error_type, attempts) == (task.path, 'read', 'PermissionError', 3)
+    assert task.path not in store.retrying
+
+    assert store.replay([letter_id]) == 1
+    assert store.dead_letters() == [] and task.path in store.retrying
+    first_failed = store.connection.execute("SELECT first_failed FROM retries").fetchone()[0]
+    assert first_failed is not None
+    assert store.claim_due() == [(task.path, task.root)]
+    assert fail(store, task, 3) == [True, True, False]
+    assert store.connection.execute("SELECT first_failed FROM dead_letters").fetchone()[0] == first_failed
+
+
+def test_the_move_to_the_dead_letters_is_one_transaction(tmp_path):
+    store = RetryStore(str(tmp_path / 'retry.sqlite'), max_attempts=2)
+    task = SimpleNamespace(path='N:/Jobs/W1/a.nc1', root='N:/Jobs')
+    fail(store, task, 1)
+    store.connection.execute("DROP TABLE dead_letters")
+    with pytest.raises(sqlite3.OperationalError):
+        fail(store, task, 1)
+    assert store.connection.execute("SELECT attempts FROM retries").fetchall() == [(1,)]
+    assert task.path in store.retrying
@@ -0,0 +1,135 @@
+"""pdc_rules against the pdcCodeFinal processors, on bytes and on memory-mapped files."""
+import mmap
+import os
+import random
+import re
+
+import pytest
+
+import pdcCodeFinal
+import pdc_rules
+import synthetic_data
+from pdc_watcher import FileTask, Pipeline
+
+LARGE_NC1_HOLES = 30000  # Makes an .nc1 of about 1.5 MB, above MMAP_THRESHOLD
+
+
+def legacy_output(directory, name, data):
+    """The files CombinedHandler leaves in a folder holding only name, even when it raises."""
+    from watchdog.events import FileCreatedEvent
+    os.makedirs(directory)
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as file:
+        file.write(data)
+    try:
+        pdcCodeFinal.CombinedHandler().on_created(FileCreatedEvent(path))
+    except (AttributeError, TypeError, ValueError):  # A bad Length or ID; the BL result is already written
+        pass
+    return folder_state(directory)
+
+
+def folder_state(directory):
+    state = {}
+    for name in os.listdir(directory):
+        with open(os.path.join(directory, name), 'rb') as file:
+            state[name] = file.read()
+    return state
+
+
+def rules_output(directory, name, data, mmap_threshold=pdc_rules.MMAP_THRESHOLD):
+    """What pdc_rules makes of name, read through SourceFile as the watcher reads it."""
+    os.makedirs(directory)
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as file:
+        file.write(data)
+    with pdc_rules.SourceFile(path, mmap_threshold) as source:
+        if name.endswith('.nc1'):
+            target, rewrite = pdc_rules.rewrite_nc1(name, source.data)
+        else:
+            target, rewrite = name, pdc_rules.rewrite_idstv(source.data)
+        return {target: rewrite.to_bytes()}, isinstance(source.data, mmap.mmap)
+
+
+def nc1_file(seed, holes=8, scribes=6, long_name=True):
+    rng = random.Random(seed)
+    prefix = synthetic_data.job_prefix() if long_name else ''
+    ident = synthetic_data.piece_id(rng, 1, seed + 1)
+    text = synthetic_data.nc1_text(rng, prefix, ident, rng.uniform(150, 6000), holes, scribes)
+    return f"{prefix}{ident}.nc1", text.encode()
+
+
+def idstv_file(seed, pieces=20, angle=True):
+    rng = random.Random(seed)
+    prefix = synthetic_data.job_prefix(profile_letter='L' if angle else 'B')
+    return f"{prefix}bar{seed:04d}.idstv", synthetic_data.idstv_text(rng, prefix, pieces, angle).encode()
+
+
+@pytest.mark.parametrize('mmap_threshold', [pdc_rules.MMAP_THRESHOLD, 1])
+@pytest.mark.parametrize('name, data', [
+    nc1_file(1),
+    nc1_file(2, holes=0, scribes=0),
+    nc1_file(3, long_name=False),
+    idstv_file(4),
+    idstv_file(5, angle=False),
+    idstv_file(6, pieces=0),
+], ids=['nc1', 'nc1-no-holes', 'nc1-short-name', 'idstv-angle', 'idstv-beam', 'idstv-no-pieces'])
+def test_rules_match_legacy(tmp_path, name, data, mmap_threshold):
+    output, mapped = rules_output(str(tmp_path / 'rules'), name, data, mmap_threshold)
+    assert mapped == (len(data) >= mmap_threshold)
+    assert output == legacy_output(str(tmp_path / 'legacy'), name, data)
+
+
+def test_transform_idstv_bl_reports_no_change():
+    assert pdc_rules.transform_idstv_bl(b'<DSTV><Length>12</Length></DSTV>') is None
+    assert not pdc_rules.rewrite_idstv(b'<DSTV><Length>12</Length></DSTV>', ('idstv_bl',)).changed
+
+
+def test_transform_idstv_bl_on_a_memory_map(tmp_path):
+    name, data = idstv_file(7)
+    path = tmp_path / name
+    path.write_bytes(data)
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        assert pdc_rules.transform_idstv_bl(mapped) == pdc_rules.transform_idstv_bl(data)
+
+
+def broken_idstv(seed, *replacements):
+    """An angle .idstv with (pattern, replacement) pairs applied to its last PI, so the AM rules fail on it."""
+    name, data = idstv_file(seed, pieces=5)
+    head, piece = data.rsplit(b'<PI>', 1)
+    for pattern, replacement in replacements:
+        piece, count = re.subn(pattern.encode(), replacement.encode(), piece, count=1)
+        assert count == 1
+    return name, head + b'<PI>' + piece
+
+
+@pytest.mark.parametrize('name, data', [
+    broken_idstv(12, (r'<Length>', '<Length>about ')),
+    broken_idstv(13, (r'<Length>[^<]*</Length>', '<Length />')),
+    broken_idstv(14, (r'<Length>[^<]*</Length>', '<Length>1</Length>'),
+                 (r'<PieceIdentification>[^<]*</PieceIdentification>', '<PieceIdentification />')),
+], ids=['length-not-a-number', 'empty-length', 'empty-id'])
+def test_idstv_am_failure_keeps_the_bl_result(tmp_path, name, data):
+    output, _ = rules_output(str(tmp_path / 'rules'), name, data)
+    assert output == {name: pdc_rules.transform_idstv_bl(data) or data}
+    assert output == legacy_output(str(tmp_path / 'legacy'), name, data)
+
+
+def test_transform_idstv_am_compacts_short_angle_ids():
+    _, data = idstv_file(8, pieces=30)
+    output = pdc_rules.transform_idstv_am(pdc_rules.transform_idstv_bl(data))
+    assert output is not None and output != data
+    assert pdc_rules.transform_idstv_am(idstv_file(9, angle=False)[1]) is None
+
+
+@pytest.mark.parametrize('name, data', [
+    nc1_file(10, holes=LARGE_NC1_HOLES, scribes=LARGE_NC1_HOLES // 3),
+    idstv_file(11, pieces=6000),
+], ids=['nc1', 'idstv'])
+def test_pipeline_processes_files_above_the_mmap_threshold(tmp_path, name, data):
+    assert len(data) >= pdc_rules.MMAP_THRESHOLD
+    expected = legacy_output(str(tmp_path / 'legacy'), name, data)
+    directory = tmp_path / 'pipeline'
+    directory.mkdir()
+    (directory / name).write_bytes(data)
+    assert Pipeline().process(FileTask(str(directory / name), str(directory)))
+    assert folder_state(str(directory)) == expected
@@ -0,0 +1,62 @@
+"""ShiftCalendar: splitting time over shifts, breaks and days off."""
+from datetime import datetime
+
+import pytest
+
+from shift_calendar import BREAK, DEFAULT_PATTERN, UNDEFINED, ShiftCalendar
+
+WEEKDAY_PATTERN = {
+    'shifts': [{'name': 'Day', 'start': '07:00', 'end': '15:30'},
+               {'name': 'Evening', 'start': '15:30', 'end': '24:00'}],
+    'breaks': [{'start': '12:00', 'end': '12:30'}, {'start': '20:00', 'end': '20:30'}],
+    'workdays': ['Mon', 'Tue', 'Wed', 'Thu', 'Fri'],
+}
+SUNDAY_NIGHT_PATTERN = {
+    'shifts': [{'name': 'Night', 'start': '22:00', 'end': '06:00'}],
+    'breaks': [{'start': '02:00', 'end': '02:30'}],
+    'workdays': ['Sun'],
+}
+
+
+def moment(text):
+    return datetime.fromisoformat(text)
+
+
+@pytest.mark.parametrize('pattern, start, finish, expected', [
+    # 2024-02-05 is a Monday
+    (WEEKDAY_PATTERN, '2024-02-05 11:00', '2024-02-05 13:00', {'Day': 5400, BREAK: 1800}),
+    (WEEKDAY_PATTERN, '2024-02-05 15:00', '2024-02-05 16:00', {'Day': 1800, 'Evening': 1800}),
+    (WEEKDAY_PATTERN, '2024-02-05 19:45', '2024-02-05 20:15', {'Evening': 900, BREAK: 900}),
+    # Over the weekend, which has no shifts
+    (WEEKDAY_PATTERN, '2024-02-09 23:00', '2024-02-12 08:00', {'Evening': 3600, UNDEFINED: 55 * 3600, 'Day': 3600}),
+    (WEEKDAY_PATTERN, '2024-02-10 09:00', '2024-02-10 10:00', {UNDEFINED: 3600}),
+    # A shift that runs from Sunday night into Monday, the end of the week table, with a break after midnight
+    (SUNDAY_NIGHT_PATTERN, '2024-02-11 21:00', '2024-02-12 07:00',
+     {UNDEFINED: 7200, 'Night': 27000, BREAK: 1800}),
+    (DEFAULT_PATTERN, '2024-02-10 18:00', '2024-02-11 08:00', {'Day': 2 * 3600, 'Night': 12 * 3600}),
+], ids=['break', 'shift-change', 'inside-break', 'weekend', 'day-off', 'sunday-night', 'default'])
+def test_split(pattern, start, finish, expected):
+    calendar = ShiftCalendar(**pattern)
+    split = calendar.split(moment(start), moment(finish))
+    assert split == expected
+    assert sum(split.values()) == (moment(finish) - moment(start)).total_seconds()
+    assert calendar.working_seconds(moment(start), moment(finish)) == sum(split.values()) - split.get(BREAK, 0)
+
+
+def test_a_break_belongs_to_its_shift():
+    calendar = ShiftCalendar(**WEEKDAY_PATTERN)
+    assert calendar.classify(moment('2024-02-05 12:10')) == 'Day'
+    assert calendar.classify(moment('2024-02-10 12:10')) == UNDEFINED
+    assert calendar.shift_hours == {'Day': 8.0, 'Evening': 8.0}
+
+
+@pytest.mark.parametrize('pattern, date, hours', [
+    (DEFAULT_PATTERN, '2024-02-05', 24),
+    (WEEKDAY_PATTERN, '2024-02-05', 16),
+    (WEEKDAY_PATTERN, '2024-02-10', 0),
+    # The day runs from rollover to rollover (05:00), so the last hour of the night shift is Monday's, as its parts are
+    (SUNDAY_NIGHT_PATTERN, '2024-02-11', 6.5),
+    (SUNDAY_NIGHT_PATTERN, '2024-02-12', 1),
+], ids=['default', 'weekday', 'saturday', 'night-into-monday', 'monday'])
+def test_working_hours_of_a_production_day(pattern, date, hours):
+    assert ShiftCalendar(**pattern).working_hours(date) == hours
@@ -0,0 +1,91 @@
+"""PathTable, FileTable and ExpiringPaths in pdc_state."""
+import math
+
+from pdc_state import ExpiringPaths, FileTable, PathTable
+
+
+def paths(count):
+    return [f"N:/Jobs/W{number // 10:05d}/part{number}.nc1" for number in range(count)]
+
+
+def test_file_table_round_trip():
+    table = FileTable({'size': 'q', 'changed': 'd'})
+    file_id = table.add('N:/Jobs/W1/a.nc1', size=10)
+    assert table.find('N:/Jobs/W1/a.nc1') == file_id
+    assert table.path(file_id) == 'N:/Jobs/W1/a.nc1'
+    assert table.get(file_id, 'size') == 10 and table.get(file_id, 'changed') is None
+    assert table.add('N:/Jobs/W1/a.nc1', changed=2.5) == file_id
+    assert table.get(file_id, 'changed') == 2.5 and len(table) == 1
+    table.remove(file_id)
+    assert table.find('N:/Jobs/W1/a.nc1') is None and len(table) == 0
+
+
+def test_directories_are_forgotten_with_their_last_file():
+    table = FileTable({'until': 'd'})
+    ids = [table.add(path, until=1.0) for path in paths(5000)]
+    assert len(table.paths) == 500
+    for file_id in ids:
+        table.remove(file_id)
+    table.compact()
+    assert len(table.paths) == 0
+    assert table.paths.directories == [] and len(table.paths.references) == 0
+    assert len(table.directory) == 0
+
+
+def test_directory_ids_are_reused():
+    table = FileTable({'until': 'd'})
+    first = table.add('N:/a/x.nc1')
+    table.add('N:/b/x.nc1')
+    table.remove(first)
+    assert table.paths.directory_id('N:/a/') is None
+    assert table.directory[table.add('N:/c/x.nc1')] == 0
+    assert [table.path(file_id) for file_id in sorted(table.ids())] == ['N:/c/x.nc1', 'N:/b/x.nc1']
+
+
+def test_directory_columns_hold_references():
+    table = FileTable({'root': 'l', 'changed': 'd'}, directory_columns=['root'])
+    first = table.add('N:/Jobs/W1/a.nc1', root='N:/Jobs', changed=1.0)
+    second = table.add('N:/Jobs/W2/b.nc1', root='N:/Jobs')
+    assert table.paths.directories[table.columns['root'][first]] == 'N:/Jobs'
+    table.remove(first)
+    assert table.paths.directory_id('N:/Jobs') is not None
+    table.set(second, 'root', 'N:/Other')
+    assert table.paths.directory_id('N:/Jobs') is None
+    table.remove(second)
+    table.compact()
+    assert len(table.paths) == 0
+
+
+def test_shared_path_table():
+    shared = PathTable()
+    waiting = FileTable({'changed': 'd'}, shared)
+    written = ExpiringPaths(shared)
+    file_id = waiting.add('N:/Jobs/W1/a.nc1')
+    written.add('N:/Jobs/W1/b.nc1', until=5.0)
+    waiting.remove(file_id)
+    assert shared.directory_id('N:/Jobs/W1/') is not None
+    assert written.active('N:/Jobs/W1/b.nc1', 1.0)
+    assert written.prune(10.0) == 1
+    assert len(shared) == 0
+
+
+def test_expiring_paths():
+    written = ExpiringPaths()
+    for number, path in enumerate(paths(100)):
+        written.add(path, until=float(number))
+    assert not written.active(paths(100)[10], 50.0)
+    assert written.active(paths(100)[60], 50.0)
+    assert written.prune(50.0) == 49
+    assert len(written) == 50 and len(written.table.paths) == 5
+    assert written.prune(math.inf) == 50
+    assert len(written.table.paths) == 0
+
+
+def test_expiring_paths_with_values():
+    written = ExpiringPaths(columns={'size': 'q'})
+    written.add('N:/Jobs/W1/a.nc1', until=5.0, size=42)
+    assert written.get('N:/Jobs/W1/a.nc1', 1.0) == {'until': 5.0, 'size': 42}
+    written.forget('N:/Jobs/W1/a.nc1')
+    assert written.get('N:/Jobs/W1/a.nc1', 1.0) is None and len(written.table.paths) == 0
+    written.add('N:/Jobs/W1/b.nc1', until=5.0, size=1)
+    assert written.get('N:/Jobs/W1/b.nc1', 6.0) is None and len(written) == 0
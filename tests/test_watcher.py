@@ -0,0 +1,62 @@
+"""Burst handling and self-write suppression in pdc_watcher."""
+import os
+import random
+
+import synthetic_data
+from pdc_watcher import BURST_EVENTS, Burst, FileTask, Pipeline, WatchEngine
+
+
+def nc1_file(seed=1):
+    rng = random.Random(seed)
+    prefix = synthetic_data.job_prefix()
+    ident = synthetic_data.piece_id(rng, 1, seed + 1)
+    return f"{prefix}{ident}.nc1", synthetic_data.nc1_text(rng, prefix, ident, 1200.0, 8, 6).encode()
+
+
+def test_split_quiet_takes_the_settled_files():
+    burst = Burst('N:/Jobs', 10.0)
+    burst.names = {'a.nc1': 11.0, 'b.nc1': 13.5, 'c.nc1': 12.0}
+    quiet = burst.split_quiet(14.0, 2.0)
+    assert quiet.names == {'a.nc1': 11.0, 'c.nc1': 12.0}
+    assert quiet.first_event == 10.0 and quiet.root == 'N:/Jobs'
+    assert burst.names == {'b.nc1': 13.5} and burst.first_event == 14.0
+    assert burst.split_quiet(14.5, 2.0).names == {}
+
+
+def test_a_busy_folder_switches_to_a_burst(tmp_path):
+    engine = WatchEngine(workers=1)
+    directory = str(tmp_path)
+    paths = [os.path.join(directory, f"part{number}.nc1") for number in range(BURST_EVENTS + 5)]
+    for path in paths[:BURST_EVENTS - 1]:
+        engine.notify(path, directory)
+    assert len(engine.pending) == BURST_EVENTS - 1 and not engine.bursts
+    for path in paths[BURST_EVENTS - 1:]:
+        engine.notify(path, directory)
+    burst = engine.bursts[directory]
+    assert len(engine.pending) == 0 and len(engine.pending.paths) == 0
+    assert sorted(burst.names) == sorted(os.path.basename(path) for path in paths)
+    # A change to a file of the burst restarts its settle time; a change to an unknown file is ignored
+    before = burst.names['part0.nc1']
+    engine.notify(paths[0], directory, 'modified')
+    engine.notify(os.path.join(directory, 'other.nc1'), directory, 'modified')
+    assert burst.names['part0.nc1'] >= before and 'other.nc1' not in burst.names
+
+
+def test_our_own_write_is_ignored_but_a_new_export_is_not(tmp_path):
+    name, data = nc1_file()
+    path = tmp_path / name
+    path.write_bytes(data)
+    pipeline = Pipeline()
+    assert pipeline.process(FileTask(str(path), str(tmp_path)))
+    [target] = [str(tmp_path / written) for written in os.listdir(tmp_path)]
+    assert pipeline.written_by_us(target)
+    engine = WatchEngine(pipeline)
+    engine.notify(target, str(tmp_path))
+    assert len(engine.pending) == 0
+    # The same job exported again, to the same path, right away
+    with open(target, 'wb') as file:
+        file.write(data + b'\n')
+    assert not pipeline.written_by_us(target)
+    assert len(pipeline.recently_written) == 0
+    engine.notify(target, str(tmp_path))
+    assert engine.pending.find(target) is not None